@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import ServerConfig, BackupFile, TransferLog, ScheduleConfig
+from .models import ServerConfig, BackupFile, TransferLog, ScheduleConfig, SnapshotDirectory, TransferJob, ScheduleRun, TransferBatch, ServerState, LeaderLease, WorkerNode, FairShare
+from .breaker import get_breaker_state
 
 @admin.register(ServerConfig)
 class ServerConfigAdmin(admin.ModelAdmin):
@@ -25,3 +26,49 @@ class ScheduleConfigAdmin(admin.ModelAdmin):
     list_filter = ('frequency', 'enabled', 'user')
     search_fields = ('name',)
 
+
+@admin.register(SnapshotDirectory)
+class SnapshotDirectoryAdmin(admin.ModelAdmin):
+    list_display = ('path', 'server', 'mtime', 'complete', 'scanned_at')
+    list_filter = ('complete', 'server')
+    search_fields = ('path',)
+
+@admin.register(TransferJob)
+class TransferJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'backup_file', 'status', 'priority', 'deadline', 'action', 'attempts', 'lease_owner', 'lease_expires_at', 'created_at')
+    list_filter = ('status', 'priority', 'action')
+    search_fields = ('backup_file__filename', 'lease_owner')
+
+@admin.register(ScheduleRun)
+class ScheduleRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'schedule', 'trigger', 'status', 'scanned_count', 'registered_count', 'queued_count', 'created_at', 'finished_at')
+    list_filter = ('status', 'trigger')
+    search_fields = ('schedule__name', 'lease_owner')
+
+@admin.register(TransferBatch)
+class TransferBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'source_status', 'action', 'status', 'total_count', 'created_at', 'finished_at')
+    list_filter = ('status', 'source_status', 'action')
+    search_fields = ('user__username', 'lease_owner')
+
+@admin.register(ServerState)
+class ServerStateAdmin(admin.ModelAdmin):
+    list_display = ('server', 'concurrency', 'last_throughput', 'window_transfers', 'window_errors', 'breaker', 'consecutive_failures', 'updated_at')
+    search_fields = ('server__name', 'server__host')
+
+    @admin.display(description='Circuit breaker')
+    def breaker(self, obj):
+        return get_breaker_state(obj)
+
+@admin.register(LeaderLease)
+class LeaderLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'holder', 'acquired_at', 'heartbeat_at', 'expires_at')
+
+@admin.register(WorkerNode)
+class WorkerNodeAdmin(admin.ModelAdmin):
+    list_display = ('name', 'started_at', 'heartbeat_at', 'expires_at')
+
+@admin.register(FairShare)
+class FairShareAdmin(admin.ModelAdmin):
+    list_display = ('user', 'weight', 'max_transfers', 'virtual_time')
+    search_fields = ('user__username',)
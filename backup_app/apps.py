@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BackupAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backup_app'
+
+    def ready(self):
+        # Push schedule edits to a scheduler running in this process
+        from . import signals  # noqa: F401
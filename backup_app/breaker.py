@@ -0,0 +1,151 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import ServerState
+from .limits import get_max_transfers
+from .concurrency import get_initial_concurrency
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpen(Exception):
+    """Raised instead of connecting to a server whose circuit breaker is open"""
+
+def get_failure_threshold():
+    """Consecutive connection failures that open a server's circuit breaker"""
+    return getattr(settings, 'BACKUP_BREAKER_FAILURE_THRESHOLD', 5)
+
+def get_cooldown_seconds():
+    """How long an open breaker rejects connections before letting a probe through"""
+    return getattr(settings, 'BACKUP_BREAKER_COOLDOWN_SECONDS', 300)
+
+def get_breaker_state(state, now=None):
+    """
+    Breaker state of a server from its ServerState
+
+    Args:
+        state: ServerState of the server, or None if it has none yet
+
+    Returns:
+        str: CLOSED, OPEN or HALF_OPEN
+    """
+    if state is None or state.breaker_opened_at is None:
+        return CLOSED
+    now = now or timezone.now()
+    if now - state.breaker_opened_at < timedelta(seconds=get_cooldown_seconds()):
+        return OPEN
+    return HALF_OPEN
+
+def get_server_breaker_state(server_config):
+    """Breaker state of a ServerConfig, using its (possibly prefetched) ServerState"""
+    try:
+        state = server_config.state
+    except ServerState.DoesNotExist:
+        state = None
+    return get_breaker_state(state)
+
+def get_breaker_allowance(server_config):
+    """
+    Transfers the breaker lets run against a server: None when closed, 1 while
+    half-open (a single probe) and 0 while open
+    """
+    breaker = get_server_breaker_state(server_config)
+    if breaker == OPEN:
+        return 0
+    if breaker == HALF_OPEN:
+        return 1
+    return None
+
+def check_circuit(server_config):
+    """
+    Make sure a connection to a server may be attempted
+
+    Reads the breaker from the database rather than from `server_config`, which
+    a long-running worker may have loaded long ago. While the breaker is
+    half-open exactly one caller becomes the probe; everyone else is rejected
+    until the probe has closed or re-opened it.
+
+    Raises:
+        CircuitOpen: if the breaker is open, or half-open with a probe running
+    """
+    if server_config.pk is None:
+        # Unsaved configurations (e.g. a connection test) have no breaker
+        return
+    state = ServerState.objects.filter(server_id=server_config.pk).only(
+        'breaker_opened_at', 'consecutive_failures'
+    ).first()
+    now = timezone.now()
+    breaker = get_breaker_state(state, now)
+    if breaker == CLOSED:
+        return
+    if breaker == HALF_OPEN:
+        # A probe that never reported back (its worker died) is replaced after a cooldown
+        stale = now - timedelta(seconds=get_cooldown_seconds())
+        probe = ServerState.objects.filter(
+            pk=state.pk,
+            breaker_opened_at=state.breaker_opened_at
+        ).filter(
+            Q(probe_started_at__isnull=True) | Q(probe_started_at__lt=stale)
+        ).update(probe_started_at=now)
+        if probe:
+            logger.info(f"Circuit breaker for {server_config.host} half-open, probing")
+            return
+    raise CircuitOpen(
+        f"Circuit breaker open for {server_config.host} after {state.consecutive_failures} "
+        f"consecutive connection failures"
+    )
+
+def record_connection_success(server_config):
+    """Reset a server's failure count, closing its breaker if it was open"""
+    if server_config.pk is None:
+        return
+    closed = ServerState.objects.filter(server_id=server_config.pk, breaker_opened_at__isnull=False).update(
+        consecutive_failures=0,
+        breaker_opened_at=None,
+        probe_started_at=None
+    )
+    if closed:
+        logger.info(f"Circuit breaker for {server_config.host} closed")
+    else:
+        ServerState.objects.filter(server_id=server_config.pk, consecutive_failures__gt=0).update(consecutive_failures=0)
+
+def record_connection_failure(server_config):
+    """
+    Count a failed connection attempt against a server
+
+    The breaker opens once the failures reach BACKUP_BREAKER_FAILURE_THRESHOLD
+    in a row; a failed probe re-opens it for another cooldown.
+    """
+    if server_config.pk is None:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        state, _ = ServerState.objects.select_for_update().get_or_create(
+            server=server_config,
+            defaults={
+                'concurrency': min(get_initial_concurrency(), get_max_transfers(server_config)),
+                'window_started_at': now
+            }
+        )
+        state.consecutive_failures += 1
+        if state.breaker_opened_at is not None:
+            if get_breaker_state(state, now) == HALF_OPEN:
+                logger.warning(f"Probe of {server_config.host} failed, circuit breaker stays open")
+                state.breaker_opened_at = now
+                state.probe_started_at = None
+        elif state.consecutive_failures >= get_failure_threshold():
+            logger.warning(
+                f"Circuit breaker for {server_config.host} opened after "
+                f"{state.consecutive_failures} consecutive connection failures"
+            )
+            state.breaker_opened_at = now
+            state.probe_started_at = None
+        state.updated_at = now
+        state.save(update_fields=['consecutive_failures', 'breaker_opened_at', 'probe_started_at', 'updated_at'])
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import BackupFile, JobStatus, TransferJob, TransferLog, TransferStatus
+from .utils import TransferAborted, TransferCancelled
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Statuses a transfer can be cancelled from; FAILED files would be retried
+# automatically once their backoff elapses
+CANCELLABLE = (TransferStatus.PENDING, TransferStatus.IN_PROGRESS, TransferStatus.RETRYING, TransferStatus.FAILED)
+
+# Message stored on cancelled files and jobs
+CANCELLED = 'Transfer cancelled by user'
+
+def get_cancel_check_seconds():
+    """How often a running transfer asks the database whether it was cancelled"""
+    return getattr(settings, 'BACKUP_CANCEL_CHECK_SECONDS', 1)
+
+# Tokens of the transfers running in this process, by BackupFile id
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+class CancellationToken:
+    """
+    Cooperative cancellation of the transfers run by one worker thread
+
+    copy_stream checks the token after every chunk, so a cancelled transfer
+    stops within one chunk of being noticed. Cancellations requested in this
+    process are noticed at once; those from other processes (e.g. the web
+    server when transfers run in dedicated workers) when the token polls the
+    files, at most BACKUP_CANCEL_CHECK_SECONDS apart.
+
+    A file is cancelled once cancel_file_transfer released it; a file whose
+    ownership went to another worker is aborted too, but without raising
+    TransferCancelled, so its destination file is left to the new owner.
+    """
+
+    def __init__(self, backup_file_ids, owner):
+        self.owner = owner
+        self.file_ids = set(backup_file_ids)
+        self.cancelled = set()
+        self.lost = set()
+        self._requested = set()
+        self._lock = threading.Lock()
+        self._checked = time.monotonic()
+
+    def __enter__(self):
+        with _tokens_lock:
+            for file_id in self.file_ids:
+                _tokens.setdefault(file_id, set()).add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _tokens_lock:
+            for file_id in self.file_ids:
+                tokens = _tokens.get(file_id)
+                if tokens is not None:
+                    tokens.discard(self)
+                    if not tokens:
+                        del _tokens[file_id]
+
+    @property
+    def stopped(self):
+        """Ids of the files that must not be transferred any further"""
+        return self.cancelled | self.lost
+
+    def request(self, backup_file_id):
+        """Mark a file as cancelled from this process, without waiting for the next poll"""
+        with self._lock:
+            self._requested.add(backup_file_id)
+
+    def refresh(self):
+        """Look up which of the token's files were cancelled or taken over since the last poll"""
+        with self._lock:
+            self.cancelled |= self._requested & self.file_ids
+        pending = self.file_ids - self.stopped
+        found = set()
+        for file_id, status, transfer_owner in BackupFile.objects.filter(pk__in=pending).values_list(
+            'pk', 'status', 'transfer_owner'
+        ):
+            found.add(file_id)
+            if transfer_owner != self.owner:
+                (self.cancelled if status == TransferStatus.CANCELLED else self.lost).add(file_id)
+        # A file deleted while it was being copied counts as cancelled
+        self.cancelled |= pending - found
+        self._checked = time.monotonic()
+
+    def check(self, backup_file_id):
+        """
+        Stop the transfer of a file if it was cancelled
+
+        Raises:
+            TransferCancelled: if the file was cancelled
+            TransferAborted: if another worker owns the file's transfer now
+        """
+        with self._lock:
+            requested = backup_file_id in self._requested
+        if requested or time.monotonic() - self._checked >= get_cancel_check_seconds():
+            self.refresh()
+        if backup_file_id in self.cancelled:
+            raise TransferCancelled(CANCELLED)
+        if backup_file_id in self.lost:
+            raise TransferAborted(f'Transfer of file {backup_file_id} was taken over by another worker')
+
+def _notify(backup_file_id):
+    """Pass a cancellation on to the transfers of the file running in this process"""
+    with _tokens_lock:
+        tokens = list(_tokens.get(backup_file_id, ()))
+    for token in tokens:
+        token.request(backup_file_id)
+
+def cancel_file_transfer(backup_file, message=CANCELLED):
+    """
+    Cancel the queued, running or backed-off transfer of a BackupFile
+
+    The file moves to CANCELLED and gives up its transfer ownership, so a
+    running worker cannot store a result for it any more; its queued or
+    leased jobs are cancelled, which frees their server slots at once. The
+    worker copying the file notices through its CancellationToken, removes
+    the partial destination file and closes its sessions.
+
+    Returns:
+        bool: False if the file was not in a state that can be cancelled
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        cancelled = BackupFile.objects.filter(pk=backup_file.pk, status__in=CANCELLABLE).update(
+            status=TransferStatus.CANCELLED,
+            error_message=message,
+            next_attempt_at=None,
+            transfer_owner=None,
+            updated_at=now
+        )
+        if not cancelled:
+            return False
+        TransferJob.objects.filter(
+            backup_file_id=backup_file.pk,
+            status__in=[JobStatus.QUEUED, JobStatus.LEASED]
+        ).update(status=JobStatus.CANCELLED, result=message, lease_expires_at=None, finished_at=now)
+        TransferLog.objects.create(backup_file_id=backup_file.pk, action='transfer_cancelled', message=message)
+        transaction.on_commit(lambda: _notify(backup_file.pk))
+    logger.info(f"Cancelled transfer of {backup_file.filename}")
+    return True
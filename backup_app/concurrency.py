@@ -0,0 +1,151 @@
+import logging
+import math
+import re
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import ServerState
+from .limits import get_max_transfers
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Failure messages that point at an overloaded host or link rather than a bad file
+CONGESTION_ERRORS = re.compile(
+    r'timed? ?out|connection (reset|refused|closed|aborted|lost)|broken pipe|eof|'
+    r'sftp connection failed|no connection slot|server connection dropped',
+    re.IGNORECASE
+)
+
+def is_adaptive():
+    """Whether destination concurrency is tuned by the AIMD controller"""
+    return getattr(settings, 'BACKUP_ADAPTIVE_CONCURRENCY', True)
+
+def get_initial_concurrency():
+    """Concurrency a destination starts at before any throughput was measured"""
+    return getattr(settings, 'BACKUP_AIMD_INITIAL_CONCURRENCY', 2)
+
+def get_window_seconds():
+    """Length of the window throughput is measured over between adjustments"""
+    return getattr(settings, 'BACKUP_AIMD_WINDOW_SECONDS', 30)
+
+def get_decrease_factor():
+    """Factor the concurrency is multiplied by after timeouts or connection errors"""
+    return getattr(settings, 'BACKUP_AIMD_DECREASE_FACTOR', 0.5)
+
+def get_growth_threshold():
+    """Relative throughput gain over the previous window needed to keep growing"""
+    return getattr(settings, 'BACKUP_AIMD_GROWTH_THRESHOLD', 0.05)
+
+def is_congestion_error(message):
+    """True if a transfer failure looks like a timeout or dropped connection"""
+    return bool(message and CONGESTION_ERRORS.search(message))
+
+def _get_state(server_config):
+    """The server's ServerState, or None if no transfer finished against it yet"""
+    try:
+        return server_config.state
+    except ServerState.DoesNotExist:
+        return None
+
+def get_transfer_limit(server_config, destination=True):
+    """
+    Number of transfers allowed to run against a server right now
+
+    Destinations use the adaptive level, capped by the server's max_transfers;
+    sources, and every server when the controller is disabled, use
+    max_transfers as is.
+    """
+    ceiling = get_max_transfers(server_config)
+    if not destination or not is_adaptive():
+        return ceiling
+    state = _get_state(server_config)
+    concurrency = state.concurrency if state is not None else get_initial_concurrency()
+    return max(1, min(concurrency, ceiling))
+
+def record_transfer(server_config, nbytes, success, message=None):
+    """
+    Feed a finished transfer to the destination's AIMD controller
+
+    Bytes and congestion errors are accumulated in the server's ServerState.
+    Once per window the concurrency is adjusted:
+
+    - timeouts or connection errors: multiply by the decrease factor
+    - throughput up by more than the growth threshold: add one
+    - flat throughput: step back by one, the extra transfer bought nothing
+    - falling throughput: step back up if the last step was a decrease,
+      otherwise step back by one
+
+    Args:
+        server_config: destination ServerConfig of the transfer
+        nbytes: bytes copied, including a partial copy that failed
+        success: whether the transfer succeeded
+        message: failure message, checked for congestion errors
+    """
+    if not is_adaptive():
+        return
+    now = timezone.now()
+    ceiling = get_max_transfers(server_config)
+    congested = not success and is_congestion_error(message)
+    with transaction.atomic():
+        state, _ = ServerState.objects.select_for_update().get_or_create(
+            server=server_config,
+            defaults={'concurrency': min(get_initial_concurrency(), ceiling), 'window_started_at': now}
+        )
+        state.window_bytes += nbytes
+        state.window_transfers += 1
+        state.window_errors += int(congested)
+
+        elapsed = (now - state.window_started_at).total_seconds()
+        if elapsed >= get_window_seconds():
+            _adjust(state, server_config, elapsed, ceiling)
+            state.window_started_at = now
+            state.window_bytes = 0
+            state.window_transfers = 0
+            state.window_errors = 0
+        state.updated_at = now
+        state.save(update_fields=[
+            'concurrency', 'last_throughput', 'last_step', 'window_started_at',
+            'window_bytes', 'window_transfers', 'window_errors', 'updated_at'
+        ])
+
+def _adjust(state, server_config, elapsed, ceiling):
+    """Apply one AIMD step to `state` at the end of a measurement window"""
+    previous = state.concurrency
+    throughput = state.window_bytes / elapsed
+
+    if elapsed >= 3 * get_window_seconds():
+        # The destination sat idle for most of the window; its throughput says
+        # nothing about the concurrency, so only start a new baseline
+        state.last_throughput = None
+        state.last_step = 0
+        return
+
+    threshold = get_growth_threshold()
+    if state.window_errors:
+        concurrency = max(1, math.floor(previous * get_decrease_factor()))
+    elif state.last_throughput is None or throughput > state.last_throughput * (1 + threshold):
+        concurrency = previous + 1
+    elif throughput < state.last_throughput * (1 - threshold) and state.last_step < 0:
+        # Cutting the concurrency hurt; undo it
+        concurrency = previous + 1
+    else:
+        concurrency = previous - 1
+
+    state.concurrency = max(1, min(concurrency, ceiling))
+    state.last_step = state.concurrency - previous
+    state.last_throughput = throughput
+    if state.concurrency != previous:
+        logger.info(
+            f"Concurrency for {server_config.host} {previous} -> {state.concurrency} "
+            f"({throughput:.0f} B/s, {state.window_errors} errors in {state.window_transfers} transfers)"
+        )
+
+def current_levels():
+    """
+    Adaptive concurrency per destination, for metrics
+
+    Returns:
+        dict: ServerConfig id -> current concurrency level
+    """
+    return dict(ServerState.objects.values_list('server_id', 'concurrency'))
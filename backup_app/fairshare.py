@@ -0,0 +1,96 @@
+import logging
+from collections import Counter
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import FairShare, JobStatus, TransferJob
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+def is_fair_share():
+    """Whether queued transfers are shared fairly between users"""
+    return getattr(settings, 'BACKUP_FAIR_SHARE', True)
+
+def get_default_weight():
+    """Weight of users without their own FairShare weight"""
+    return getattr(settings, 'BACKUP_DEFAULT_USER_WEIGHT', 1.0)
+
+def get_max_user_transfers(share=None):
+    """Maximum concurrent transfers of one user, None for no limit"""
+    if share is not None and share.max_transfers:
+        return share.max_transfers
+    return getattr(settings, 'BACKUP_USER_MAX_TRANSFERS', None)
+
+def _running_per_user():
+    """Live transfer sessions per user, a small-file group counting once"""
+    running = TransferJob.objects.filter(status=JobStatus.LEASED, lease_expires_at__gte=timezone.now())
+    counts = Counter()
+    for _, user_id in running.values_list('lease_owner', 'user_id').distinct():
+        counts[user_id] += 1
+    return counts
+
+def get_shares(user_ids):
+    """
+    FairShare rows of the given users, created with default weights if missing
+
+    Returns:
+        dict: user id -> FairShare
+    """
+    shares = {share.user_id: share for share in FairShare.objects.filter(user_id__in=user_ids)}
+    missing = [user_id for user_id in user_ids if user_id is not None and user_id not in shares]
+    if missing:
+        FairShare.objects.bulk_create(
+            [FairShare(user_id=user_id, weight=get_default_weight()) for user_id in missing],
+            ignore_conflicts=True
+        )
+        shares.update((share.user_id, share) for share in FairShare.objects.filter(user_id__in=missing))
+    return shares
+
+def fair_order(user_ids):
+    """
+    Order in which users with queued jobs are served
+
+    Start-time fair queuing: every claimed job advances its user's virtual
+    time by its expected seconds divided by the user's weight, and the user
+    furthest behind is served first. A user coming back with new work after
+    being idle is moved up to the virtual time of the busy users, so it
+    cannot cash in the idle period and starve them. Users at their
+    max_transfers are left out until a transfer of theirs finishes.
+
+    Args:
+        user_ids: users with claimable jobs; None stands for jobs without a user
+
+    Returns:
+        list: user ids to try claiming for, in order
+    """
+    shares = get_shares(user_ids)
+    running = _running_per_user()
+    busy = [shares[user_id].virtual_time for user_id in shares if running[user_id]]
+    floor = min(busy) if busy else 0
+
+    for user_id, share in shares.items():
+        if not running[user_id] and share.virtual_time < floor:
+            # Idle users re-enter at the busy users' virtual time
+            FairShare.objects.filter(pk=share.pk, virtual_time__lt=floor).update(virtual_time=floor)
+            share.virtual_time = floor
+
+    order = []
+    for user_id in user_ids:
+        share = shares.get(user_id)
+        limit = get_max_user_transfers(share)
+        if limit is not None and running[user_id] >= limit:
+            continue
+        order.append((share.virtual_time if share else floor, running[user_id], user_id))
+    return [user_id for _, _, user_id in sorted(order, key=lambda item: item[:2])]
+
+def charge(jobs):
+    """Advance the virtual time of the users of claimed jobs by the jobs' expected seconds"""
+    costs = Counter()
+    for job in jobs:
+        if job.user_id is not None:
+            costs[job.user_id] += job.expected_seconds or 1
+    for user_id, seconds in costs.items():
+        FairShare.objects.filter(user_id=user_id).update(
+            virtual_time=F('virtual_time') + seconds / F('weight')
+        )
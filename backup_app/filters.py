@@ -0,0 +1,152 @@
+import fnmatch
+import re
+import time
+
+# Prefix marking a pattern as a regular expression instead of a glob
+REGEX_PREFIX = 're:'
+
+def parse_patterns(text):
+    """Split a newline/comma separated pattern list, dropping blanks"""
+    if not text:
+        return []
+    return [pattern.strip() for pattern in re.split(r'[\n,]', text) if pattern.strip()]
+
+def validate_patterns(text):
+    """
+    Check a pattern list for invalid regular expressions
+
+    Returns:
+        list: error messages, empty if every pattern is valid
+    """
+    errors = []
+    for pattern in parse_patterns(text):
+        if pattern.startswith(REGEX_PREFIX):
+            try:
+                re.compile(pattern[len(REGEX_PREFIX):])
+            except re.error as e:
+                errors.append(f'Invalid regular expression "{pattern}": {e}')
+    return errors
+
+class _Pattern:
+    """A single glob or regex rule matched against an entry's relative path"""
+
+    def __init__(self, pattern):
+        self.directory_only = pattern.endswith('/') and not pattern.startswith(REGEX_PREFIX)
+        if pattern.startswith(REGEX_PREFIX):
+            self._regex = re.compile(pattern[len(REGEX_PREFIX):])
+        else:
+            self._regex = re.compile(fnmatch.translate(pattern.rstrip('/')))
+        self._is_glob = not pattern.startswith(REGEX_PREFIX)
+
+    def matches(self, rel_path, is_folder):
+        if self.directory_only and not is_folder:
+            return False
+        if self._is_glob:
+            # Globs match either the full relative path or just the name, so
+            # `cache` and `*.lock` work at any depth
+            name = rel_path.rsplit('/', 1)[-1]
+            return bool(self._regex.match(rel_path) or self._regex.match(name))
+        return bool(self._regex.search(rel_path))
+
+class ScanFilter:
+    """
+    Include/exclude rules evaluated while walking a source tree
+
+    Patterns are globs (`*.lock`, `tmp/` for directories only) or regular
+    expressions prefixed with `re:`, matched against the path relative to the
+    source server's remote path. Excluded directories are never descended
+    into; include patterns and size/age limits apply to files only.
+    """
+
+    FIELDS = ('include_patterns', 'exclude_patterns', 'min_size', 'max_size', 'min_age_hours', 'max_age_hours')
+
+    def __init__(self, include_patterns='', exclude_patterns='', min_size=None, max_size=None,
+                 min_age_hours=None, max_age_hours=None):
+        self.include_patterns = include_patterns or ''
+        self.exclude_patterns = exclude_patterns or ''
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_age_hours = min_age_hours
+        self.max_age_hours = max_age_hours
+        self._includes = [_Pattern(pattern) for pattern in parse_patterns(self.include_patterns)]
+        self._excludes = [_Pattern(pattern) for pattern in parse_patterns(self.exclude_patterns)]
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a filter from any object with the filter fields, e.g. a ScheduleConfig"""
+        return cls(**{field: getattr(config, field, None) for field in cls.FIELDS})
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Build a filter from submitted form data, e.g. the manual scan POST
+
+        Raises:
+            ValueError: if a limit is not a non-negative number or a regex is invalid
+        """
+        values = {}
+        for field in cls.FIELDS:
+            value = (data.get(field) or '').strip()
+            if field.endswith('_patterns'):
+                errors = validate_patterns(value)
+                if errors:
+                    raise ValueError(errors[0])
+                values[field] = value
+            elif value:
+                number = float(value) if field.endswith('_hours') else int(value)
+                if number < 0:
+                    raise ValueError(f'{field} must not be negative')
+                values[field] = number
+        return cls(**values)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a filter from the dictionary stored on a BackupFile (or None)"""
+        return cls(**{field: (data or {}).get(field) for field in cls.FIELDS})
+
+    def to_dict(self):
+        """Serialize the filter, or return None when it has no rules"""
+        if self.is_empty:
+            return None
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def is_empty(self):
+        return not (self._includes or self._excludes or self.min_size is not None or self.max_size is not None
+                    or self.min_age_hours is not None or self.max_age_hours is not None)
+
+    @property
+    def key(self):
+        """Hashable identity of the rules, used to key cached folder sizes"""
+        return tuple(getattr(self, field) for field in self.FIELDS) if not self.is_empty else None
+
+    def allows(self, rel_path, entry, now=None):
+        """
+        Decide whether an entry is listed/transferred (or, for folders, descended into)
+
+        Args:
+            rel_path: path of the entry relative to the source server's remote path
+            entry: RemoteEntry
+            now: current epoch time, defaults to time.time()
+        """
+        if any(pattern.matches(rel_path, entry.is_folder) for pattern in self._excludes):
+            return False
+        if entry.is_folder:
+            return True
+
+        if self._includes and not any(pattern.matches(rel_path, False) for pattern in self._includes):
+            return False
+        if self.min_size is not None and entry.size < self.min_size:
+            return False
+        if self.max_size is not None and entry.size > self.max_size:
+            return False
+
+        if self.min_age_hours is not None or self.max_age_hours is not None:
+            if entry.mtime is None:
+                return False
+            age_hours = ((now or time.time()) - entry.mtime) / 3600
+            if self.min_age_hours is not None and age_hours < self.min_age_hours:
+                return False
+            if self.max_age_hours is not None and age_hours > self.max_age_hours:
+                return False
+        return True
@@ -1,7 +1,8 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.models import User
-from .models import ServerConfig, ScheduleConfig
+from .models import ServerConfig, ScheduleConfig, TransferOrder
+from .filters import validate_patterns
 
 class LoginForm(AuthenticationForm):
     username = forms.CharField(
@@ -78,10 +79,23 @@ class ServerConfigForm(forms.ModelForm):
         choices=SERVER_TYPE_CHOICES,
         widget=forms.Select(attrs={'class': 'form-select'})
     )
+    max_connections = forms.IntegerField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Default'}),
+        required=False,
+        min_value=1,
+        help_text='Maximum SSH sessions each worker process opens to this server'
+    )
+    max_transfers = forms.IntegerField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Default'}),
+        required=False,
+        min_value=1,
+        help_text='Maximum transfers running against this server across all workers'
+    )
     
     class Meta:
         model = ServerConfig
-        fields = ['name', 'host', 'port', 'username', 'password', 'private_key', 'remote_path', 'server_type']
+        fields = ['name', 'host', 'port', 'username', 'password', 'private_key', 'remote_path', 'server_type',
+                  'max_connections', 'max_transfers']
         
     def clean(self):
         cleaned_data = super().clean()
@@ -131,10 +145,55 @@ class ScheduleConfigForm(forms.ModelForm):
         required=False,
         widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
     )
+    normalize_line_endings = forms.BooleanField(
+        initial=False,
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    transfer_order = forms.ChoiceField(
+        choices=TransferOrder.choices,
+        initial=TransferOrder.SCAN,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    deadline_minutes = forms.IntegerField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Minutes after the run starts'}),
+        min_value=1,
+        required=False
+    )
+    include_patterns = forms.CharField(
+        widget=forms.Textarea(attrs={'class': 'form-control', 'placeholder': 'One pattern per line (e.g., *.sql or re:^db/.*\\.gz$)', 'rows': 3}),
+        required=False
+    )
+    exclude_patterns = forms.CharField(
+        widget=forms.Textarea(attrs={'class': 'form-control', 'placeholder': 'One pattern per line (e.g., tmp/, cache/, *.lock)', 'rows': 3}),
+        required=False
+    )
+    min_size = forms.IntegerField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Minimum size in bytes'}),
+        min_value=0,
+        required=False
+    )
+    max_size = forms.IntegerField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Maximum size in bytes'}),
+        min_value=0,
+        required=False
+    )
+    min_age_hours = forms.FloatField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Minimum age in hours'}),
+        min_value=0,
+        required=False
+    )
+    max_age_hours = forms.FloatField(
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Maximum age in hours'}),
+        min_value=0,
+        required=False
+    )
     
     class Meta:
         model = ScheduleConfig
-        fields = ['name', 'source_server', 'destination_server', 'frequency', 'cron_expression', 'enabled']
+        fields = ['name', 'source_server', 'destination_server', 'frequency', 'cron_expression', 'enabled',
+                  'normalize_line_endings', 'transfer_order', 'deadline_minutes', 'include_patterns', 'exclude_patterns', 'min_size', 'max_size',
+                  'min_age_hours', 'max_age_hours']
         
     def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -149,5 +208,19 @@ class ScheduleConfigForm(forms.ModelForm):
         
         if frequency == 'custom' and not cron_expression:
             self.add_error('cron_expression', 'Cron expression is required for custom schedules')
+        
+        for field in ('include_patterns', 'exclude_patterns'):
+            for error in validate_patterns(cleaned_data.get(field)):
+                self.add_error(field, error)
+        
+        min_size = cleaned_data.get('min_size')
+        max_size = cleaned_data.get('max_size')
+        if min_size is not None and max_size is not None and min_size > max_size:
+            self.add_error('max_size', 'Maximum size must not be smaller than minimum size')
+        
+        min_age = cleaned_data.get('min_age_hours')
+        max_age = cleaned_data.get('max_age_hours')
+        if min_age is not None and max_age is not None and min_age > max_age:
+            self.add_error('max_age_hours', 'Maximum age must not be smaller than minimum age')
             
         return cleaned_data
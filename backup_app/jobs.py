@@ -0,0 +1,1129 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from .models import (
+    BackupFile, ServerConfig, ScheduleConfig, ScheduleRun, TransferBatch, TransferJob, TransferLog, TransferStatus,
+    TransferOrder, TransferPriority, JobStatus
+)
+from .utils import SCAN_CHUNK_SIZE, TransferAborted, TransferCancelled, iter_chunks, transfer_file, transfer_files
+from .limits import connection_slots
+from .concurrency import current_levels, get_transfer_limit, record_transfer
+from .ordering import estimate_seconds, get_order_key, get_transfer_rates
+from .retries import schedule_retry
+from .breaker import get_breaker_allowance
+from .fairshare import charge, fair_order, get_max_user_transfers, is_fair_share
+from .cancellation import CANCELLED, CancellationToken
+from .sharding import Shard, deregister_node, get_node_heartbeat_seconds, is_sharded, purge_nodes, schedule_key, server_key
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Result returned by execute_job when the job was taken over by another worker
+LEASE_LOST = 'Lease lost'
+
+# Results of jobs that lost the compare-and-set on their file and did nothing
+ALREADY_TRANSFERRED = 'Skipped: file already transferred'
+ALREADY_RUNNING = 'Skipped: file is being transferred by another worker'
+SKIPPED = (ALREADY_TRANSFERRED, ALREADY_RUNNING)
+
+# Claim order of transfer jobs: priority class, earliest deadline, then run by run in order_key order
+JOB_ORDERING = ('priority', F('deadline').asc(nulls_last=True), 'run_at', 'order_key', 'created_at')
+
+class LeaseLost(TransferAborted):
+    """Raised inside a transfer when the worker no longer holds the job's lease"""
+
+class WorkerStopping(TransferAborted):
+    """Raised inside a schedule run that would otherwise keep a stopping worker waiting"""
+
+def get_lease_seconds():
+    """Visibility timeout: a leased job is handed to another worker if not renewed in time"""
+    return getattr(settings, 'BACKUP_JOB_LEASE_SECONDS', 300)
+
+def get_heartbeat_seconds():
+    """Minimum interval between lease renewals while a transfer is running"""
+    return getattr(settings, 'BACKUP_JOB_HEARTBEAT_SECONDS', 30)
+
+def get_poll_seconds():
+    """How long an idle worker waits before looking for new jobs again"""
+    return getattr(settings, 'BACKUP_JOB_POLL_SECONDS', 2)
+
+def make_worker_id(prefix='worker'):
+    """Build a unique lease owner name for a worker thread"""
+    return f'{prefix}@{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def _claimable():
+    """Jobs waiting to run, or leased by a worker that stopped renewing its lease"""
+    return Q(status=JobStatus.QUEUED) | Q(status=JobStatus.LEASED, lease_expires_at__lt=timezone.now())
+
+def enqueue_transfer(backup_file, action='transfer_initiated', message=None, priority=TransferPriority.INTERACTIVE):
+    """
+    Queue a single BackupFile for transfer
+
+    Single transfers are started by hand, so they default to the interactive
+    priority and are claimed ahead of any queued bulk work.
+
+    Returns:
+        TransferJob or None: the new job, or None if the file already has an active job
+    """
+    try:
+        with transaction.atomic():
+            return TransferJob.objects.create(
+                backup_file=backup_file, user_id=backup_file.user_id, action=action, message=message,
+                priority=priority
+            )
+    except IntegrityError:
+        # The file already has a queued or running job
+        return None
+
+def enqueue_transfers(backup_files, action='transfer_initiated', message=None, batch_size=SCAN_CHUNK_SIZE,
+                      batch=None, status=None, order=TransferOrder.SCAN, priority=TransferPriority.SCHEDULED,
+                      deadline=None, run_at=None):
+    """
+    Queue many BackupFiles for transfer in bulk
+
+    Files that already have a queued or running job are skipped, so calling
+    this repeatedly for the same files never transfers them twice.
+
+    Args:
+        backup_files: iterable of BackupFile (a queryset iterator is fine)
+        action: TransferLog action written when each transfer starts
+        message: TransferLog message written when each transfer starts
+        batch_size: number of jobs inserted per query
+        batch: optional TransferBatch the new jobs report their results to
+        status: if given, skip files whose status changed since they were selected
+        order: TransferOrder deciding the position of the new jobs within their run
+        priority: TransferPriority class of the new jobs
+        deadline: optional datetime the transfers should be finished by
+        run_at: start of the schedule run queueing the files; all jobs of a
+            run share it, so `order` only reorders them among themselves.
+            Defaults to now.
+
+    Returns:
+        int: number of jobs queued
+    """
+    queued = 0
+    run_at = run_at or timezone.now()
+    for chunk in iter_chunks(backup_files, batch_size):
+        files = {backup_file.pk: backup_file for backup_file in chunk}
+        file_ids = list(files)
+        if status is not None:
+            # A worker may have transferred some of them since they were read
+            file_ids = list(
+                BackupFile.objects.filter(pk__in=file_ids, status=status).values_list('pk', flat=True)
+            )
+        active = set(
+            TransferJob.objects.filter(
+                backup_file_id__in=file_ids,
+                status__in=[JobStatus.QUEUED, JobStatus.LEASED]
+            ).values_list('backup_file_id', flat=True)
+        )
+        rates = get_transfer_rates({backup_file.destination_server_id for backup_file in chunk})
+        new_jobs = []
+        for file_id in file_ids:
+            if file_id in active:
+                continue
+            expected_seconds = estimate_seconds(files[file_id], rates)
+            new_jobs.append(TransferJob(
+                backup_file_id=file_id,
+                user_id=files[file_id].user_id,
+                batch=batch,
+                action=action,
+                message=message,
+                priority=priority,
+                deadline=deadline,
+                run_at=run_at,
+                expected_seconds=expected_seconds,
+                order_key=get_order_key(order, expected_seconds)
+            ))
+        # ignore_conflicts covers a concurrent enqueue winning the race
+        TransferJob.objects.bulk_create(new_jobs, ignore_conflicts=True)
+        queued += len(new_jobs)
+    return queued
+
+def _claim(model, owner, limit, exclude=None, ordering=('created_at',), include=None):
+    """
+    Atomically lease up to `limit` claimable rows of a queue model
+
+    On databases supporting it (PostgreSQL) candidate rows are locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers never wait on or
+    double-claim the same row. Elsewhere each candidate is claimed with a
+    conditional UPDATE and only the worker whose update matched a row wins.
+
+    Args:
+        model: TransferJob, ScheduleRun or TransferBatch
+        owner: lease owner name of the calling worker thread
+        limit: maximum number of rows to lease
+        exclude: optional Q of candidates to leave alone for now
+        ordering: order in which candidates are claimed
+        include: optional Q restricting the candidates
+
+    Returns:
+        list: primary keys of the rows now leased by `owner`
+    """
+    now = timezone.now()
+    lease = {
+        'status': JobStatus.LEASED,
+        'lease_owner': owner,
+        'lease_expires_at': now + timedelta(seconds=get_lease_seconds()),
+        'heartbeat_at': now,
+        'attempts': F('attempts') + 1,
+    }
+    candidates = model.objects.filter(_claimable()).order_by(*ordering)
+    if exclude is not None:
+        candidates = candidates.exclude(exclude)
+    if include is not None:
+        candidates = candidates.filter(include)
+
+    claimed_ids = []
+    if connection.features.has_select_for_update_skip_locked:
+        # Lock only the queue rows, not the rows joined in by `exclude`
+        lock_of = ('self',) if connection.features.has_select_for_update_of else ()
+        with transaction.atomic():
+            claimed_ids = list(
+                candidates.select_for_update(skip_locked=True, of=lock_of).values_list('pk', flat=True)[:limit]
+            )
+            model.objects.filter(pk__in=claimed_ids).update(**lease)
+    else:
+        # Over-fetch a little so losing a few races still fills the batch
+        for row_id in candidates.values_list('pk', flat=True)[:limit * 4]:
+            if model.objects.filter(_claimable(), pk=row_id).update(**lease):
+                claimed_ids.append(row_id)
+                if len(claimed_ids) >= limit:
+                    break
+    return claimed_ids
+
+def _running_transfers(exclude_owner=None):
+    """
+    Count the transfer sessions currently running against each server, cluster-wide
+
+    A worker thread runs one session at a time, possibly carrying a group of
+    small files, so sessions are counted as distinct lease owners.
+
+    Returns:
+        Counter: ServerConfig id -> number of live sessions using it
+    """
+    running = TransferJob.objects.filter(status=JobStatus.LEASED, lease_expires_at__gte=timezone.now())
+    if exclude_owner is not None:
+        running = running.exclude(lease_owner=exclude_owner)
+    counts = Counter()
+    for _, source_id, destination_id in running.values_list(
+        'lease_owner', 'backup_file__source_server_id', 'backup_file__destination_server_id'
+    ).distinct():
+        counts[source_id] += 1
+        counts[destination_id] += 1
+    return counts
+
+def _transfer_limit(server_config):
+    """Current transfer limit of a server, adaptive for destinations and throttled by its circuit breaker"""
+    limit = get_transfer_limit(server_config, destination=server_config.server_type != 'source')
+    allowance = get_breaker_allowance(server_config)
+    return limit if allowance is None else min(limit, allowance)
+
+def _saturated_servers():
+    """Ids of servers already running their maximum number of transfers, or with an open breaker"""
+    counts = _running_transfers()
+    servers = ServerConfig.objects.filter(
+        Q(pk__in=list(counts)) | Q(state__breaker_opened_at__isnull=False)
+    ).select_related('state')
+    return [server.pk for server in servers if counts[server.pk] >= _transfer_limit(server)]
+
+def _exceeds_transfer_limit(job, owner):
+    """True if running `job` would put its source or destination over its transfer limit"""
+    counts = _running_transfers(exclude_owner=owner)
+    backup_file = job.backup_file
+    return any(
+        counts[server.pk] >= _transfer_limit(server)
+        for server in (backup_file.source_server, backup_file.destination_server)
+    )
+
+def release_job(job, owner):
+    """
+    Give a leased queue row back to the queue untouched, e.g. when its server
+    has no free slot or its worker is stopping
+    """
+    return type(job).objects.filter(pk=job.pk, lease_owner=owner, status=JobStatus.LEASED).update(
+        status=JobStatus.QUEUED,
+        lease_owner=None,
+        lease_expires_at=None,
+        attempts=F('attempts') - 1
+    )
+
+def is_work_stealing():
+    """Whether a sharded node with nothing of its own to do takes jobs of other nodes' servers"""
+    return getattr(settings, 'BACKUP_SHARD_WORK_STEALING', True)
+
+def claim_jobs(owner, limit=1, shard=None):
+    """
+    Atomically lease up to `limit` transfer jobs for a worker
+
+    Jobs whose source or destination server is already running its transfer
+    limit (see concurrency.get_transfer_limit) are skipped, so queued work waits for a slot instead of
+    overloading the host. Two workers racing for a server's last slot both
+    re-check after claiming and hand the job back if the server is now over
+    its limit; the job is picked up again on a later poll. Servers with an
+    open circuit breaker get no transfers until it turns half-open, and then
+    a single one as the probe (see breaker.py).
+
+    Jobs are claimed by priority class first (interactive, scheduled, retry,
+    scrub), so a transfer started by hand overtakes everything queued behind
+    it. Within a class, jobs with a deadline go first, earliest deadline
+    first, then the others run by run (see run_at), each run in its own
+    order_key order (see ordering.get_order_key), oldest first on ties. Order
+    keys are only compared within a run, so one schedule's order option
+    never moves its jobs ahead of another schedule's.
+
+    With a shard, jobs reading from source servers this node owns on the
+    hash ring come first; only when there are none does the node steal other
+    jobs (BACKUP_SHARD_WORK_STEALING), so no node idles while work is queued.
+
+    When several users have queued jobs in the same class, users are served
+    in weighted fair order (see fairshare.fair_order), so one user's huge
+    backlog cannot starve the others; the order within a user is unchanged.
+    Jobs with a deadline are not reordered for fairness, and interactive jobs
+    skip both the shard and the fair order: whichever worker polls first
+    takes them.
+
+    Returns:
+        list: the TransferJobs now leased by `owner`
+    """
+    saturated = _saturated_servers()
+    exclude = None
+    if saturated:
+        exclude = Q(backup_file__source_server_id__in=saturated) | Q(backup_file__destination_server_id__in=saturated)
+
+    # Candidate filters to try in turn; an empty Q restricts nothing
+    scopes = [Q()]
+    if shard is not None:
+        source_ids = ServerConfig.objects.filter(server_type='source').values_list('pk', flat=True)
+        owned = Q(backup_file__source_server_id__in=shard.owned(source_ids, server_key))
+        scopes = [owned, Q()] if is_work_stealing() else [owned]
+
+    # Users with claimable jobs, per priority class
+    backlogged = {}
+    for priority, user_id in TransferJob.objects.filter(_claimable()).values_list('priority', 'user_id').distinct():
+        backlogged.setdefault(priority, []).append(user_id)
+
+    claimed_ids = []
+    for priority in sorted(backlogged):
+        if priority == TransferPriority.INTERACTIVE:
+            candidates = [Q(priority=priority)]
+        else:
+            users = [Q()]
+            if is_fair_share() and (len(backlogged[priority]) > 1 or get_max_user_transfers() is not None):
+                user_ids = fair_order(backlogged[priority])
+                # Deadlines are served earliest first across users, before the fair order
+                users = [Q(deadline__isnull=False, user_id__in=user_ids)] + [Q(user_id=user_id) for user_id in user_ids]
+            candidates = [Q(priority=priority) & user & scope for user in users for scope in scopes]
+        for include in candidates:
+            claimed_ids = _claim(TransferJob, owner, limit, exclude, ordering=JOB_ORDERING, include=include)
+            if claimed_ids:
+                break
+        if claimed_ids:
+            break
+    if not claimed_ids:
+        return []
+    jobs = []
+    for job in TransferJob.objects.filter(pk__in=claimed_ids, lease_owner=owner).select_related(
+        'backup_file__source_server__state', 'backup_file__destination_server__state'
+    ).order_by(*JOB_ORDERING):
+        if _exceeds_transfer_limit(job, owner):
+            release_job(job, owner)
+        else:
+            jobs.append(job)
+    charge(jobs)
+    return jobs
+
+def get_small_file_threshold():
+    """Files up to this many bytes are transferred in groups over one session"""
+    return getattr(settings, 'BACKUP_SMALL_FILE_THRESHOLD', 1048576)
+
+def get_small_file_batch_size():
+    """Maximum number of small files transferred over one session"""
+    return getattr(settings, 'BACKUP_SMALL_FILE_BATCH_SIZE', 100)
+
+def is_small_file(backup_file):
+    """True if a BackupFile can share a session with other small files"""
+    return not backup_file.is_folder and (backup_file.file_size or 0) <= get_small_file_threshold()
+
+def claim_small_files(owner, first_job):
+    """
+    Lease more small-file jobs that can share `first_job`'s session
+
+    Only files between the same source and destination qualify. They join the
+    session the worker opens anyway, so they do not count against the
+    servers' transfer limits.
+
+    The group keeps to what claim_jobs chose the first job under: only jobs
+    of the same priority class and the same user join, so a group never
+    pulls lower-class work ahead of its turn or runs another user's files
+    outside their fair share and transfer cap. Shards are assigned by source
+    server, which the whole group shares, so it stays in the first job's
+    shard too.
+
+    Returns:
+        list: the extra TransferJobs now leased by `owner`, possibly empty
+    """
+    limit = get_small_file_batch_size() - 1
+    if limit <= 0:
+        return []
+    backup_file = first_job.backup_file
+    claimed_ids = _claim(
+        TransferJob,
+        owner,
+        limit,
+        ordering=JOB_ORDERING,
+        include=Q(
+            priority=first_job.priority,
+            user_id=first_job.user_id,
+            backup_file__source_server_id=backup_file.source_server_id,
+            backup_file__destination_server_id=backup_file.destination_server_id,
+            backup_file__is_folder=False
+        ) & (
+            # Files of unknown size count as small, as in is_small_file
+            Q(backup_file__file_size__lte=get_small_file_threshold()) | Q(backup_file__file_size__isnull=True)
+        )
+    )
+    if not claimed_ids:
+        return []
+    jobs = list(
+        TransferJob.objects.filter(pk__in=claimed_ids, lease_owner=owner).select_related(
+            'backup_file__source_server', 'backup_file__destination_server'
+        ).order_by(*JOB_ORDERING)
+    )
+    charge(jobs)
+    return jobs
+
+def renew_lease(job, owner, **fields):
+    """
+    Extend the lease of a queue row and record a heartbeat
+
+    Args:
+        job: the leased TransferJob, ScheduleRun or TransferBatch
+        owner: lease owner name of the calling worker thread
+        **fields: other columns to update in the same query, e.g. progress counters
+
+    Raises:
+        LeaseLost: if the lease expired and the job was claimed by another worker
+    """
+    now = timezone.now()
+    renewed = type(job).objects.filter(pk=job.pk, status=JobStatus.LEASED, lease_owner=owner).update(
+        lease_expires_at=now + timedelta(seconds=get_lease_seconds()),
+        heartbeat_at=now,
+        **fields
+    )
+    if not renewed:
+        raise LeaseLost(f'Lease on {type(job).__name__} {job.pk} was lost')
+
+def renew_leases(jobs, owner):
+    """
+    Extend the leases of several TransferJobs run over one session
+
+    Raises:
+        LeaseLost: if any of them was claimed by another worker
+    """
+    now = timezone.now()
+    renewed = TransferJob.objects.filter(
+        pk__in=[job.pk for job in jobs],
+        status=JobStatus.LEASED,
+        lease_owner=owner
+    ).update(lease_expires_at=now + timedelta(seconds=get_lease_seconds()), heartbeat_at=now)
+    if renewed < len(jobs):
+        raise LeaseLost(f'Lease on {len(jobs) - renewed} of {len(jobs)} jobs was lost')
+
+def finish_job(job, owner, success, message):
+    """Mark a leased queue row as done or failed; ignored if the lease was lost meanwhile"""
+    return type(job).objects.filter(pk=job.pk, lease_owner=owner, status=JobStatus.LEASED).update(
+        status=JobStatus.DONE if success else JobStatus.FAILED,
+        result=message,
+        lease_expires_at=None,
+        finished_at=timezone.now()
+    )
+
+def enqueue_schedule_run(schedule, trigger='manual'):
+    """
+    Queue an immediate scan-and-transfer run of a schedule
+
+    The run is picked up by a transfer worker, so callers such as web views
+    return at once and can poll the run for progress.
+
+    Returns:
+        ScheduleRun: the new run, or the one already queued or running for the schedule
+
+    Raises:
+        IntegrityError: if the run cannot be inserted for another reason,
+            e.g. the schedule was deleted meanwhile
+    """
+    attempts = 3
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return ScheduleRun.objects.create(schedule=schedule, trigger=trigger)
+        except IntegrityError:
+            # Coalesce with the run that is already pending
+            active = ScheduleRun.objects.filter(
+                schedule=schedule,
+                status__in=[JobStatus.QUEUED, JobStatus.LEASED]
+            ).first()
+            if active is not None:
+                return active
+            # No active run: either it finished meanwhile (try again) or the
+            # insert failed for another reason, which retrying cannot fix
+            if attempt == attempts - 1 or not ScheduleConfig.objects.filter(pk=schedule.pk).exists():
+                raise
+
+def claim_schedule_runs(owner, limit=1, shard=None):
+    """
+    Atomically lease up to `limit` queued schedule runs for a worker
+
+    With a shard, only runs of schedules this node owns on the hash ring are
+    claimed, plus runs of schedules whose owning node's lease has expired.
+
+    Returns:
+        list: the ScheduleRuns now leased by `owner`
+    """
+    include = None
+    if shard is not None:
+        schedule_ids = ScheduleRun.objects.filter(_claimable()).values_list('schedule_id', flat=True).distinct()
+        include = Q(schedule_id__in=(
+            shard.owned(schedule_ids, schedule_key) + shard.orphaned(schedule_ids, schedule_key)
+        ))
+    claimed_ids = _claim(ScheduleRun, owner, limit, include=include)
+    if not claimed_ids:
+        return []
+    return list(
+        ScheduleRun.objects.filter(pk__in=claimed_ids, lease_owner=owner).select_related(
+            'schedule__source_server', 'schedule__destination_server', 'schedule__user'
+        )
+    )
+
+def execute_schedule_run(run, owner, stop_event=None):
+    """
+    Run the scan for a leased ScheduleRun, recording progress as it goes
+
+    The progress counters are written together with each lease renewal, once
+    per batch of scanned entries. If `stop_event` is set while the scan waits
+    for the queue to drain, the run is given back to the queue for another
+    worker to pick up.
+
+    Returns:
+        tuple: (success, result message)
+    """
+    # The scheduler module imports this one, so import it lazily
+    from .scheduler import run_schedule
+
+    schedule = run.schedule
+    ScheduleRun.objects.filter(pk=run.pk).update(started_at=timezone.now())
+    if not schedule.enabled:
+        result = f'Schedule {schedule.name} is disabled'
+        finish_job(run, owner, False, result)
+        return False, result
+
+    def progress(scanned, registered, queued):
+        renew_lease(run, owner, scanned_count=scanned, registered_count=registered, queued_count=queued)
+
+    logger.info(f"Starting {run.trigger} run {run.pk} of schedule {schedule.name}")
+    try:
+        new_files_count, queued_count = run_schedule(schedule, progress=progress, stop_event=stop_event)
+        success, result = True, f'Registered {new_files_count} new files, queued {queued_count} transfers'
+    except LeaseLost:
+        logger.warning(f"Abandoned run {run.pk} of schedule {schedule.name}: lease was lost")
+        return False, LEASE_LOST
+    except WorkerStopping as e:
+        logger.info(f"Returned run {run.pk} of schedule {schedule.name} to the queue: {str(e)}")
+        release_job(run, owner)
+        return False, str(e)
+    except Exception as e:
+        success, result = False, f'Error running schedule: {str(e)}'
+
+    logger.info(f"Run {run.pk} of schedule {schedule.name} finished: {result}")
+    finish_job(run, owner, success, result)
+    return success, result
+
+def submit_batch(user, source_status, action='transfer_initiated', message=None):
+    """
+    Submit a batch transfer of all of a user's files in `source_status`
+
+    Only the batch row is written here; a worker selects the files and queues
+    their jobs, so even a huge backlog is submitted instantly.
+
+    Returns:
+        TransferBatch: the new batch, or an identical one that is still waiting for a worker
+    """
+    waiting = TransferBatch.objects.filter(
+        user=user,
+        source_status=source_status,
+        action=action,
+        status=JobStatus.QUEUED
+    ).first()
+    if waiting is not None:
+        return waiting
+    return TransferBatch.objects.create(user=user, source_status=source_status, action=action, message=message)
+
+def claim_batches(owner, limit=1):
+    """
+    Atomically lease up to `limit` submitted batches for a worker
+
+    Returns:
+        list: the TransferBatches now leased by `owner`
+    """
+    claimed_ids = _claim(TransferBatch, owner, limit)
+    if not claimed_ids:
+        return []
+    return list(TransferBatch.objects.filter(pk__in=claimed_ids, lease_owner=owner).select_related('user'))
+
+def execute_batch(batch, owner, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Queue a TransferJob for every file selected by a leased batch
+
+    The queued count is written together with each lease renewal, once per
+    chunk. Files that already have an active job are left with it, so a batch
+    resumed by another worker does not queue anything twice.
+
+    Returns:
+        tuple: (success, result message)
+    """
+    TransferBatch.objects.filter(pk=batch.pk).update(started_at=timezone.now())
+    selected = BackupFile.objects.filter(user=batch.user, status=batch.source_status).order_by('pk')
+    queued_count = batch.total_count
+    try:
+        for chunk in iter_chunks(selected.iterator(chunk_size=chunk_size), chunk_size):
+            queued_count += enqueue_transfers(
+                chunk,
+                action=batch.action,
+                message=batch.message,
+                batch_size=chunk_size,
+                batch=batch,
+                status=batch.source_status,
+                priority=TransferPriority.RETRY if batch.action == 'transfer_retry' else TransferPriority.SCHEDULED
+            )
+            renew_lease(batch, owner, total_count=queued_count)
+        success, result = True, f'Queued {queued_count} transfers'
+    except LeaseLost:
+        logger.warning(f"Abandoned transfer batch {batch.pk}: lease was lost")
+        return False, LEASE_LOST
+    except Exception as e:
+        success, result = False, f'Error queueing transfers: {str(e)}'
+
+    logger.info(f"Transfer batch {batch.pk} submitted: {result}")
+    finish_job(batch, owner, success, result)
+    return success, result
+
+def get_batch_progress(batch):
+    """
+    Count a batch's jobs by state
+
+    Returns:
+        dict: total, queued, running, succeeded, failed, cancelled and completed job counts
+    """
+    counts = dict(
+        batch.jobs.values_list('status').annotate(count=Count('pk')).order_by()
+    )
+    succeeded = counts.get(JobStatus.DONE, 0)
+    failed = counts.get(JobStatus.FAILED, 0)
+    cancelled = counts.get(JobStatus.CANCELLED, 0)
+    return {
+        'total': sum(counts.values()),
+        'queued': counts.get(JobStatus.QUEUED, 0),
+        'running': counts.get(JobStatus.LEASED, 0),
+        'succeeded': succeeded,
+        'failed': failed,
+        'cancelled': cancelled,
+        'completed': succeeded + failed + cancelled,
+    }
+
+class _Heartbeat:
+    """Progress callback that renews leases while data flows and counts the bytes copied"""
+
+    def __init__(self, renew, progress=None):
+        self.renew = renew
+        self.progress = progress
+        self.copied = 0
+        self.lease_lost = False
+        self._last = time.monotonic()
+
+    def __call__(self, nbytes):
+        self.copied += nbytes
+        if self.progress is not None:
+            self.progress(nbytes)
+        if time.monotonic() - self._last >= get_heartbeat_seconds():
+            try:
+                self.renew()
+            except LeaseLost:
+                self.lease_lost = True
+                raise
+            self._last = time.monotonic()
+
+def acquire_files(jobs, owner):
+    """
+    Take exclusive ownership of the files of leased jobs before transferring them
+
+    A compare-and-set on BackupFile.transfer_owner: a file is won only if it
+    is not transferred yet and no other worker owns a transfer of it that is
+    still in progress. The same conditional UPDATE moves won files to in
+    progress (or retrying, counting the retry), so no other worker can see
+    a file that is owned but not yet marked as running. A job that was
+    taken over after its lease expired (attempts > 1) may take the file from
+    the presumed-dead worker; if that worker is alive after all, its result
+    is discarded by store_results.
+
+    The in-memory BackupFiles of won jobs get the new status and retry count.
+
+    Returns:
+        set: ids of the BackupFiles now owned by `owner`
+    """
+    now = timezone.now()
+    taken_over = [job.backup_file_id for job in jobs if job.attempts > 1]
+    retries = [job.backup_file_id for job in jobs if job.action == 'transfer_retry']
+    first_tries = [job.backup_file_id for job in jobs if job.action != 'transfer_retry']
+    won = 0
+    for file_ids, fields in (
+        (retries, {'status': TransferStatus.RETRYING, 'retry_count': F('retry_count') + 1}),
+        (first_tries, {'status': TransferStatus.IN_PROGRESS}),
+    ):
+        if not file_ids:
+            continue
+        won += BackupFile.objects.filter(pk__in=file_ids).exclude(
+            status=TransferStatus.SUCCESS
+        ).filter(
+            Q(transfer_owner__isnull=True)
+            | ~Q(status__in=[TransferStatus.IN_PROGRESS, TransferStatus.RETRYING])
+            | Q(pk__in=taken_over)
+        ).update(transfer_owner=owner, updated_at=now, **fields)
+    if not won:
+        return set()
+
+    owned = dict(
+        BackupFile.objects.filter(
+            pk__in=[job.backup_file_id for job in jobs],
+            transfer_owner=owner
+        ).values_list('pk', 'retry_count')
+    )
+    for job in jobs:
+        if job.backup_file_id in owned:
+            backup_file = job.backup_file
+            backup_file.status = TransferStatus.RETRYING if job.action == 'transfer_retry' else TransferStatus.IN_PROGRESS
+            backup_file.retry_count = owned[job.backup_file_id]
+            backup_file.updated_at = now
+    return set(owned)
+
+def _skip_result(backup_file_id):
+    """Result of a job whose file could not be acquired"""
+    if BackupFile.objects.filter(pk=backup_file_id, status=TransferStatus.SUCCESS).exists():
+        return ALREADY_TRANSFERRED
+    return ALREADY_RUNNING
+
+def store_results(files, owner, fields):
+    """
+    Write the final state of transferred files, releasing their ownership
+
+    Only files still owned by `owner` are written, so a worker whose transfer
+    was taken over cannot overwrite the newer attempt's state.
+
+    Returns:
+        set: ids of the BackupFiles that were written
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        owned = set(
+            BackupFile.objects.select_for_update().filter(
+                pk__in=[backup_file.pk for backup_file in files],
+                transfer_owner=owner
+            ).values_list('pk', flat=True)
+        )
+        written = [backup_file for backup_file in files if backup_file.pk in owned]
+        for backup_file in written:
+            backup_file.transfer_owner = None
+            backup_file.updated_at = now
+        BackupFile.objects.bulk_update(written, list(fields) + ['transfer_owner', 'updated_at'])
+    return owned
+
+def _start_log(job):
+    """Build the TransferLog recording the start of a job acquired by acquire_files"""
+    backup_file = job.backup_file
+    if job.action == 'transfer_retry':
+        message = f'{job.message or "Retry"} (attempt #{backup_file.retry_count})'
+    else:
+        message = job.message or 'Transfer initiated'
+    return TransferLog(backup_file=backup_file, action=job.action, message=message)
+
+def _finish_transfer(backup_file, success, result):
+    """Set a file's final status and build the TransferLog recording the result"""
+    if success:
+        backup_file.status = TransferStatus.SUCCESS
+        backup_file.next_attempt_at = None
+        log_action = 'transfer_complete'
+    else:
+        backup_file.error_message = result
+        # Failed with a backed-off retry time, or dead-lettered
+        if schedule_retry(backup_file, result):
+            log_action = 'transfer_failed'
+        else:
+            log_action = 'transfer_dead_lettered'
+    return TransferLog(backup_file=backup_file, action=log_action, message=result)
+
+def execute_job(job, owner, progress=None):
+    """
+    Run the transfer for a leased job and record the outcome
+
+    This is the single place individual BackupFiles are transferred: it
+    acquires the file and moves it to in progress or retrying in one step
+    (see acquire_files), logs the start, streams the transfer while renewing the lease,
+    then stores the final status and result log. A job whose file was already
+    transferred or is being copied by another worker finishes without doing
+    anything. A transfer cancelled meanwhile (see cancellation.py) stops
+    within one chunk; the cancellation already finished the job.
+
+    Args:
+        job: TransferJob leased by `owner`
+        owner: lease owner name of the calling worker thread
+        progress: optional callable receiving the byte count of each copied chunk
+    """
+    backup_file = job.backup_file
+    if not acquire_files([job], owner):
+        # Already transferred, or another worker is copying it right now
+        result = _skip_result(backup_file.pk)
+        logger.info(f"Skipped transfer of {backup_file.filename}: {result}")
+        finish_job(job, owner, True, result)
+        return True, result
+    _start_log(job).save()
+
+    with CancellationToken([backup_file.pk], owner) as token:
+        def renew():
+            # A cancelled job is no longer leased; stop at the next chunk instead
+            token.refresh()
+            if not token.stopped:
+                renew_lease(job, owner)
+
+        heartbeat = _Heartbeat(renew, progress)
+        try:
+            success, result = transfer_file(backup_file, progress=heartbeat, cancel=token)
+        except TransferCancelled:
+            logger.info(f"Stopped cancelled transfer of {backup_file.filename} after {heartbeat.copied} bytes")
+            return False, CANCELLED
+        except Exception as e:
+            success, result = False, f'Exception during transfer: {str(e)}'
+
+    if heartbeat.lease_lost:
+        # Another worker owns the job now; leave the outcome to it
+        logger.warning(f"Abandoned transfer of {backup_file.filename}: lease on job {job.pk} was lost")
+        return False, LEASE_LOST
+
+    # Let the destination's concurrency controller see the outcome
+    try:
+        record_transfer(backup_file.destination_server, heartbeat.copied, success, None if success else result)
+    except Exception as e:
+        logger.error(f"Error recording transfer throughput: {str(e)}")
+
+    result_log = _finish_transfer(backup_file, success, result)
+    if not store_results([backup_file], owner, ['status', 'error_message', 'next_attempt_at']):
+        token.refresh()
+        if backup_file.pk in token.cancelled:
+            # Cancelled after the last chunk was copied
+            logger.info(f"Discarded result of {backup_file.filename}: the transfer was cancelled")
+            return False, CANCELLED
+        logger.warning(f"Discarded result of {backup_file.filename}: another worker took the transfer over")
+        return False, LEASE_LOST
+    result_log.save()
+    finish_job(job, owner, success, result)
+    return success, result
+
+def execute_small_files(jobs, owner, progress=None):
+    """
+    Run several leased small-file jobs over one session, with bulk database writes
+
+    The same steps as execute_job, but the status changes, TransferLogs and
+    job results of the whole group are each written with one bulk query.
+
+    Returns:
+        dict: BackupFile id -> (success, result message)
+    """
+    owned = acquire_files(jobs, owner)
+    results = {}
+    for job in [job for job in jobs if job.backup_file_id not in owned]:
+        results[job.backup_file_id] = (True, _skip_result(job.backup_file_id))
+        finish_job(job, owner, True, results[job.backup_file_id][1])
+    jobs = [job for job in jobs if job.backup_file_id in owned]
+    if not jobs:
+        return results
+
+    files = [job.backup_file for job in jobs]
+    TransferLog.objects.bulk_create([_start_log(job) for job in jobs])
+
+    with CancellationToken([backup_file.pk for backup_file in files], owner) as token:
+        def renew():
+            # Cancelled jobs are no longer leased; the rest of the group carries on
+            token.refresh()
+            renew_leases([job for job in jobs if job.backup_file_id not in token.stopped], owner)
+
+        heartbeat = _Heartbeat(renew, progress)
+        try:
+            transferred = transfer_files(files, progress=heartbeat, cancel=token)
+        except Exception as e:
+            transferred = {backup_file.pk: (False, f'Exception during transfer: {str(e)}') for backup_file in files}
+        token.refresh()
+
+    if heartbeat.lease_lost:
+        logger.warning(f"Abandoned transfer of {len(jobs)} small files: a lease was lost")
+        results.update((backup_file.pk, (False, LEASE_LOST)) for backup_file in files)
+        return results
+
+    failures = [result for success, result in transferred.values() if not success]
+    try:
+        record_transfer(files[0].destination_server, heartbeat.copied, not failures, failures[0] if failures else None)
+    except Exception as e:
+        logger.error(f"Error recording transfer throughput: {str(e)}")
+
+    now = timezone.now()
+    result_logs = []
+    for job, backup_file in zip(jobs, files):
+        success, result = transferred.get(backup_file.pk, (False, 'Transfer failed: not attempted'))
+        results[backup_file.pk] = (success, result)
+        result_logs.append(_finish_transfer(backup_file, success, result))
+        job.status = JobStatus.DONE if success else JobStatus.FAILED
+        job.result = result
+        job.lease_expires_at = None
+        job.finished_at = now
+
+    with transaction.atomic():
+        leased = set(
+            TransferJob.objects.filter(
+                pk__in=[job.pk for job in jobs],
+                lease_owner=owner,
+                status=JobStatus.LEASED
+            ).values_list('pk', flat=True)
+        )
+        written = store_results(files, owner, ['status', 'error_message', 'next_attempt_at'])
+        TransferLog.objects.bulk_create([log for log in result_logs if log.backup_file_id in written])
+        TransferJob.objects.bulk_update(
+            [job for job in jobs if job.pk in leased and job.backup_file_id in written],
+            ['status', 'result', 'lease_expires_at', 'finished_at']
+        )
+    for backup_file in files:
+        if backup_file.pk in token.cancelled:
+            results[backup_file.pk] = (False, CANCELLED)
+        elif backup_file.pk not in written:
+            logger.warning(f"Discarded result of {backup_file.filename}: another worker took the transfer over")
+            results[backup_file.pk] = (False, LEASE_LOST)
+    return results
+
+class TransferWorker:
+    """
+    Pool of threads that claim and run jobs from the transfer queue
+
+    Each thread claims a job only when it is idle, so no job sits leased in a
+    local buffer while its visibility timeout runs out. Queued schedule runs
+    and batches are claimed before transfer jobs, since they feed the queue.
+    A claimed small file brings other small files between the same servers
+    along, and the whole group is copied over one session.
+
+    Unless BACKUP_SHARDING is off, the worker registers itself as a node of
+    the hash ring (see sharding.py) and heartbeats from a background thread;
+    it then runs only the schedules it owns and prefers transfers from the
+    source servers it owns. Nodes joining or leaving rebalance the ring.
+    """
+
+    METRICS = ('jobs_claimed', 'jobs_succeeded', 'jobs_failed', 'jobs_skipped', 'jobs_abandoned', 'jobs_cancelled',
+               'bytes_transferred', 'schedule_runs', 'batches_submitted')
+
+    def __init__(self, threads=None, name='worker'):
+        self.threads = threads or getattr(settings, 'BACKUP_WORKER_THREADS', 10)
+        self.name = name
+        self.stop_event = threading.Event()
+        self.started_at = None
+        self._threads = []
+        self._metrics = dict.fromkeys(self.METRICS, 0)
+        self._busy = 0
+        self._metrics_lock = threading.Lock()
+        self.shard = Shard(make_worker_id(name)) if is_sharded() else None
+
+    def _count(self, metric, amount=1):
+        with self._metrics_lock:
+            self._metrics[metric] += amount
+
+    def metrics(self):
+        """
+        Snapshot of the worker's counters since it started
+
+        Returns:
+            dict: the METRICS counters plus busy/total threads, uptime in seconds,
+            open SSH sessions per server as {server id: (in use, limit)} and
+            adaptive concurrency per destination as {server id: level}
+        """
+        with self._metrics_lock:
+            snapshot = dict(self._metrics)
+            snapshot['busy_threads'] = self._busy
+        snapshot['threads'] = sum(1 for thread in self._threads if thread.is_alive())
+        snapshot['uptime'] = round(time.monotonic() - self.started_at) if self.started_at else 0
+        snapshot['connections'] = connection_slots.in_use()
+        if self.shard is not None:
+            snapshot['nodes'] = len(self.shard.ring)
+        try:
+            snapshot['concurrency'] = current_levels()
+        except Exception as e:
+            logger.error(f"Error reading concurrency levels: {str(e)}")
+        return snapshot
+
+    def is_alive(self):
+        """True while any worker thread is still running"""
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        """Start the worker threads in the background"""
+        self.started_at = time.monotonic()
+        if self.shard is not None:
+            try:
+                self.shard.refresh()
+            except Exception as e:
+                logger.error(f"Error registering worker node: {str(e)}")
+            threading.Thread(target=self._node_loop, name=f'{self.name}-node', daemon=True).start()
+        for index in range(self.threads):
+            thread = threading.Thread(
+                target=self._work_loop,
+                name=f'{self.name}-{index}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.threads} transfer worker threads")
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Ask the threads to stop after their current job and wait for them
+
+        Args:
+            timeout: maximum seconds to wait for all threads together, None waits forever
+
+        Returns:
+            bool: True if every thread finished in time
+        """
+        self.stop_event.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not self.is_alive()
+
+    def _node_loop(self):
+        """Keep this node in the ring while the worker runs, and leave it on stop"""
+        try:
+            while not self.stop_event.wait(get_node_heartbeat_seconds()):
+                close_old_connections()
+                try:
+                    self.shard.refresh()
+                    purge_nodes()
+                except Exception as e:
+                    logger.error(f"Error sending worker node heartbeat: {str(e)}")
+            # Running transfers are still finishing, but new work can go to other nodes
+            deregister_node(self.shard.node)
+        except Exception as e:
+            logger.error(f"Error leaving the worker ring: {str(e)}")
+        finally:
+            connection.close()
+
+    def _work_loop(self):
+        owner = make_worker_id(self.name)
+        try:
+            while not self.stop_event.is_set():
+                # Drop connections that broke or outlived CONN_MAX_AGE between jobs
+                close_old_connections()
+                try:
+                    runs = claim_schedule_runs(owner, shard=self.shard)
+                    batches = [] if runs else claim_batches(owner)
+                    jobs = [] if runs or batches else claim_jobs(owner, shard=self.shard)
+                    if jobs and is_small_file(jobs[0].backup_file):
+                        jobs += claim_small_files(owner, jobs[0])
+                except Exception as e:
+                    logger.error(f"Error claiming work: {str(e)}")
+                    runs, batches, jobs = [], [], []
+                if not runs and not batches and not jobs:
+                    self.stop_event.wait(get_poll_seconds())
+                    continue
+                for run in runs:
+                    self._run_schedule(run, owner)
+                for batch in batches:
+                    self._run_batch(batch, owner)
+                self._count('jobs_claimed', len(jobs))
+                if len(jobs) > 1:
+                    self._run_small_files(jobs, owner)
+                elif jobs:
+                    self._run(jobs[0], owner)
+        finally:
+            # Each worker thread has its own database connection; release it
+            connection.close()
+
+    def _run(self, job, owner):
+        """Execute one claimed job, updating the worker metrics"""
+        with self._metrics_lock:
+            self._busy += 1
+        try:
+            success, result = execute_job(
+                job, owner, progress=lambda nbytes: self._count('bytes_transferred', nbytes)
+            )
+            if result == LEASE_LOST:
+                self._count('jobs_abandoned')
+            elif result == CANCELLED:
+                self._count('jobs_cancelled')
+            elif result in SKIPPED:
+                self._count('jobs_skipped')
+            else:
+                self._count('jobs_succeeded' if success else 'jobs_failed')
+        except Exception as e:
+            self._count('jobs_failed')
+            logger.error(f"Error running transfer job {job.pk}: {str(e)}")
+        finally:
+            with self._metrics_lock:
+                self._busy -= 1
+
+    def _run_small_files(self, jobs, owner):
+        """Execute a group of claimed small-file jobs over one session"""
+        with self._metrics_lock:
+            self._busy += 1
+        try:
+            results = execute_small_files(
+                jobs, owner, progress=lambda nbytes: self._count('bytes_transferred', nbytes)
+            )
+            for success, result in results.values():
+                if result == LEASE_LOST:
+                    self._count('jobs_abandoned')
+                elif result == CANCELLED:
+                    self._count('jobs_cancelled')
+                elif result in SKIPPED:
+                    self._count('jobs_skipped')
+                else:
+                    self._count('jobs_succeeded' if success else 'jobs_failed')
+        except Exception as e:
+            self._count('jobs_failed', len(jobs))
+            logger.error(f"Error running {len(jobs)} small-file transfer jobs: {str(e)}")
+        finally:
+            with self._metrics_lock:
+                self._busy -= 1
+
+    def _run_schedule(self, run, owner):
+        """Execute one claimed schedule run"""
+        with self._metrics_lock:
+            self._busy += 1
+        try:
+            execute_schedule_run(run, owner, stop_event=self.stop_event)
+            self._count('schedule_runs')
+        except Exception as e:
+            logger.error(f"Error running schedule run {run.pk}: {str(e)}")
+        finally:
+            with self._metrics_lock:
+                self._busy -= 1
+
+    def _run_batch(self, batch, owner):
+        """Queue the jobs of one claimed transfer batch"""
+        try:
+            execute_batch(batch, owner)
+            self._count('batches_submitted')
+        except Exception as e:
+            logger.error(f"Error running transfer batch {batch.pk}: {str(e)}")
@@ -0,0 +1,149 @@
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import LeaderLease
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+def get_lease_seconds():
+    """How long leadership lasts without renewal; a dead leader is replaced after this"""
+    return getattr(settings, 'BACKUP_LEADER_LEASE_SECONDS', 30)
+
+def get_heartbeat_seconds():
+    """Interval between leadership renewals, and between takeover attempts of followers"""
+    return getattr(settings, 'BACKUP_LEADER_HEARTBEAT_SECONDS', 10)
+
+def hold_leadership(name, holder):
+    """
+    Acquire or renew the lease of a role
+
+    A conditional UPDATE on the role's LeaderLease row: it succeeds when
+    `holder` already holds the lease, or when nobody does or the lease expired.
+
+    Returns:
+        bool: True if `holder` is the leader until the new expiry
+    """
+    try:
+        with transaction.atomic():
+            LeaderLease.objects.get_or_create(name=name)
+    except IntegrityError:
+        # Another process created the row at the same time
+        pass
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=get_lease_seconds())
+    if LeaderLease.objects.filter(name=name, holder=holder).update(heartbeat_at=now, expires_at=expires_at):
+        return True
+    return bool(LeaderLease.objects.filter(name=name).filter(
+        Q(holder__isnull=True) | Q(expires_at__lt=now)
+    ).update(holder=holder, acquired_at=now, heartbeat_at=now, expires_at=expires_at))
+
+def release_leadership(name, holder):
+    """Give up a role so a follower takes over without waiting for the lease to expire"""
+    return LeaderLease.objects.filter(name=name, holder=holder).update(holder=None, expires_at=None)
+
+def get_leader(name):
+    """
+    Current holder of a role
+
+    Returns:
+        LeaderLease: the role's lease row, or None if no live process holds it
+    """
+    return LeaderLease.objects.filter(name=name, holder__isnull=False, expires_at__gte=timezone.now()).first()
+
+class LeaderElection:
+    """
+    Run a role in exactly one process of the cluster
+
+    Every candidate process runs a thread that tries to hold the role's
+    lease every BACKUP_LEADER_HEARTBEAT_SECONDS. The winner runs
+    `on_elected`; when it fails to renew (lost the lease, database
+    unreachable) it runs `on_deposed` right away. If `on_elected` raises,
+    the winner runs `on_deposed` and releases the lease, so the role is
+    retried at the next heartbeat instead of being held by a process that
+    does not run it. A follower takes over once the leader's lease expires,
+    e.g. because its process died.
+    """
+
+    def __init__(self, name, holder, on_elected, on_deposed):
+        self.name = name
+        self.holder = holder
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.is_leader = False
+        self.stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start campaigning in the background"""
+        self._thread = threading.Thread(target=self._run, name=f'leader-{self.name}', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop campaigning, stepping down if this process is the leader"""
+        self.stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def confirm(self):
+        """Check with the database that this process still holds the role"""
+        return self.is_leader and LeaderLease.objects.filter(
+            name=self.name, holder=self.holder, expires_at__gte=timezone.now()
+        ).exists()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                try:
+                    leader = hold_leadership(self.name, self.holder)
+                except Exception as e:
+                    logger.error(f"Error holding {self.name} leadership: {str(e)}")
+                    leader = False
+                if leader and not self.is_leader:
+                    logger.info(f"{self.holder} elected {self.name} leader")
+                    self.is_leader = True
+                    if not self._call(self.on_elected):
+                        # Holding the lease without running the role would stop
+                        # it cluster-wide; step down so any candidate can retry
+                        self._step_down()
+                elif not leader and self.is_leader:
+                    logger.warning(f"{self.holder} lost {self.name} leadership")
+                    self.is_leader = False
+                    self._call(self.on_deposed)
+                self.stop_event.wait(get_heartbeat_seconds())
+            if self.is_leader:
+                self.is_leader = False
+                self._call(self.on_deposed)
+                release_leadership(self.name, self.holder)
+        finally:
+            connection.close()
+
+    def _step_down(self):
+        """Give up the role after `on_elected` failed, undoing whatever it started"""
+        logger.warning(f"{self.holder} stepping down as {self.name} leader")
+        self.is_leader = False
+        self._call(self.on_deposed)
+        try:
+            release_leadership(self.name, self.holder)
+        except Exception as e:
+            logger.error(f"Error releasing {self.name} leadership: {str(e)}")
+
+    def _call(self, callback):
+        """
+        Run a leadership callback, logging its errors
+
+        Returns:
+            bool: True if the callback succeeded
+        """
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Error switching {self.name} leadership: {str(e)}")
+            return False
+        return True
@@ -0,0 +1,114 @@
+import logging
+import threading
+import paramiko
+from django.conf import settings
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+class ConnectionLimitReached(Exception):
+    """Raised when no connection slot for a server frees up in time"""
+
+def get_max_connections(server_config):
+    """Maximum simultaneous SSH sessions this process opens to a server"""
+    return server_config.max_connections or getattr(settings, 'BACKUP_MAX_CONNECTIONS_PER_SERVER', 12)
+
+def get_max_transfers(server_config):
+    """Maximum transfers running against a server across all workers"""
+    return server_config.max_transfers or getattr(settings, 'BACKUP_MAX_TRANSFERS_PER_SERVER', 10)
+
+def get_connection_wait_seconds():
+    """How long a connection attempt waits for a free slot before giving up"""
+    return getattr(settings, 'BACKUP_CONNECTION_WAIT_SECONDS', 300)
+
+class ConnectionLimiter:
+    """
+    Process-wide cap on the SSH sessions open to each ServerConfig
+
+    Every scan, listing and transfer connects through sftp_connect, which takes
+    a slot here first; when a server is at its limit the caller waits for a
+    session to close instead of opening another one.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._in_use = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, server_config):
+        limit = get_max_connections(server_config)
+        with self._lock:
+            current = self._slots.get(server_config.pk)
+            if current is None or current[0] != limit:
+                # The limit was edited; sessions holding the old semaphore release into it
+                current = (limit, threading.BoundedSemaphore(limit))
+                self._slots[server_config.pk] = current
+            return current[1]
+
+    def acquire(self, server_config, timeout=None):
+        """
+        Wait for a connection slot on a server
+
+        Args:
+            server_config: ServerConfig about to be connected to
+            timeout: seconds to wait, defaults to BACKUP_CONNECTION_WAIT_SECONDS
+
+        Returns:
+            callable: releases the slot; safe to call more than once
+
+        Raises:
+            ConnectionLimitReached: if no slot became free in time
+        """
+        if server_config.pk is None:
+            # Unsaved configurations (e.g. a connection test) are not limited
+            return lambda: None
+        semaphore = self._semaphore(server_config)
+        if timeout is None:
+            timeout = get_connection_wait_seconds()
+        if not semaphore.acquire(timeout=timeout):
+            raise ConnectionLimitReached(
+                f'No connection slot free on {server_config.host} after {timeout}s '
+                f'(limit {get_max_connections(server_config)})'
+            )
+
+        server_id = server_config.pk
+        with self._lock:
+            self._in_use[server_id] = self._in_use.get(server_id, 0) + 1
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                semaphore.release()
+                with self._lock:
+                    self._in_use[server_id] -= 1
+
+        return release
+
+    def in_use(self):
+        """
+        Open sessions per server in this process
+
+        Returns:
+            dict: ServerConfig id -> (sessions in use, limit)
+        """
+        with self._lock:
+            return {
+                server_id: (self._in_use.get(server_id, 0), limit)
+                for server_id, (limit, _) in self._slots.items()
+            }
+
+connection_slots = ConnectionLimiter()
+
+class SlotSSHClient(paramiko.SSHClient):
+    """SSHClient that gives its connection slot back when it is closed"""
+
+    def __init__(self, release):
+        super().__init__()
+        self._release = release
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release()
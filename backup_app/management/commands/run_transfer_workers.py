@@ -0,0 +1,192 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before restarting a worker process that died unexpectedly
+RESTART_DELAY = 5
+
+def _configure_logging(verbosity):
+    """Send log records to stderr unless the project configured logging itself"""
+    if logging.getLogger().handlers:
+        return
+    level = {0: logging.WARNING, 1: logging.INFO}.get(verbosity, logging.DEBUG)
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s %(processName)s[%(process)d] %(levelname)s %(name)s: %(message)s'
+    )
+
+def run_worker_process(index, threads, drain_timeout, metrics_interval, verbosity):
+    """
+    Entry point of one worker process
+
+    Runs a TransferWorker with `threads` threads until SIGTERM/SIGINT, then
+    drains: threads finish their current transfer and stop claiming jobs. A
+    second signal, or `drain_timeout` elapsing, exits immediately; jobs still
+    running are handed to other workers once their lease expires.
+
+    Args:
+        index: position of the process in the pool, used in worker names
+        threads: number of worker threads in this process
+        drain_timeout: seconds to wait for running transfers on shutdown, None waits forever
+        metrics_interval: seconds between metrics log lines
+        verbosity: management command verbosity, used for log levels
+    """
+    if not apps.ready:
+        # Started with the spawn method: this interpreter has not loaded Django yet
+        django.setup()
+    from backup_app.jobs import TransferWorker
+
+    _configure_logging(verbosity)
+    # Never share a database socket inherited from the parent process
+    connections.close_all()
+
+    worker = TransferWorker(threads=threads, name=f'worker-{index}')
+    drain_started = None
+
+    def handle_signal(signum, frame):
+        nonlocal drain_started
+        if drain_started is not None:
+            logger.warning(f"Received {signal.Signals(signum).name} while draining, exiting now")
+            raise SystemExit(1)
+        # Only set flags here: the interrupted main thread may hold a lock the
+        # worker metrics need, so busy threads are reported from the main loop
+        drain_started = time.monotonic()
+        logger.info(f"Received {signal.Signals(signum).name}, draining running transfers")
+        worker.stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    if multiprocessing.parent_process() is None:
+        signal.signal(signal.SIGINT, handle_signal)
+    else:
+        # Ctrl-C reaches the whole process group; the supervisor forwards it as SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    worker.start()
+    next_report = time.monotonic() + metrics_interval
+    drain_reported = False
+    try:
+        while worker.is_alive():
+            time.sleep(1)
+            now = time.monotonic()
+            if drain_started is not None and not drain_reported:
+                logger.info(f"Draining {worker.metrics()['busy_threads']} running transfers")
+                drain_reported = True
+            if now >= next_report:
+                logger.info(f"Worker metrics: {worker.metrics()}")
+                next_report = now + metrics_interval
+            if drain_started is not None and drain_timeout is not None and now - drain_started >= drain_timeout:
+                logger.warning(f"Drain timeout of {drain_timeout}s reached with {worker.metrics()['busy_threads']} transfers running, exiting")
+                break
+    finally:
+        logger.info(f"Worker stopped, final metrics: {worker.metrics()}")
+        connections.close_all()
+
+class Command(BaseCommand):
+    help = 'Run transfer workers in dedicated processes, outside the web server'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of worker processes (default: number of CPUs)'
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=getattr(settings, 'BACKUP_WORKER_THREADS', 10),
+            help='Worker threads per process (default: BACKUP_WORKER_THREADS)'
+        )
+        parser.add_argument(
+            '--drain-timeout',
+            type=float,
+            default=None,
+            help='Seconds to wait for running transfers on shutdown (default: wait until they finish)'
+        )
+        parser.add_argument(
+            '--metrics-interval',
+            type=float,
+            default=60,
+            help='Seconds between worker metrics log lines'
+        )
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        threads = options['threads']
+        if processes < 1 or threads < 1:
+            raise CommandError('--processes and --threads must be at least 1')
+        worker_args = (threads, options['drain_timeout'], options['metrics_interval'], options['verbosity'])
+
+        if getattr(settings, 'BACKUP_RUN_INPROCESS_WORKERS', True):
+            self.stderr.write(self.style.WARNING(
+                'BACKUP_RUN_INPROCESS_WORKERS is enabled, so the web process also runs transfers; '
+                'set it to False when using dedicated workers'
+            ))
+
+        if processes == 1:
+            self.stdout.write(f'Starting 1 worker process with {threads} threads')
+            run_worker_process(0, *worker_args)
+            return
+
+        self._supervise(processes, worker_args)
+
+    def _supervise(self, processes, worker_args):
+        """Start the worker processes, restart any that crash, and drain them on shutdown"""
+        context = multiprocessing.get_context()
+        stopping = False
+
+        def start_process(index):
+            process = context.Process(
+                target=run_worker_process,
+                args=(index,) + worker_args,
+                name=f'transfer-worker-{index}'
+            )
+            process.start()
+            return process
+
+        def handle_signal(signum, frame):
+            nonlocal stopping
+            if stopping:
+                # Second signal: stop waiting for the drain
+                for process in pool.values():
+                    if process.is_alive():
+                        process.kill()
+                return
+            stopping = True
+            self.stdout.write(f'Received {signal.Signals(signum).name}, draining worker processes')
+            for process in pool.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+        # Children open their own connections; close ours so none are inherited
+        connections.close_all()
+
+        pool = {index: start_process(index) for index in range(processes)}
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+        self.stdout.write(f'Started {processes} worker processes with {worker_args[0]} threads each')
+
+        while any(process.is_alive() for process in pool.values()):
+            time.sleep(1)
+            if stopping:
+                continue
+            for index, process in list(pool.items()):
+                if not process.is_alive():
+                    self.stderr.write(
+                        f'Worker process {process.name} exited with code {process.exitcode}, restarting in {RESTART_DELAY}s'
+                    )
+                    time.sleep(RESTART_DELAY)
+                    if not stopping:
+                        pool[index] = start_process(index)
+
+        self.stdout.write(self.style.SUCCESS('All worker processes stopped'))
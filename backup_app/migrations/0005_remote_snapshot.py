@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0004_backupfile_files_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnapshotDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=512)),
+                ('mtime', models.BigIntegerField(blank=True, null=True)),
+                ('complete', models.BooleanField(default=False)),
+                ('scanned_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot_directories', to='backup_app.serverconfig')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SnapshotEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=256)),
+                ('size', models.BigIntegerField(default=0)),
+                ('mtime', models.BigIntegerField(blank=True, null=True)),
+                ('atime', models.BigIntegerField(blank=True, null=True)),
+                ('mode', models.IntegerField()),
+                ('directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='backup_app.snapshotdirectory')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='snapshotdirectory',
+            constraint=models.UniqueConstraint(fields=('server', 'path'), name='unique_snapshot_directory'),
+        ),
+        migrations.AddConstraint(
+            model_name='snapshotentry',
+            constraint=models.UniqueConstraint(fields=('directory', 'filename'), name='unique_snapshot_entry'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0005_remote_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupfile',
+            name='normalize_line_endings',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='normalize_line_endings',
+            field=models.BooleanField(default=False),
+        ),
+    ]
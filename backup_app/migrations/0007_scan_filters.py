@@ -0,0 +1,48 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0006_normalize_line_endings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupfile',
+            name='scan_filter',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='exclude_patterns',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='include_patterns',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='max_age_hours',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='max_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='min_age_hours',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='min_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:26
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0007_scan_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('action', models.CharField(default='transfer_initiated', max_length=64)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=128, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('backup_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='backup_app.backupfile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'lease_expires_at'], name='backup_app__status_ac6061_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'leased'])), fields=('backup_file',), name='unique_active_transfer_job')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0008_transfer_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduleRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger', models.CharField(default='manual', max_length=20)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('lease_owner', models.CharField(blank=True, max_length=128, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('scanned_count', models.IntegerField(default=0)),
+                ('registered_count', models.IntegerField(default=0)),
+                ('queued_count', models.IntegerField(default=0)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='backup_app.scheduleconfig')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'lease_expires_at'], name='backup_app__status_56260c_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'leased'])), fields=('schedule',), name='unique_active_schedule_run')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0009_schedule_run'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_status', models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('success', 'Success'), ('failed', 'Failed'), ('retrying', 'Retrying')], max_length=20)),
+                ('action', models.CharField(default='transfer_initiated', max_length=64)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('lease_owner', models.CharField(blank=True, max_length=128, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('total_count', models.IntegerField(default=0)),
+                ('result', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transfer_batches', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='backup_app.transferbatch'),
+        ),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['batch', 'finished_at'], name='backup_app__batch_i_6ac777_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transferbatch',
+            index=models.Index(fields=['status', 'lease_expires_at'], name='backup_app__status_61143c_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0010_transfer_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serverconfig',
+            name='max_connections',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='serverconfig',
+            name='max_transfers',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
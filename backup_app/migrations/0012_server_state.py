@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0011_server_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServerState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('concurrency', models.PositiveIntegerField(default=1)),
+                ('last_throughput', models.FloatField(blank=True, null=True)),
+                ('last_step', models.IntegerField(default=0)),
+                ('window_started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('window_bytes', models.BigIntegerField(default=0)),
+                ('window_transfers', models.IntegerField(default=0)),
+                ('window_errors', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('server', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='state', to='backup_app.serverconfig')),
+            ],
+        ),
+    ]
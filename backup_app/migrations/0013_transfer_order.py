@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0012_server_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='transfer_order',
+            field=models.CharField(choices=[('scan', 'Scan order'), ('largest_first', 'Largest first (shortest total run time)'), ('smallest_first', 'Smallest first (quick wins)')], default='scan', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='expected_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='order_key',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['status', 'order_key', 'created_at'], name='backup_app__status_c3df62_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0013_transfer_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupfile',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='backupfile',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('success', 'Success'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('dead_letter', 'Dead Letter')], default='pending', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transferbatch',
+            name='source_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('success', 'Success'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('dead_letter', 'Dead Letter')], max_length=20),
+        ),
+    ]
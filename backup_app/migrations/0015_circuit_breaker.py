@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0014_retry_backoff'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serverstate',
+            name='breaker_opened_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='serverstate',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='serverstate',
+            name='probe_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
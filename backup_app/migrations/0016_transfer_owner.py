@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0015_circuit_breaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backupfile',
+            name='transfer_owner',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0016_transfer_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
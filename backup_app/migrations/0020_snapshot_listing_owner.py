@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0019_worker_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshotdirectory',
+            name='listing_owner',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='snapshotdirectory',
+            name='listing_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:53
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_job_users(apps, schema_editor):
+    """Copy the file owner onto existing unfinished jobs"""
+    TransferJob = apps.get_model('backup_app', 'TransferJob')
+    BackupFile = apps.get_model('backup_app', 'BackupFile')
+    TransferJob.objects.filter(status__in=['queued', 'leased']).update(
+        user=Subquery(BackupFile.objects.filter(pk=OuterRef('backup_file_id')).values('user_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0020_snapshot_listing_owner'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FairShare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.FloatField(default=1.0, validators=[django.core.validators.MinValueValidator(0.01)])),
+                ('max_transfers', models.PositiveIntegerField(blank=True, null=True)),
+                ('virtual_time', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transfer_jobs', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['status', 'user'], name='backup_app__status_a6773d_idx'),
+        ),
+        migrations.AddField(
+            model_name='fairshare',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fair_share', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(set_job_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.1 on 2026-10-19 05:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_retry_priority(apps, schema_editor):
+    """Queued retries go behind the other queued work"""
+    TransferJob = apps.get_model('backup_app', 'TransferJob')
+    TransferJob.objects.filter(status__in=['queued', 'leased'], action='transfer_retry').update(priority=2)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0021_fair_share'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transferjob',
+            name='backup_app__status_c3df62_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='transferjob',
+            name='backup_app__status_a6773d_idx',
+        ),
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='deadline_minutes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='priority',
+            field=models.IntegerField(choices=[(0, 'Interactive'), (1, 'Scheduled'), (2, 'Retry'), (3, 'Scrub')], default=1),
+        ),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['status', 'priority', 'deadline', 'order_key', 'created_at'], name='backup_app__status_fedb83_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['status', 'priority', 'user'], name='backup_app__status_02f9f0_idx'),
+        ),
+        migrations.RunPython(set_retry_priority, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.1 on 2026-10-19 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0022_transfer_priority'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backupfile',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('success', 'Success'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('dead_letter', 'Dead Letter'), ('cancelled', 'Cancelled')], default='pending', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='schedulerun',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transferbatch',
+            name='source_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('success', 'Success'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('dead_letter', 'Dead Letter'), ('cancelled', 'Cancelled')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transferbatch',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transferjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-19 06:10
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_run_at(apps, schema_editor):
+    """Existing jobs keep their queue position: each counts as its own run"""
+    TransferJob = apps.get_model('backup_app', 'TransferJob')
+    TransferJob.objects.update(run_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0023_cancelled_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transferjob',
+            name='backup_app__status_fedb83_idx',
+        ),
+        migrations.AddField(
+            model_name='transferjob',
+            name='run_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(set_run_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='transferjob',
+            index=models.Index(fields=['status', 'priority', 'deadline', 'run_at', 'order_key', 'created_at'], name='backup_app__status_10ac4c_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backup_app', '0024_job_run_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshotdirectory',
+            name='relist_token',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
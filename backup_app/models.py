@@ -1,6 +1,7 @@
 import os
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.validators import MinValueValidator
 from django.utils import timezone
 
 class TransferStatus(models.TextChoices):
@@ -9,6 +10,27 @@ class TransferStatus(models.TextChoices):
     SUCCESS = 'success', 'Success'
     FAILED = 'failed', 'Failed'
     RETRYING = 'retrying', 'Retrying'
+    DEAD_LETTER = 'dead_letter', 'Dead Letter'  # Gave up: permanent error or out of retries
+    CANCELLED = 'cancelled', 'Cancelled'  # Stopped by the user; never retried automatically
+
+class TransferOrder(models.TextChoices):
+    SCAN = 'scan', 'Scan order'
+    LARGEST_FIRST = 'largest_first', 'Largest first (shortest total run time)'
+    SMALLEST_FIRST = 'smallest_first', 'Smallest first (quick wins)'
+
+class TransferPriority(models.IntegerChoices):
+    # Lower values are claimed first
+    INTERACTIVE = 0, 'Interactive'  # Started by hand from the web interface
+    SCHEDULED = 1, 'Scheduled'  # Schedule runs and bulk transfers
+    RETRY = 2, 'Retry'  # Automatic and bulk retries of failed transfers
+    SCRUB = 3, 'Scrub'  # Background maintenance, only when nothing else is queued
+
+class JobStatus(models.TextChoices):
+    QUEUED = 'queued', 'Queued'
+    LEASED = 'leased', 'Leased'
+    DONE = 'done', 'Done'
+    FAILED = 'failed', 'Failed'
+    CANCELLED = 'cancelled', 'Cancelled'
 
 class ServerConfig(models.Model):
     name = models.CharField(max_length=64)
@@ -19,12 +41,32 @@ class ServerConfig(models.Model):
     private_key = models.TextField(blank=True, null=True)
     remote_path = models.CharField(max_length=256)
     server_type = models.CharField(max_length=20)  # 'source' or 'destination'
+    max_connections = models.PositiveIntegerField(null=True, blank=True)  # SSH sessions per worker process; blank uses the default
+    max_transfers = models.PositiveIntegerField(null=True, blank=True)  # Concurrent transfers across all workers; blank uses the default
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='server_configs')
     created_at = models.DateTimeField(default=timezone.now)
     
     def __str__(self):
         return f'{self.name} ({self.server_type})'
 
+class ServerState(models.Model):
+    """Runtime state the transfer workers share per server, e.g. its adaptive concurrency"""
+    server = models.OneToOneField(ServerConfig, on_delete=models.CASCADE, related_name='state')
+    concurrency = models.PositiveIntegerField(default=1)  # Current adaptive limit on concurrent transfers
+    last_throughput = models.FloatField(null=True, blank=True)  # Bytes per second over the previous window
+    last_step = models.IntegerField(default=0)  # Last change of the concurrency, to tell which way to go next
+    window_started_at = models.DateTimeField(default=timezone.now)
+    window_bytes = models.BigIntegerField(default=0)  # Bytes transferred in the current window
+    window_transfers = models.IntegerField(default=0)  # Transfers finished in the current window
+    window_errors = models.IntegerField(default=0)  # Timeouts and connection errors in the current window
+    consecutive_failures = models.IntegerField(default=0)  # Failed connection attempts since the last successful one
+    breaker_opened_at = models.DateTimeField(null=True, blank=True)  # Set while the circuit breaker is open
+    probe_started_at = models.DateTimeField(null=True, blank=True)  # Connection attempt testing a half-open breaker
+    updated_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f'State of {self.server.name}'
+
 class BackupFile(models.Model):
     filename = models.CharField(max_length=256)
     file_size = models.BigIntegerField(blank=True, null=True)
@@ -39,6 +81,8 @@ class BackupFile(models.Model):
     )
     error_message = models.TextField(blank=True, null=True)
     retry_count = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # Earliest automatic retry of a failed transfer
+    transfer_owner = models.CharField(max_length=100, null=True, blank=True)  # Worker currently transferring the file
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
     source_server = models.ForeignKey(ServerConfig, on_delete=models.CASCADE, related_name='source_files')
@@ -46,6 +90,8 @@ class BackupFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='backup_files')
     is_folder = models.BooleanField(default=False)
     files_count = models.IntegerField(default=0)
+    normalize_line_endings = models.BooleanField(default=False)  # Convert CRLF to LF while transferring
+    scan_filter = models.JSONField(blank=True, null=True)  # Include/exclude rules applied when walking a folder
     
     def __str__(self):
         return f'{self.filename} (Status: {self.status})'
@@ -59,6 +105,81 @@ class TransferLog(models.Model):
     def __str__(self):
         return f'{self.action} for file ID {self.backup_file_id}'
 
+class TransferBatch(models.Model):
+    """A user's request to transfer many files at once, e.g. all pending or all failed files"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='transfer_batches')
+    source_status = models.CharField(max_length=20, choices=TransferStatus.choices)  # Files selected for the batch
+    action = models.CharField(max_length=64, default='transfer_initiated')  # Passed on to each TransferJob
+    message = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=20, choices=JobStatus.choices, default=JobStatus.QUEUED)  # Of queueing the jobs
+    lease_owner = models.CharField(max_length=128, blank=True, null=True)  # Worker queueing the jobs
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    total_count = models.IntegerField(default=0)  # Jobs queued so far
+    result = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)  # When all jobs were queued
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at']),
+        ]
+    
+    def __str__(self):
+        return f'Batch {self.pk} of {self.source_status} files for {self.user.username} ({self.status})'
+
+class FairShare(models.Model):
+    """A user's share of the transfer workers when several users have queued jobs"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='fair_share')
+    weight = models.FloatField(default=1.0, validators=[MinValueValidator(0.01)])  # Relative share; a user with weight 2 gets twice the transfer time
+    max_transfers = models.PositiveIntegerField(null=True, blank=True)  # Cap on concurrent transfers, default BACKUP_USER_MAX_TRANSFERS
+    virtual_time = models.FloatField(default=0)  # Transfer seconds received, divided by the weight
+    
+    def __str__(self):
+        return f'Share of {self.user.username} (weight {self.weight})'
+
+class TransferJob(models.Model):
+    """A unit of work in the durable transfer queue: transfer one BackupFile once"""
+    backup_file = models.ForeignKey(BackupFile, on_delete=models.CASCADE, related_name='jobs')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='transfer_jobs')  # Owner of the file, for fair sharing
+    batch = models.ForeignKey(TransferBatch, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    status = models.CharField(max_length=20, choices=JobStatus.choices, default=JobStatus.QUEUED)
+    action = models.CharField(max_length=64, default='transfer_initiated')  # Logged when the transfer starts
+    message = models.TextField(blank=True, null=True)
+    lease_owner = models.CharField(max_length=128, blank=True, null=True)  # Worker currently holding the job
+    lease_expires_at = models.DateTimeField(null=True, blank=True)  # Job becomes visible again after this
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    expected_seconds = models.FloatField(null=True, blank=True)  # Estimated transfer time from size and throughput
+    priority = models.IntegerField(choices=TransferPriority.choices, default=TransferPriority.SCHEDULED)
+    deadline = models.DateTimeField(null=True, blank=True)  # Must finish by; earliest deadline first within a priority
+    run_at = models.DateTimeField(default=timezone.now)  # Start of the run that queued the job; runs are served in order
+    order_key = models.FloatField(default=0)  # Within a run, jobs are claimed by ascending key, then by age
+    result = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at']),
+            models.Index(fields=['batch', 'finished_at']),
+            models.Index(fields=['status', 'priority', 'deadline', 'run_at', 'order_key', 'created_at']),
+            models.Index(fields=['status', 'priority', 'user']),
+        ]
+        constraints = [
+            # At most one queued or running job per file
+            models.UniqueConstraint(
+                fields=['backup_file'],
+                condition=models.Q(status__in=['queued', 'leased']),
+                name='unique_active_transfer_job'
+            ),
+        ]
+    
+    def __str__(self):
+        return f'Job {self.pk} for file ID {self.backup_file_id} ({self.status})'
+
 class ScheduleConfig(models.Model):
     name = models.CharField(max_length=64)
     source_server = models.ForeignKey(ServerConfig, on_delete=models.CASCADE, related_name='source_schedules')
@@ -66,9 +187,109 @@ class ScheduleConfig(models.Model):
     frequency = models.CharField(max_length=20, default='daily')  # daily, hourly, weekly, etc.
     cron_expression = models.CharField(max_length=64, blank=True, null=True)  # For more complex schedules
     enabled = models.BooleanField(default=True)
+    normalize_line_endings = models.BooleanField(default=False)  # Convert CRLF to LF while transferring
+    transfer_order = models.CharField(max_length=20, choices=TransferOrder.choices, default=TransferOrder.SCAN)
+    deadline_minutes = models.PositiveIntegerField(null=True, blank=True)  # Transfers of a run must finish this long after it starts
+    include_patterns = models.TextField(blank=True, default='')  # Globs, or regexes prefixed with 're:'
+    exclude_patterns = models.TextField(blank=True, default='')  # e.g. 'tmp/', 'cache/', '*.lock'
+    min_size = models.BigIntegerField(null=True, blank=True)  # Bytes
+    max_size = models.BigIntegerField(null=True, blank=True)  # Bytes
+    min_age_hours = models.FloatField(null=True, blank=True)  # Skip files modified more recently
+    max_age_hours = models.FloatField(null=True, blank=True)  # Skip files modified longer ago
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='schedules')
     created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)  # Bumped on every edit; the scheduler re-registers changed schedules
     last_run = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
         return f'{self.name} (Frequency: {self.frequency})'
+
+class ScheduleRun(models.Model):
+    """An on-demand scan-and-transfer run of a schedule, executed by a transfer worker"""
+    schedule = models.ForeignKey(ScheduleConfig, on_delete=models.CASCADE, related_name='runs')
+    trigger = models.CharField(max_length=20, default='manual')  # created, enabled, manual, scheduled
+    status = models.CharField(max_length=20, choices=JobStatus.choices, default=JobStatus.QUEUED)
+    lease_owner = models.CharField(max_length=128, blank=True, null=True)  # Worker currently running the scan
+    lease_expires_at = models.DateTimeField(null=True, blank=True)  # Run becomes visible again after this
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    scanned_count = models.IntegerField(default=0)  # Source entries seen so far
+    registered_count = models.IntegerField(default=0)  # New BackupFiles created so far
+    queued_count = models.IntegerField(default=0)  # Transfers queued so far
+    result = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'lease_expires_at']),
+        ]
+        constraints = [
+            # At most one queued or running run per schedule
+            models.UniqueConstraint(
+                fields=['schedule'],
+                condition=models.Q(status__in=['queued', 'leased']),
+                name='unique_active_schedule_run'
+            ),
+        ]
+    
+    def __str__(self):
+        return f'Run {self.pk} of schedule ID {self.schedule_id} ({self.status})'
+
+class LeaderLease(models.Model):
+    """Lease row electing the single process that runs a cluster-wide role, e.g. the scheduler"""
+    name = models.CharField(max_length=64, unique=True)
+    holder = models.CharField(max_length=128, blank=True, null=True)  # Process currently holding the role
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)  # Another process may take over after this
+    
+    def __str__(self):
+        return f'{self.name} held by {self.holder or "nobody"}'
+
+class WorkerNode(models.Model):
+    """A running transfer worker process; schedules and servers are sharded across the live ones"""
+    name = models.CharField(max_length=128, unique=True)
+    started_at = models.DateTimeField(default=timezone.now)
+    heartbeat_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()  # The node is considered gone after this
+    
+    def __str__(self):
+        return self.name
+
+class SnapshotDirectory(models.Model):
+    """Last known state of a remote directory, used to skip unchanged directories on rescans"""
+    server = models.ForeignKey(ServerConfig, on_delete=models.CASCADE, related_name='snapshot_directories')
+    path = models.CharField(max_length=512)
+    mtime = models.BigIntegerField(null=True, blank=True)  # Directory mtime when its entries were listed
+    complete = models.BooleanField(default=False)  # False while a listing is being (re)recorded
+    scanned_at = models.DateTimeField(default=timezone.now)
+    listing_owner = models.CharField(max_length=64, blank=True, null=True)  # Scan currently listing the directory for everyone
+    listing_started_at = models.DateTimeField(null=True, blank=True)
+    relist_token = models.CharField(max_length=32, blank=True, null=True)  # Listing now rewriting the entries; only it may complete them
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['server', 'path'], name='unique_snapshot_directory'),
+        ]
+    
+    def __str__(self):
+        return f'{self.path} on {self.server.name}'
+
+class SnapshotEntry(models.Model):
+    """A single file or folder recorded in a SnapshotDirectory listing"""
+    directory = models.ForeignKey(SnapshotDirectory, on_delete=models.CASCADE, related_name='entries')
+    filename = models.CharField(max_length=256)
+    size = models.BigIntegerField(default=0)
+    mtime = models.BigIntegerField(null=True, blank=True)
+    atime = models.BigIntegerField(null=True, blank=True)
+    mode = models.IntegerField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['directory', 'filename'], name='unique_snapshot_entry'),
+        ]
+    
+    def __str__(self):
+        return f'{self.filename} in {self.directory.path}'
@@ -0,0 +1,52 @@
+from django.conf import settings
+from .models import ServerState, TransferOrder
+
+def get_default_rate():
+    """Bytes per second assumed for one transfer to a destination with no measured throughput"""
+    return getattr(settings, 'BACKUP_DEFAULT_TRANSFER_RATE', 10 * 1024 * 1024)
+
+def get_overhead_seconds():
+    """Fixed cost of a transfer (connecting, opening files), so tiny files are not estimated as free"""
+    return getattr(settings, 'BACKUP_TRANSFER_OVERHEAD_SECONDS', 0.5)
+
+def get_transfer_rates(destination_ids):
+    """
+    Historical throughput of a single transfer to each destination
+
+    The AIMD controller measures the aggregate throughput of a destination
+    over its last window; divided by the concurrency it ran at, that is the
+    rate one transfer can expect.
+
+    Returns:
+        dict: ServerConfig id -> bytes per second
+    """
+    rates = {}
+    for server_id, throughput, concurrency in ServerState.objects.filter(
+        server_id__in=destination_ids,
+        last_throughput__gt=0
+    ).values_list('server_id', 'last_throughput', 'concurrency'):
+        rates[server_id] = throughput / max(concurrency, 1)
+    return rates
+
+def estimate_seconds(backup_file, rates):
+    """Expected duration of transferring a file or folder, from its size and the destination's rate"""
+    rate = rates.get(backup_file.destination_server_id) or get_default_rate()
+    return get_overhead_seconds() + (backup_file.file_size or 0) / rate
+
+def get_order_key(order, expected_seconds):
+    """
+    Position of a job within its run; jobs of a run are claimed by ascending key, then by age
+
+    Keys are only compared between jobs queued by the same run (see
+    TransferJob.run_at), since they mean different things under each order.
+
+    Largest first is longest-processing-time-first scheduling: starting the
+    longest transfers early keeps one big file from starting last and
+    stretching the whole run. Smallest first gets the most files done soonest.
+    Scan order keeps first-in, first-out.
+    """
+    if order == TransferOrder.LARGEST_FIRST:
+        return -expected_seconds
+    if order == TransferOrder.SMALLEST_FIRST:
+        return expected_seconds
+    return 0
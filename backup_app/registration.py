@@ -0,0 +1,129 @@
+import logging
+import os
+from django.db import transaction
+from .models import BackupFile, TransferLog, TransferStatus
+from .snapshots import get_folder_size
+from .utils import SCAN_CHUNK_SIZE, iter_chunks
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+class BulkRegistrar:
+    """
+    Register scanned entries as BackupFiles in batches
+
+    The filenames already registered for the source/destination/user triple are
+    loaded once with a single query; new entries are then inserted with one
+    bulk_create per batch for the BackupFiles and one for their TransferLogs,
+    each batch inside its own transaction.
+
+    Attributes:
+        scanned_count: number of entries seen
+        registered_count: number of new BackupFiles created
+    """
+
+    def __init__(self, source_server, destination_server, user,
+                 status=TransferStatus.PENDING, log_action='file_registered',
+                 log_message='File or folder registered for transfer',
+                 normalize_line_endings=False, scan_filter=None, sftp=None, batch_size=SCAN_CHUNK_SIZE):
+        """
+        Args:
+            source_server: source ServerConfig
+            destination_server: destination ServerConfig
+            user: owner of the new BackupFiles
+            status: initial status of the new BackupFiles
+            log_action: action of the TransferLog written for each new BackupFile
+            log_message: message of that TransferLog
+            normalize_line_endings: convert CRLF to LF when the new files are transferred
+            scan_filter: optional ScanFilter stored on new folders and applied to their contents
+            sftp: optional SFTP connection to the source, used to size new folders
+            batch_size: number of entries inserted per transaction
+        """
+        self.source_server = source_server
+        self.destination_server = destination_server
+        self.user = user
+        self.status = status
+        self.log_action = log_action
+        self.log_message = log_message
+        self.normalize_line_endings = normalize_line_endings
+        self.scan_filter = scan_filter
+        self.sftp = sftp
+        self.batch_size = batch_size
+        self.scanned_count = 0
+        self.registered_count = 0
+        self.existing = set(
+            BackupFile.objects.filter(
+                source_server=source_server,
+                destination_server=destination_server,
+                user=user
+            ).values_list('filename', flat=True)
+        )
+
+    def register(self, entries):
+        """
+        Register every entry that is not registered yet
+
+        Args:
+            entries: iterable of RemoteEntry, typically a streaming scan
+
+        Yields:
+            list: the BackupFiles created for each batch of scanned entries,
+            empty when the whole batch was already registered
+        """
+        for chunk in iter_chunks(entries, self.batch_size):
+            self.scanned_count += len(chunk)
+            new_files = []
+            for entry in chunk:
+                if entry.filename in self.existing:
+                    continue
+                # Guard against the same name appearing twice in one scan
+                self.existing.add(entry.filename)
+                new_files.append(self._build(entry))
+
+            if not new_files:
+                yield new_files
+                continue
+
+            with transaction.atomic():
+                new_files = BackupFile.objects.bulk_create(new_files)
+                TransferLog.objects.bulk_create([
+                    TransferLog(
+                        backup_file=new_file,
+                        action=self.log_action,
+                        message=self.log_message
+                    )
+                    for new_file in new_files
+                ])
+
+            self.registered_count += len(new_files)
+            yield new_files
+
+    def _build(self, entry):
+        """Build an unsaved BackupFile for a scanned entry"""
+        # Use the configured remote paths for both files and folders
+        source_path = os.path.join(self.source_server.remote_path, entry.filename).replace('\\', '/')
+        destination_path = os.path.join(self.destination_server.remote_path, entry.filename).replace('\\', '/')
+
+        # Calculate folder size if folder; memoized per directory mtime
+        file_size = entry.size
+        files_count = 0
+        if entry.is_folder and self.sftp is not None:
+            file_size, files_count = get_folder_size(self.sftp, self.source_server, source_path, scan_filter=self.scan_filter)
+            logger.info(f"Calculated folder size for {source_path}: {file_size} bytes")
+
+        return BackupFile(
+            filename=entry.filename,
+            file_size=file_size,
+            file_created_at=entry.created_at,
+            file_modified_at=entry.modified_at,
+            source_path=source_path,
+            destination_path=destination_path,
+            status=self.status,
+            source_server=self.source_server,
+            destination_server=self.destination_server,
+            user=self.user,
+            is_folder=entry.is_folder,
+            files_count=files_count,
+            normalize_line_endings=self.normalize_line_endings,
+            scan_filter=self.scan_filter.to_dict() if entry.is_folder and self.scan_filter else None
+        )
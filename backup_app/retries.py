@@ -0,0 +1,60 @@
+import random
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import TransferStatus
+
+# Failures that will not go away by trying again; the file needs attention instead
+PERMANENT_ERRORS = re.compile(
+    r'no such file|errno 2\b|permission denied|errno 13\b|access denied|'
+    r'is a directory|not a directory|authentication failed|bad authentication|'
+    r'invalid (key|path)|not a valid rsa private key|quota exceeded|disk quota',
+    re.IGNORECASE
+)
+
+def get_max_retries():
+    """Automatic retries of a transient failure before the file is dead-lettered"""
+    return getattr(settings, 'BACKUP_MAX_RETRIES', 8)
+
+def get_base_delay():
+    """Delay before the first retry; it doubles with every further attempt"""
+    return getattr(settings, 'BACKUP_RETRY_BASE_SECONDS', 60)
+
+def get_max_delay():
+    """Upper bound on the delay between two retries"""
+    return getattr(settings, 'BACKUP_RETRY_MAX_DELAY_SECONDS', 6 * 3600)
+
+def is_permanent_error(message):
+    """True if a transfer failure is permanent (missing source, permission denied, ...)"""
+    return bool(message and PERMANENT_ERRORS.search(message))
+
+def backoff_seconds(retry_count):
+    """
+    Delay before the next retry of a file that has been retried `retry_count` times
+
+    Exponential backoff with equal jitter: half of the capped delay is fixed
+    and the other half random, so files that failed together (e.g. when a
+    server went down) do not all come back at the same moment.
+    """
+    delay = min(get_max_delay(), get_base_delay() * (2 ** retry_count))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def schedule_retry(backup_file, message, now=None):
+    """
+    Decide what happens to a BackupFile whose transfer just failed
+
+    Transient failures stay FAILED with `next_attempt_at` pushed back
+    exponentially; permanent failures, and files that used up their retries,
+    move to DEAD_LETTER, which the automatic retry job skips.
+
+    Returns:
+        bool: True if the file will be retried automatically
+    """
+    if is_permanent_error(message) or backup_file.retry_count >= get_max_retries():
+        backup_file.status = TransferStatus.DEAD_LETTER
+        backup_file.next_attempt_at = None
+        return False
+    backup_file.status = TransferStatus.FAILED
+    backup_file.next_attempt_at = (now or timezone.now()) + timedelta(seconds=backoff_seconds(backup_file.retry_count))
+    return True
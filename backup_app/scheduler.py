@@ -1,15 +1,27 @@
 import logging
+import threading
 import time
-import os
-from datetime import datetime
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
 from django_apscheduler.jobstores import DjangoJobStore
 from django_apscheduler.models import DjangoJobExecution
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.triggers.cron import CronTrigger
-from .models import BackupFile, ScheduleConfig, TransferLog, TransferStatus
-from .utils import list_files_on_server, transfer_file
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from apscheduler.triggers.interval import IntervalTrigger
+from .models import BackupFile, JobStatus, ScheduleConfig, TransferJob, TransferStatus, TransferOrder, TransferPriority
+from .utils import iter_chunks, sftp_connect
+from .snapshots import iter_server_listing, renew_listing
+from .registration import BulkRegistrar
+from .filters import ScanFilter
+from .jobs import (
+    TransferWorker, WorkerStopping, enqueue_schedule_run, enqueue_transfers, get_poll_seconds, make_worker_id
+)
+from .sharding import is_sharded
+from .leader import LeaderElection
 
 # Set up logger
 logger = logging.getLogger(__name__)
@@ -18,8 +30,157 @@ def delete_old_job_executions(max_age=604_800):
     """Delete job execution entries older than `max_age` seconds."""
     DjangoJobExecution.objects.delete_old_job_executions(max_age)
 
+def get_max_queued():
+    """Queued transfers of a schedule above which its scan stops queueing more"""
+    return getattr(settings, 'BACKUP_SCHEDULE_MAX_QUEUED', 5000)
+
+def get_queue_wait_seconds():
+    """Longest a scan waits for the queue to drain before queueing the next chunk anyway"""
+    return getattr(settings, 'BACKUP_SCHEDULE_QUEUE_WAIT_SECONDS', 600)
+
+def wait_for_queue(schedule, heartbeat=None, stop_event=None):
+    """
+    Block while too many of a schedule's transfers are waiting in the queue
+
+    Backpressure for the scan: when workers fall behind, the listing pauses
+    instead of pushing every chunk into the queue. The wait is bounded, so a
+    pool whose only thread is running the scan itself cannot deadlock.
+
+    Args:
+        schedule: ScheduleConfig being run
+        heartbeat: optional callable invoked while waiting, e.g. to renew the run's lease
+        stop_event: optional threading.Event of the worker running the scan
+
+    Raises:
+        WorkerStopping: if `stop_event` is set while waiting
+    """
+    queued = TransferJob.objects.filter(
+        status=JobStatus.QUEUED,
+        user=schedule.user,
+        backup_file__source_server=schedule.source_server,
+        backup_file__destination_server=schedule.destination_server
+    )
+    limit = get_max_queued()
+    deadline = time.monotonic() + get_queue_wait_seconds()
+    while queued.count() >= limit:
+        if time.monotonic() >= deadline:
+            logger.warning(f"Queue of schedule {schedule.name} still at {limit} transfers, queueing anyway")
+            return
+        if heartbeat is not None:
+            heartbeat()
+        if stop_event is None:
+            time.sleep(get_poll_seconds())
+        elif stop_event.is_set() or stop_event.wait(get_poll_seconds()):
+            raise WorkerStopping(f'Worker stopped while schedule {schedule.name} waited for its queue')
+
+def run_schedule(schedule, progress=None, stop_event=None):
+    """
+    Scan a schedule's source server and queue its files for transfer
+
+    Files are queued chunk by chunk while the listing is read; the scan
+    pauses whenever the schedule has BACKUP_SCHEDULE_MAX_QUEUED transfers
+    waiting (see wait_for_queue).
+
+    Args:
+        schedule: ScheduleConfig to run
+        progress: optional callable(scanned, registered, queued) invoked after
+            each batch of scanned entries and once more at the end
+        stop_event: optional threading.Event of the worker running the scan;
+            once set, waiting for the queue raises WorkerStopping
+
+    Returns:
+        tuple: (new files registered, transfers queued)
+    """
+    # Update last run time
+    schedule.last_run = timezone.now()
+    schedule.save(update_fields=['last_run'])
+    # Transfers of this run are claimed earliest deadline first among scheduled work
+    deadline = None
+    if schedule.deadline_minutes:
+        deadline = schedule.last_run + timedelta(minutes=schedule.deadline_minutes)
+    
+    # Get server configurations
+    source_server = schedule.source_server
+    destination_server = schedule.destination_server
+    
+    scanned_count = 0
+    new_files_count = 0
+    queued_count = 0
+    # Claim of the shared listing of the source path, kept alive while the scan waits
+    listing_owner = uuid.uuid4().hex
+    
+    def heartbeat():
+        renew_listing(source_server, listing_owner)
+        if progress is not None:
+            progress(scanned_count, new_files_count, queued_count)
+    
+    # Scan for files on source server only if scanning is enabled for this schedule
+    if getattr(schedule, 'scan_enabled', True):
+        scan_filter = ScanFilter.from_config(schedule)
+        # Size-aware ordering needs real folder sizes, which take a second connection
+        ssh, sftp = None, None
+        if schedule.transfer_order != TransferOrder.SCAN:
+            ssh, sftp = sftp_connect(source_server)
+        try:
+            registrar = BulkRegistrar(
+                source_server,
+                destination_server,
+                schedule.user,
+                normalize_line_endings=schedule.normalize_line_endings,
+                scan_filter=scan_filter,
+                sftp=sftp
+            )
+            listing = iter_server_listing(
+                source_server, include_folders=True, scan_filter=scan_filter, owner=listing_owner
+            )
+            
+            # Queue each registered batch as soon as it is written, so workers
+            # start transferring while the rest of the listing is still being read
+            for new_files in registrar.register(listing):
+                wait_for_queue(schedule, heartbeat, stop_event)
+                queued_count += enqueue_transfers(
+                    new_files,
+                    message='Scheduled automatic transfer',
+                    order=schedule.transfer_order,
+                    priority=TransferPriority.SCHEDULED,
+                    deadline=deadline,
+                    run_at=schedule.last_run
+                )
+                scanned_count = registrar.scanned_count
+                new_files_count = registrar.registered_count
+                if progress is not None:
+                    progress(scanned_count, new_files_count, queued_count)
+        finally:
+            if sftp:
+                sftp.close()
+            if ssh:
+                ssh.close()
+    
+    # Queue all pending files regardless of scanning; files queued above
+    # already have an active job and are skipped
+    pending_files = BackupFile.objects.filter(
+        user=schedule.user,
+        status=TransferStatus.PENDING,
+        source_server=source_server,
+        destination_server=destination_server
+    )
+    for chunk in iter_chunks(pending_files.iterator()):
+        wait_for_queue(schedule, heartbeat, stop_event)
+        queued_count += enqueue_transfers(
+            chunk,
+            message='Scheduled automatic transfer of pending file',
+            order=schedule.transfer_order,
+            priority=TransferPriority.SCHEDULED,
+            deadline=deadline,
+            run_at=schedule.last_run
+        )
+    if progress is not None:
+        progress(scanned_count, new_files_count, queued_count)
+    
+    return new_files_count, queued_count
+
 def scan_and_transfer_files(schedule_id):
-    """Background job to scan source server and transfer files to destination"""
+    """Background job to scan source server and queue files for transfer to destination"""
     try:
         # Get the schedule configuration
         schedule = ScheduleConfig.objects.get(pk=schedule_id)
@@ -28,229 +189,156 @@ def scan_and_transfer_files(schedule_id):
             logger.warning(f"Schedule {schedule_id} not found or disabled")
             return
         
-        logger.info(f"Starting scheduled job for config: {schedule.name}")
-        
-        # Update last run time
-        schedule.last_run = timezone.now()
-        schedule.save()
-        
-        # Get server configurations
-        source_server = schedule.source_server
-        destination_server = schedule.destination_server
-        
-        new_files_count = 0
-        transfer_success_count = 0
-        transfer_failed_count = 0
-        
-        # Scan for files on source server only if scanning is enabled for this schedule
-        if getattr(schedule, 'scan_enabled', True):
-            files = list_files_on_server(source_server, include_folders=True)
-            
-            # Function to transfer a single file and log results
-            def transfer_and_log(file_info):
-                nonlocal transfer_success_count, transfer_failed_count
-                try:
-                    # Check if file is already registered
-                    existing = BackupFile.objects.filter(
-                        filename=file_info['filename'],
-                        source_server=source_server,
-                        destination_server=destination_server,
-                        user=schedule.user
-                    ).first()
-                    
-                    if not existing:
-                        # Register new file for transfer
-                        new_file = BackupFile(
-                            filename=file_info['filename'],
-                            file_size=file_info['size'],
-                            file_created_at=file_info.get('created_at'),
-                            file_modified_at=file_info.get('modified_at'),
-                            source_path=os.path.join(source_server.remote_path, file_info['filename']).replace('\\', '/'),
-                            destination_path=os.path.join(destination_server.remote_path, file_info['filename']).replace('\\', '/'),
-                            status=TransferStatus.PENDING,
-                            source_server=source_server,
-                            destination_server=destination_server,
-                            user=schedule.user,
-                            is_folder=file_info.get('is_folder', False)
-                        )
-                        
-                        new_file.save()
-                        # Immediately attempt transfer
-                        new_file.status = TransferStatus.IN_PROGRESS
-                        new_file.save()
-                        
-                        # Log the transfer initiation
-                        log_entry = TransferLog(
-                            backup_file=new_file,
-                            action='transfer_initiated',
-                            message='Scheduled automatic transfer'
-                        )
-                        log_entry.save()
-                        
-                        # Perform the file transfer
-                        success, message = transfer_file(new_file)
-                        
-                        if success:
-                            new_file.status = TransferStatus.SUCCESS
-                            log_action = 'transfer_complete'
-                            transfer_success_count += 1
-                        else:
-                            new_file.status = TransferStatus.FAILED
-                            new_file.error_message = message
-                            log_action = 'transfer_failed'
-                            transfer_failed_count += 1
-                        
-                        # Update backup file status
-                        new_file.save()
-                        
-                        # Log the transfer result
-                        log_entry = TransferLog(
-                            backup_file=new_file,
-                            action=log_action,
-                            message=message
-                        )
-                        log_entry.save()
-                except Exception as e:
-                    logger.error(f"Error transferring file {file_info['filename']}: {str(e)}")
-                    transfer_failed_count += 1
-            
-            # Use ThreadPoolExecutor to transfer files concurrently
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = [executor.submit(transfer_and_log, file_info) for file_info in files]
-                for future in as_completed(futures):
-                    pass  # Just wait for all to complete
+        # A leader that stalled past its lease may still fire once; the new leader runs it instead
+        if not is_scheduler_leader():
+            logger.warning(f"Skipping schedule {schedule.name}: this process is no longer the scheduler leader")
+            return
         
-        # Transfer all pending files regardless of scanning
-        pending_files = BackupFile.objects.filter(
-            user=schedule.user,
-            status=TransferStatus.PENDING,
-            source_server=source_server,
-            destination_server=destination_server
-        )   
+        if is_sharded():
+            # Hand the scan to the worker node owning this schedule on the hash ring
+            run = enqueue_schedule_run(schedule, trigger='scheduled')
+            logger.info(f"Queued scheduled run #{run.pk} for config: {schedule.name}")
+            return
         
-        def transfer_pending_file(backup_file):
-            nonlocal transfer_success_count, transfer_failed_count
-            try:
-                backup_file.status = TransferStatus.IN_PROGRESS
-                backup_file.save()
-                
-                log_entry = TransferLog(
-                    backup_file=backup_file,
-                    action='transfer_initiated',
-                    message='Scheduled automatic transfer of pending file'
-                )
-                log_entry.save()
-                
-                success, message = transfer_file(backup_file)
-                
-                if success:
-                    backup_file.status = TransferStatus.SUCCESS
-                    log_action = 'transfer_complete'
-                    transfer_success_count += 1
-                else:
-                    backup_file.status = TransferStatus.FAILED
-                    backup_file.error_message = message
-                    log_action = 'transfer_failed'
-                    transfer_failed_count += 1
-                
-                backup_file.save()
-                
-                log_entry = TransferLog(
-                    backup_file=backup_file,
-                    action=log_action,
-                    message=message
-                )
-                log_entry.save()
-            except Exception as e:
-                logger.error(f"Error transferring pending file {backup_file.filename}: {str(e)}")
-                transfer_failed_count += 1
+        logger.info(f"Starting scheduled job for config: {schedule.name}")
         
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(transfer_pending_file, bf) for bf in pending_files]
-            for future in as_completed(futures):
-                pass
+        new_files_count, queued_count = run_schedule(schedule)
         
         logger.info(f"Scheduled job completed for config: {schedule.name}. "
-                    f"Transferred {transfer_success_count} files successfully, "
-                    f"{transfer_failed_count} failed.")
+                    f"Registered {new_files_count} new files, queued {queued_count} transfers.")
         
     except Exception as e:
         logger.error(f"Error in scheduled job for config {schedule_id}: {str(e)}")
 
 
 def retry_failed_transfers():
-    """Background job to retry all failed transfers concurrently"""
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    """Background job to queue failed transfers whose backoff has elapsed"""
     try:
-        # Find all failed transfers regardless of retry count
-        failed_files = BackupFile.objects.filter(status=TransferStatus.FAILED)
-        
-        logger.info(f"Starting retry job for {failed_files.count()} failed transfers")
+        # Dead-lettered and cancelled files are different statuses and never retried automatically
+        failed_files = BackupFile.objects.filter(status=TransferStatus.FAILED).filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+        )
         
-        retried_count = 0
-        success_count = 0
+        # Files cancelled while the selection streams past are skipped too
+        queued_count = enqueue_transfers(
+            failed_files.iterator(),
+            action='transfer_retry',
+            message='Automatic retry',
+            status=TransferStatus.FAILED,
+            priority=TransferPriority.RETRY
+        )
         
-        def retry_transfer(backup_file):
-            nonlocal success_count
-            try:
-                backup_file.status = TransferStatus.RETRYING
-                backup_file.retry_count += 1
-                backup_file.save()
-                
-                log_entry = TransferLog(
-                    backup_file=backup_file,
-                    action='transfer_retry',
-                    message=f'Automatic retry attempt #{backup_file.retry_count}'
-                )
-                log_entry.save()
-                
-                success, message = transfer_file(backup_file)
-                
-                if success:
-                    backup_file.status = TransferStatus.SUCCESS
-                    log_action = 'transfer_complete'
-                    success_count += 1
-                else:
-                    backup_file.status = TransferStatus.FAILED
-                    backup_file.error_message = message
-                    log_action = 'transfer_failed'
-                
-                backup_file.save()
-                
-                log_entry = TransferLog(
-                    backup_file=backup_file,
-                    action=log_action,
-                    message=message
-                )
-                log_entry.save()
-            except Exception as e:
-                logger.error(f"Error retrying transfer for file {backup_file.filename}: {str(e)}")
-        
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(retry_transfer, bf) for bf in failed_files]
-            for future in as_completed(futures):
-                pass
-        
-        logger.info(f"Retry job completed. Retried {failed_files.count()} transfers, {success_count} successful.")
-    except RuntimeError as e:
-        if "cannot schedule new futures after interpreter shutdown" in str(e):
-            logger.warning("Executor shutdown prevented scheduling new futures during interpreter shutdown")
-        else:
-            raise
+        logger.info(f"Retry job queued {queued_count} failed transfers")
     except Exception as e:
         logger.error(f"Error in retry job: {str(e)}")
 
 
-def init_scheduler():
-    """Initialize the background scheduler with scheduled jobs"""
+# Name of the LeaderLease whose holder runs the scheduler
+SCHEDULER_ROLE = 'scheduler'
+
+# Scheduler running in this process, if any, and the version of each schedule it has registered
+_scheduler = None
+_registered = {}
+_sync_lock = threading.Lock()
+
+# This process's candidacy for running the scheduler (see init_scheduler)
+_election = None
+
+def get_schedule_job_id(schedule_id):
+    """APScheduler job id of a schedule's scan-and-transfer job"""
+    return f'schedule_{schedule_id}'
+
+def get_schedule_trigger(schedule):
+    """
+    Build the APScheduler trigger of a schedule
+
+    Returns:
+        trigger for the schedule's cron expression or frequency, or None if
+        the frequency is unknown
+    """
+    if schedule.cron_expression:
+        # Use custom cron expression if provided
+        return CronTrigger.from_crontab(schedule.cron_expression)
+    # Default schedules based on frequency
+    if schedule.frequency == 'hourly':
+        return IntervalTrigger(hours=1)
+    if schedule.frequency == 'daily':
+        return CronTrigger(hour=0, minute=0)
+    if schedule.frequency == 'weekly':
+        return CronTrigger(day_of_week=0, hour=0, minute=0)
+    return None
+
+def _register_schedule(scheduler, schedule):
+    """Add or replace the job of an enabled schedule"""
+    try:
+        trigger = get_schedule_trigger(schedule)
+    except ValueError as e:
+        logger.error(f"Invalid cron expression for schedule {schedule.name}: {str(e)}")
+        trigger = None
+    if trigger is None:
+        _unregister_schedule(scheduler, schedule.pk)
+        return
+    scheduler.add_job(
+        scan_and_transfer_files,
+        args=[schedule.pk],
+        trigger=trigger,
+        id=get_schedule_job_id(schedule.pk),
+        replace_existing=True,
+    )
+    logger.info(f"Added scheduled job for config: {schedule.name}")
+
+def _unregister_schedule(scheduler, schedule_id):
+    """Remove the job of a deleted or disabled schedule, if it has one"""
+    try:
+        scheduler.remove_job(get_schedule_job_id(schedule_id))
+        logger.info(f"Removed scheduled job for schedule {schedule_id}")
+    except JobLookupError:
+        pass
+
+def sync_schedules(schedule_ids=None):
+    """
+    Apply schedule changes to the running scheduler without restarting it
+
+    Compares the updated_at of enabled schedules with the versions already
+    registered, then adds or replaces the jobs of new and edited schedules
+    and removes those of deleted or disabled ones. Runs periodically as a
+    change feed, and right after a save or delete in this process (see
+    signals.py).
+
+    Args:
+        schedule_ids: only sync these schedules, default all of them
+    """
+    scheduler = _scheduler
+    if scheduler is None:
+        return
+    with _sync_lock:
+        enabled = ScheduleConfig.objects.filter(enabled=True)
+        known = set(_registered)
+        if schedule_ids is not None:
+            enabled = enabled.filter(pk__in=schedule_ids)
+            known &= set(schedule_ids)
+        versions = dict(enabled.values_list('pk', 'updated_at'))
+
+        for schedule_id in known - set(versions):
+            _unregister_schedule(scheduler, schedule_id)
+            del _registered[schedule_id]
+
+        changed = [schedule_id for schedule_id, version in versions.items() if _registered.get(schedule_id) != version]
+        for schedule in ScheduleConfig.objects.filter(pk__in=changed):
+            _register_schedule(scheduler, schedule)
+            _registered[schedule.pk] = schedule.updated_at
+
+def start_scheduler():
+    """Start the background scheduler with its scheduled jobs in this process"""
+    global _scheduler
     scheduler = BackgroundScheduler()
     scheduler.add_jobstore(DjangoJobStore(), "default")
     
-    # Add job to retry failed transfers every 15 minutes
+    # Add job to queue failed transfers once their backoff has elapsed
     scheduler.add_job(
         retry_failed_transfers,
         trigger='interval',
-        minutes=15,
+        seconds=getattr(settings, 'BACKUP_RETRY_CHECK_SECONDS', 60),
         id='retry_failed_transfers',
         replace_existing=True,
     )
@@ -264,50 +352,67 @@ def init_scheduler():
         replace_existing=True,
     )
     
-    # Add scheduled jobs for each enabled schedule
-    schedules = ScheduleConfig.objects.filter(enabled=True)
-    
-    for schedule in schedules:
-        if schedule.cron_expression:
-            # Use custom cron expression if provided
-            trigger = CronTrigger.from_crontab(schedule.cron_expression)
-            scheduler.add_job(
-                scan_and_transfer_files,
-                args=[schedule.id],
-                trigger=trigger,
-                id=f'schedule_{schedule.id}',
-                replace_existing=True,
-            )
-        else:
-            # Default schedules based on frequency
-            if schedule.frequency == 'hourly':
-                scheduler.add_job(
-                    scan_and_transfer_files,
-                    args=[schedule.id],
-                    trigger='interval',
-                    hours=1,
-                    id=f'schedule_{schedule.id}',
-                    replace_existing=True,
-                )
-            elif schedule.frequency == 'daily':
-                scheduler.add_job(
-                    scan_and_transfer_files,
-                    args=[schedule.id],
-                    trigger=CronTrigger(hour=0, minute=0),
-                    id=f'schedule_{schedule.id}',
-                    replace_existing=True,
-                )
-            elif schedule.frequency == 'weekly':
-                scheduler.add_job(
-                    scan_and_transfer_files,
-                    args=[schedule.id],
-                    trigger=CronTrigger(day_of_week=0, hour=0, minute=0),
-                    id=f'schedule_{schedule.id}',
-                    replace_existing=True,
-                )
-            
-        logger.info(f"Added scheduled job for config: {schedule.name}")
-    
     logger.info("Starting scheduler...")
     scheduler.start()
+    # Known from here on, so stop_scheduler can shut it down if the rest fails
+    _scheduler = scheduler
+    
+    # Drop jobs the job store kept for schedules deleted or disabled while no scheduler ran
+    enabled_ids = set(ScheduleConfig.objects.filter(enabled=True).values_list('pk', flat=True))
+    for job in scheduler.get_jobs():
+        if job.id.startswith('schedule_') and int(job.id[len('schedule_'):]) not in enabled_ids:
+            scheduler.remove_job(job.id)
+    
+    # Add scheduled jobs for each enabled schedule, then keep them in sync with
+    # schedule edits made by other processes
+    _registered.clear()
+    sync_schedules()
+    scheduler.add_job(
+        sync_schedules,
+        trigger='interval',
+        seconds=getattr(settings, 'BACKUP_SCHEDULE_SYNC_SECONDS', 30),
+        id='sync_schedules',
+        max_instances=1,
+        replace_existing=True,
+    )
     return scheduler
+
+def stop_scheduler():
+    """Shut down the scheduler of this process, e.g. after losing leadership"""
+    global _scheduler
+    scheduler, _scheduler = _scheduler, None
+    if scheduler is not None:
+        logger.info("Stopping scheduler...")
+        scheduler.shutdown(wait=False)
+
+def is_scheduler_leader():
+    """True if this process currently holds the scheduler lease"""
+    return _election is not None and _election.confirm()
+
+def init_scheduler():
+    """
+    Stand for election as the cluster's scheduler and start in-process workers
+
+    Every web process (gunicorn worker, node) calls this at startup, but the
+    scheduler only runs in the process holding the scheduler LeaderLease, so
+    each schedule fires once per cluster. If the leader dies, another process
+    takes over once its lease expires (BACKUP_LEADER_LEASE_SECONDS).
+
+    Returns:
+        LeaderElection: this process's candidacy
+    """
+    global _election
+    if _election is None:
+        _election = LeaderElection(
+            SCHEDULER_ROLE,
+            make_worker_id('scheduler'),
+            on_elected=start_scheduler,
+            on_deposed=stop_scheduler
+        ).start()
+        
+        # Run transfer workers inside this process unless dedicated workers are used;
+        # every process may run them, since jobs are claimed exclusively
+        if getattr(settings, 'BACKUP_RUN_INPROCESS_WORKERS', True):
+            TransferWorker(name='inprocess').start()
+    
+    return _election
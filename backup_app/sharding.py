@@ -0,0 +1,127 @@
+import bisect
+import hashlib
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import WorkerNode
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+def is_sharded():
+    """Whether schedules and transfers are partitioned across worker nodes"""
+    return getattr(settings, 'BACKUP_SHARDING', True)
+
+def get_node_lease_seconds():
+    """How long a worker node stays in the ring without a heartbeat"""
+    return getattr(settings, 'BACKUP_NODE_LEASE_SECONDS', 60)
+
+def get_node_heartbeat_seconds():
+    """Interval between worker node heartbeats, and between ring refreshes"""
+    return getattr(settings, 'BACKUP_NODE_HEARTBEAT_SECONDS', 15)
+
+def get_virtual_nodes():
+    """Points each node gets on the hash ring; more points spread keys more evenly"""
+    return getattr(settings, 'BACKUP_SHARD_VIRTUAL_NODES', 128)
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys (schedules, servers) to node names
+
+    When a node joins or leaves, only the keys on its arcs of the ring move;
+    every other key keeps its owner.
+    """
+
+    def __init__(self, nodes, virtual_nodes=None):
+        virtual_nodes = virtual_nodes or get_virtual_nodes()
+        points = sorted(
+            (_hash(f'{node}#{index}'), node)
+            for node in nodes
+            for index in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+    def owner(self, key):
+        """Name of the node owning `key`, or None if the ring is empty"""
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+def heartbeat_node(name):
+    """Register a worker node or extend its membership of the ring"""
+    now = timezone.now()
+    WorkerNode.objects.update_or_create(
+        name=name,
+        defaults={'heartbeat_at': now, 'expires_at': now + timedelta(seconds=get_node_lease_seconds())}
+    )
+
+def deregister_node(name):
+    """Leave the ring right away, so other nodes take over this node's keys"""
+    WorkerNode.objects.filter(name=name).delete()
+
+def live_nodes():
+    """Names of the worker nodes whose membership has not expired"""
+    return list(WorkerNode.objects.filter(expires_at__gte=timezone.now()).values_list('name', flat=True))
+
+def purge_nodes():
+    """Delete nodes that stopped sending heartbeats long ago"""
+    cutoff = timezone.now() - timedelta(seconds=10 * get_node_lease_seconds())
+    return WorkerNode.objects.filter(expires_at__lt=cutoff).delete()[0]
+
+def schedule_key(schedule_id):
+    """Ring key of a schedule; its scans run on the node owning it"""
+    return f'schedule:{schedule_id}'
+
+def server_key(server_id):
+    """Ring key of a source server; its transfers prefer the node owning it"""
+    return f'server:{server_id}'
+
+class Shard:
+    """
+    The keys a worker node owns, by a view of the ring refreshed on heartbeats
+
+    Ownership is only a partition of the work, never a lock: queue rows are
+    still claimed exclusively (see jobs._claim), so two nodes briefly
+    disagreeing about the ring while a node joins or leaves cannot run the
+    same work twice.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.ring = HashRing([node])
+        self._members = [node]
+
+    def refresh(self):
+        """Heartbeat this node and rebuild the ring from the live nodes"""
+        heartbeat_node(self.node)
+        members = sorted(set(live_nodes()) | {self.node})
+        if members != self._members:
+            logger.info(f"Worker ring changed to {len(members)} nodes, rebalancing")
+            self.ring = HashRing(members)
+            self._members = members
+        return self
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.node
+
+    def owned(self, ids, key):
+        """The ids among `ids` whose key (schedule_key, server_key) this node owns"""
+        return [item_id for item_id in ids if self.owns(key(item_id))]
+
+    def orphaned(self, ids, key):
+        """
+        The ids among `ids` whose owner on this node's view of the ring has let
+        its lease expire since the last refresh; anyone may take them until the
+        next refresh moves their keys to a live node
+        """
+        live = set(live_nodes()) | {self.node}
+        return [item_id for item_id in ids if self.ring.owner(key(item_id)) not in live]
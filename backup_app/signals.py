@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import ScheduleConfig
+
+@receiver(post_save, sender=ScheduleConfig)
+@receiver(post_delete, sender=ScheduleConfig)
+def schedule_changed(sender, instance, update_fields=None, **kwargs):
+    """Re-register a saved or deleted schedule with the scheduler running in this process"""
+    if update_fields is not None and set(update_fields) <= {'last_run'}:
+        # Recording a run does not change when the schedule fires
+        return
+    from .scheduler import sync_schedules
+    schedule_id = instance.pk
+    transaction.on_commit(lambda: sync_schedules([schedule_id]))
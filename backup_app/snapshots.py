@@ -0,0 +1,470 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import SnapshotDirectory, SnapshotEntry
+from .utils import RemoteEntry, SCAN_CHUNK_SIZE, iter_remote_dir, sftp_connect
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+def normalize_remote_path(path):
+    """Normalize a remote directory path so it can be used as a snapshot key"""
+    path = path.replace('\\', '/')
+    return path.rstrip('/') or '/'
+
+def get_snapshot_ttl():
+    """Seconds a cached listing may be served without rescanning the server"""
+    return getattr(settings, 'BACKUP_SNAPSHOT_TTL', 300)
+
+def get_scan_share_seconds():
+    """Seconds a finished listing of a server's remote path is shared with later scans"""
+    return getattr(settings, 'BACKUP_SCAN_SHARE_SECONDS', 60)
+
+def get_scan_wait_seconds():
+    """
+    How long a scan waits for another scan's in-flight listing of the same
+    path, and how long a listing claim lasts without being renewed
+    """
+    return getattr(settings, 'BACKUP_SCAN_WAIT_SECONDS', 300)
+
+class ScanInProgress(Exception):
+    """Raised instead of waiting when another scan is listing the path and no snapshot can be served"""
+
+def iter_directory(sftp, server_config, path, dir_mtime=None):
+    """
+    Yield every file and folder in a remote directory, reusing the snapshot when possible
+
+    If the directory mtime matches the one recorded with the last listing, no
+    entries can have been added, removed or renamed, so the cached entries are
+    streamed from the database instead of listing the directory again.
+    Otherwise the directory is listed live and the snapshot is rewritten as
+    entries stream past. Mtimes only have whole-second resolution, so a
+    listing of a directory modified in the second it started is recorded but
+    not trusted (see _relist_directory).
+
+    Args:
+        sftp: active SFTP client connection
+        server_config: ServerConfig the directory belongs to
+        path: remote directory path
+        dir_mtime: current directory mtime if already known (saves a stat call)
+
+    Yields:
+        RemoteEntry: one entry per file/folder
+    """
+    entries, _ = _open_directory(sftp, server_config, path, dir_mtime)
+    yield from entries
+
+def _open_directory(sftp, server_config, path, dir_mtime=None):
+    """
+    Start listing a directory
+
+    Returns:
+        tuple: (entries, from_snapshot) - an iterator of RemoteEntry and whether
+        it is served from the snapshot rather than the server
+    """
+    path = normalize_remote_path(path)
+    if dir_mtime is None:
+        dir_mtime = sftp.stat(path).st_mtime
+
+    directory = SnapshotDirectory.objects.filter(server=server_config, path=path).first()
+    if directory and directory.complete and directory.mtime == dir_mtime:
+        logger.debug(f"Directory {path} on {server_config.host} unchanged, using snapshot")
+        # The snapshot was just verified against the server, so it counts as fresh
+        SnapshotDirectory.objects.filter(pk=directory.pk).update(scanned_at=timezone.now())
+        return _iter_snapshot_entries(directory), True
+
+    if directory is None:
+        directory, _ = SnapshotDirectory.objects.get_or_create(server=server_config, path=path)
+    return _relist_directory(sftp, server_config, directory, dir_mtime), False
+
+def _iter_snapshot_entries(directory):
+    """Stream the recorded entries of a directory snapshot"""
+    for row in directory.entries.iterator(chunk_size=SCAN_CHUNK_SIZE):
+        yield RemoteEntry(row.filename, row.size, row.mtime, row.atime, row.mode)
+
+def _relist_directory(sftp, server_config, directory, dir_mtime):
+    """
+    List a directory live and replace its snapshot entries
+
+    The snapshot is only marked complete if `dir_mtime` is older than the
+    second the listing started: an entry added later in that same second
+    would leave the mtime unchanged, so matching it could never reveal the
+    entry missing from the snapshot.
+
+    Each relist takes a token on the directory row. A relist that started
+    later takes the token over and clears the entries again; the earlier one
+    then stops writing (its caller still gets every entry) and cannot mark
+    the snapshot complete, so it never completes a snapshot another listing
+    is half-way through rewriting.
+    """
+    listed_at = int(time.time())
+    token = uuid.uuid4().hex
+    # Mark the snapshot incomplete first so an interrupted listing is never trusted
+    with transaction.atomic():
+        SnapshotDirectory.objects.filter(pk=directory.pk).update(complete=False, relist_token=token)
+        directory.entries.all().delete()
+
+    def record(entries):
+        """Store a batch of entries unless another relist took over; returns whether it was stored"""
+        with transaction.atomic():
+            # Locking the row keeps a newer relist from clearing the entries mid-batch
+            if not SnapshotDirectory.objects.select_for_update().filter(pk=directory.pk, relist_token=token).exists():
+                return False
+            SnapshotEntry.objects.bulk_create(entries, ignore_conflicts=True)
+        return True
+
+    recording = True
+    folders = set()
+    batch = []
+    for entry in iter_remote_dir(sftp, directory.path, include_folders=True):
+        if entry.is_folder:
+            folders.add(entry.filename)
+        batch.append(SnapshotEntry(
+            directory=directory,
+            filename=entry.filename,
+            size=entry.size,
+            mtime=entry.mtime,
+            atime=entry.atime,
+            mode=entry.mode
+        ))
+        if len(batch) >= SCAN_CHUNK_SIZE:
+            recording = recording and record(batch)
+            batch = []
+        yield entry
+    if batch:
+        recording = recording and record(batch)
+    if not recording:
+        logger.debug(f"Another listing of {directory.path} on {server_config.host} took over its snapshot")
+        return
+
+    with transaction.atomic():
+        finished = SnapshotDirectory.objects.filter(pk=directory.pk, relist_token=token).update(
+            mtime=dir_mtime,
+            complete=dir_mtime is not None and dir_mtime < listed_at,
+            scanned_at=timezone.now(),
+            relist_token=None
+        )
+        if finished:
+            _prune_removed_folders(server_config, directory.path, folders)
+
+def _prune_removed_folders(server_config, path, folders):
+    """Drop snapshots of sub-directories that no longer exist under `path`"""
+    prefix = path.rstrip('/') + '/'
+    stale_paths = [
+        sub_path
+        for sub_path in SnapshotDirectory.objects.filter(
+            server=server_config,
+            path__startswith=prefix
+        ).values_list('path', flat=True)
+        if sub_path[len(prefix):].split('/', 1)[0] not in folders
+    ]
+    if stale_paths:
+        SnapshotDirectory.objects.filter(server=server_config, path__in=stale_paths).delete()
+
+class FolderSizeCache:
+    """
+    Thread-safe LRU cache of the direct contents of folders
+
+    Keys are (server id, path, directory mtime, filter key), values are
+    (bytes, files count, sub-folder names) tuples covering only the files
+    directly in the folder. Subtree totals are summed while walking, since a
+    change deep in a subtree does not touch the mtimes of the folders above
+    it. The least recently used entry is evicted once `max_entries` is
+    reached.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+folder_sizes = FolderSizeCache(getattr(settings, 'BACKUP_FOLDER_SIZE_CACHE_ENTRIES', 10000))
+
+def walk_tree(sftp, server_config, path, dir_mtime=None, errors=None, scan_filter=None):
+    """
+    Walk a remote directory tree depth first, computing folder sizes on the way
+
+    Every directory's listing goes through the snapshot, so unchanged
+    directories cost a stat instead of a full listing. The direct size, file
+    count and sub-folders of each directory are stored in `folder_sizes`, so
+    later size lookups in the tree only stat each folder.
+
+    Args:
+        sftp: active SFTP client connection
+        server_config: ServerConfig the tree belongs to
+        path: remote root directory of the walk
+        dir_mtime: current mtime of the root directory if already known
+        errors: optional list collecting error messages for unreadable directories
+        scan_filter: optional ScanFilter; excluded folders are not descended into
+            and excluded files are neither yielded nor counted
+
+    Yields:
+        tuple: (parent_path, RemoteEntry) for every file and folder below `path`,
+        each folder before its contents
+
+    Returns:
+        tuple: (total bytes, files count) of the whole tree, as the StopIteration value
+    """
+    return (yield from _walk_directory(sftp, server_config, normalize_remote_path(path), dir_mtime, errors, scan_filter))
+
+def _relative_path(server_config, path):
+    """Path relative to the server's remote path, as matched by scan filters"""
+    root = normalize_remote_path(server_config.remote_path).rstrip('/') + '/'
+    return path[len(root):] if path.startswith(root) else path.lstrip('/')
+
+def _walk_directory(sftp, server_config, path, dir_mtime, errors, scan_filter=None, sizes_only=False):
+    """Generator behind walk_tree; returns the (total bytes, files count) of `path`"""
+    total_size = 0
+    files_count = 0
+    subdirectories = []
+    try:
+        listed_at = int(time.time())
+        if dir_mtime is None:
+            dir_mtime = sftp.stat(path).st_mtime
+        cache_key = (server_config.pk, path, dir_mtime, scan_filter.key if scan_filter else None)
+        cached = folder_sizes.get(cache_key) if sizes_only else None
+        if cached is not None:
+            total_size, files_count, folder_names = cached
+            subdirectories = [(filename, None) for filename in folder_names]
+            entries = ()
+        else:
+            entries, from_snapshot = _open_directory(sftp, server_config, path, dir_mtime)
+            if not sizes_only and not from_snapshot:
+                # Callers may use the same SFTP client between entries (transfer_folder
+                # copies each file as it is yielded), which would consume the replies to
+                # the listing's read-ahead requests; finish the live listing first
+                entries = list(entries)
+        relative_dir = _relative_path(server_config, path)
+        for entry in entries:
+            if scan_filter and not scan_filter.allows(f"{relative_dir}/{entry.filename}".lstrip('/'), entry):
+                continue
+            if entry.is_folder:
+                # Mtimes recorded in a snapshot may be stale for sub-directories, so
+                # only trust them when the parent was listed live
+                subdirectories.append((entry.filename, None if from_snapshot else entry.mtime))
+            else:
+                total_size += entry.size
+                files_count += 1
+            if not sizes_only:
+                yield path, entry
+        # Like snapshots, totals of a folder modified in the second it was read are not reused
+        if cached is None and dir_mtime < listed_at:
+            folder_sizes.set(cache_key, (total_size, files_count, tuple(filename for filename, _ in subdirectories)))
+    except Exception as e:
+        error_msg = f"Error listing directory {path}: {str(e)}"
+        logger.error(error_msg)
+        if errors is not None:
+            errors.append(error_msg)
+        return 0, 0
+
+    # Descend only after this directory's listing is consumed, so at most one
+    # snapshot cursor is open at a time
+    for filename, sub_mtime in subdirectories:
+        sub_path = f"{path.rstrip('/')}/{filename}"
+        sub_size, sub_files = yield from _walk_directory(
+            sftp, server_config, sub_path, sub_mtime, errors, scan_filter, sizes_only
+        )
+        total_size += sub_size
+        files_count += sub_files
+
+    return total_size, files_count
+
+def get_folder_size(sftp, server_config, path, dir_mtime=None, scan_filter=None):
+    """
+    Return the total size and file count of a remote folder, listing only the folders that changed
+
+    Args:
+        sftp: active SFTP client connection
+        server_config: ServerConfig the folder belongs to
+        path: remote folder path
+        dir_mtime: current mtime of the folder if already known
+        scan_filter: optional ScanFilter restricting which entries are counted
+
+    Returns:
+        tuple: (total bytes, files count)
+    """
+    totals = []
+
+    def drive():
+        totals.append((yield from _walk_directory(
+            sftp, server_config, normalize_remote_path(path), dir_mtime, None, scan_filter, sizes_only=True
+        )))
+
+    for _ in drive():
+        pass
+    return totals[0]
+
+def iter_server_listing(server_config, include_folders=False, scan_filter=None, share=True, owner=None, wait=True):
+    """
+    Stream the configured remote path of a server, re-listing it only if it changed
+
+    Scans of the same server and path are coalesced: while one scan lists
+    the path, others wait for it and then read its snapshot, and a listing
+    finished less than BACKUP_SCAN_SHARE_SECONDS ago is served to later scans
+    without connecting. Filters are applied per caller, after sharing.
+
+    The listing scan holds a claim that lapses after BACKUP_SCAN_WAIT_SECONDS.
+    It is renewed as entries stream past; a caller that may stop reading for
+    longer (e.g. a schedule run waiting for the transfer queue) renews it with
+    renew_listing.
+
+    Args:
+        server_config: ServerConfig model instance
+        include_folders: If True, also include folders in the result
+        scan_filter: optional ScanFilter; entries it rejects are skipped
+        share: if False, always connect and list (e.g. to test the connection)
+        owner: name of the listing claim, for renew_listing; generated if omitted
+        wait: if False, never wait for another scan's listing (e.g. in web
+            requests); the cached snapshot is served instead if there is one
+
+    Yields:
+        RemoteEntry: one entry per file/folder
+
+    Raises:
+        ScanInProgress: if `wait` is False, another scan is listing the path
+            and there is no cached snapshot to serve
+    """
+    path = normalize_remote_path(server_config.remote_path)
+    owner = owner or uuid.uuid4().hex
+    claimed = False
+    if share:
+        directory, claimed = _coalesce_listing(server_config, path, owner, wait)
+        if directory is not None:
+            logger.debug(f"Sharing the listing of {path} on {server_config.host} scanned at {directory.scanned_at}")
+            entries = _iter_snapshot_entries(directory)
+            yield from _filter_entries(entries, include_folders, scan_filter)
+            return
+
+    try:
+        ssh, sftp = sftp_connect(server_config)
+        try:
+            entries = iter_directory(sftp, server_config, path)
+            if claimed:
+                entries = _renewing(entries, server_config, owner)
+            yield from _filter_entries(entries, include_folders, scan_filter)
+        except Exception as e:
+            logger.error(f"Error listing files on {server_config.host}: {str(e)}")
+            raise RuntimeError(f"Failed to list files: {str(e)}")
+        finally:
+            sftp.close()
+            ssh.close()
+    finally:
+        if claimed:
+            SnapshotDirectory.objects.filter(server=server_config, path=path, listing_owner=owner).update(
+                listing_owner=None,
+                listing_started_at=None
+            )
+
+def renew_listing(server_config, owner):
+    """
+    Extend the claim of a scan listing a server's remote path
+
+    Returns:
+        bool: False if `owner` holds no claim (not listing, or already done)
+    """
+    return bool(SnapshotDirectory.objects.filter(
+        server=server_config,
+        path=normalize_remote_path(server_config.remote_path),
+        listing_owner=owner
+    ).update(listing_started_at=timezone.now()))
+
+def _renewing(entries, server_config, owner):
+    """Pass entries through, renewing the listing claim once per chunk"""
+    for count, entry in enumerate(entries, 1):
+        if count % SCAN_CHUNK_SIZE == 0:
+            renew_listing(server_config, owner)
+        yield entry
+
+def _filter_entries(entries, include_folders, scan_filter):
+    for entry in entries:
+        if not include_folders and entry.is_folder:
+            continue
+        if scan_filter and not scan_filter.allows(entry.filename, entry):
+            continue
+        yield entry
+
+def _coalesce_listing(server_config, path, owner, wait=True):
+    """
+    Find a listing of `path` to share, or become the scan that lists it
+
+    Returns:
+        tuple: (directory, claimed) - a fresh complete SnapshotDirectory to read
+        instead of listing, or None and whether `owner` now holds the listing
+        claim to release when done (False if waiting for another scan timed out)
+
+    Raises:
+        ScanInProgress: if `wait` is False, another scan holds the claim and
+            no cached snapshot is available
+    """
+    try:
+        with transaction.atomic():
+            SnapshotDirectory.objects.get_or_create(server=server_config, path=path)
+    except IntegrityError:
+        # Another scan created the row at the same time
+        pass
+    deadline = time.monotonic() + get_scan_wait_seconds()
+    while True:
+        fresh = get_cached_listing(server_config, max_age=get_scan_share_seconds())
+        if fresh is not None:
+            return fresh, False
+        # Claim the listing unless another scan holds a claim it renewed recently
+        now = timezone.now()
+        if SnapshotDirectory.objects.filter(server=server_config, path=path).filter(
+            Q(listing_owner__isnull=True)
+            | Q(listing_started_at__lt=now - timedelta(seconds=get_scan_wait_seconds()))
+        ).update(listing_owner=owner, listing_started_at=now):
+            return None, True
+        if not wait:
+            cached = get_cached_listing(server_config)
+            if cached is not None:
+                return cached, False
+            raise ScanInProgress(f'Another scan of {path} on {server_config.host} is in progress, try again shortly')
+        if time.monotonic() >= deadline:
+            logger.warning(f"Gave up waiting for another scan of {path} on {server_config.host}")
+            return None, False
+        time.sleep(1)
+
+def get_cached_listing(server_config, max_age=None):
+    """
+    Return the snapshot of a server's remote path if it is recent enough
+
+    Args:
+        server_config: ServerConfig model instance
+        max_age: maximum age in seconds (defaults to BACKUP_SNAPSHOT_TTL)
+
+    Returns:
+        SnapshotDirectory or None: the complete snapshot, or None if missing or stale
+    """
+    if max_age is None:
+        max_age = get_snapshot_ttl()
+    return SnapshotDirectory.objects.filter(
+        server=server_config,
+        path=normalize_remote_path(server_config.remote_path),
+        complete=True,
+        scanned_at__gte=timezone.now() - timedelta(seconds=max_age)
+    ).first()
@@ -1,3 +1,256 @@
-from django.test import TestCase
+import io
+import stat
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from paramiko import SFTPAttributes
+from .models import BackupFile, JobStatus, ServerConfig, TransferJob, TransferStatus
+from .jobs import (
+    LEASE_LOST, LeaseLost, acquire_files, claim_jobs, enqueue_transfer, execute_job, finish_job, renew_lease,
+    renew_leases, store_results
+)
+from .cancellation import CancellationToken, cancel_file_transfer
+from .utils import TransferAborted, TransferCancelled
 
-# Create your tests here.
+class FakeSFTP:
+    """In-memory SFTP client: `files` maps remote paths to their contents"""
+
+    def __init__(self, files=None, on_read=None):
+        self.files = dict(files or {})
+        self.folders = {'/'}
+        self.on_read = on_read
+
+    def stat(self, path):
+        attributes = SFTPAttributes()
+        if path in self.folders:
+            attributes.st_mode = stat.S_IFDIR | 0o755
+            attributes.st_size = 0
+        elif path in self.files:
+            attributes.st_mode = stat.S_IFREG | 0o644
+            attributes.st_size = len(self.files[path])
+        else:
+            raise FileNotFoundError(path)
+        attributes.st_mtime = 0
+        return attributes
+
+    def mkdir(self, path):
+        self.folders.add(path)
+
+    def open(self, path, mode='rb'):
+        if 'r' in mode:
+            if path not in self.files:
+                raise FileNotFoundError(path)
+            return FakeFile(self, path, self.files[path])
+        return FakeFile(self, path)
+
+    def remove(self, path):
+        del self.files[path]
+
+    def close(self):
+        pass
+
+class FakeFile(io.BytesIO):
+    """File opened on a FakeSFTP; written contents are stored when it is closed"""
+
+    def __init__(self, sftp, path, data=None):
+        super().__init__(data or b'')
+        self.sftp = sftp
+        self.path = path
+        self.writing = data is None
+
+    def read(self, size=-1):
+        if self.sftp.on_read is not None:
+            self.sftp.on_read(self.path)
+        return super().read(size)
+
+    def close(self):
+        if self.writing and not self.closed:
+            self.sftp.files[self.path] = self.getvalue()
+        super().close()
+
+class FakeSSH:
+    def close(self):
+        pass
+
+class QueueTestCase(TestCase):
+    """Servers, files and a fake SFTP connection shared by the queue tests"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.source = ServerConfig.objects.create(
+            name='source', host='source.example', username='backup', remote_path='/data',
+            server_type='source', user=self.user
+        )
+        self.destination = ServerConfig.objects.create(
+            name='destination', host='destination.example', username='backup', remote_path='/backup',
+            server_type='destination', user=self.user
+        )
+        self.sftp = {
+            self.source.pk: FakeSFTP({'/data/report.csv': b'a,b\n1,2\n'}),
+            self.destination.pk: FakeSFTP(),
+        }
+        patcher = mock.patch(
+            'backup_app.utils.sftp_connect',
+            side_effect=lambda server_config: (FakeSSH(), self.sftp[server_config.pk])
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_file(self, filename='report.csv'):
+        return BackupFile.objects.create(
+            filename=filename,
+            file_size=8,
+            source_path=f'/data/{filename}',
+            destination_path=f'/backup/{filename}',
+            source_server=self.source,
+            destination_server=self.destination,
+            user=self.user
+        )
+
+    def expire(self, job):
+        """Let a job's lease run out, as if its worker had died"""
+        TransferJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+class TransferQueueTests(QueueTestCase):
+
+    def test_only_one_owner_claims_a_job(self):
+        job = enqueue_transfer(self.make_file())
+
+        first = claim_jobs('worker-a')
+        second = claim_jobs('worker-b')
+
+        self.assertEqual([claimed.pk for claimed in first], [job.pk])
+        self.assertEqual(second, [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.LEASED)
+        self.assertEqual(job.lease_owner, 'worker-a')
+        self.assertEqual(job.attempts, 1)
+
+    def test_expired_lease_is_reclaimed(self):
+        job = enqueue_transfer(self.make_file())
+        claim_jobs('worker-a')
+        self.assertEqual(claim_jobs('worker-b'), [])
+
+        self.expire(job)
+        reclaimed = claim_jobs('worker-b')
+
+        self.assertEqual([claimed.pk for claimed in reclaimed], [job.pk])
+        job.refresh_from_db()
+        self.assertEqual(job.lease_owner, 'worker-b')
+        self.assertEqual(job.attempts, 2)
+
+    def test_renew_leases_raises_after_takeover(self):
+        job = enqueue_transfer(self.make_file())
+        [leased] = claim_jobs('worker-a')
+        renew_leases([leased], 'worker-a')
+
+        self.expire(job)
+        claim_jobs('worker-b')
+
+        with self.assertRaises(LeaseLost):
+            renew_leases([leased], 'worker-a')
+        with self.assertRaises(LeaseLost):
+            renew_lease(leased, 'worker-a')
+        # The old owner's outcome is ignored as well
+        self.assertEqual(finish_job(leased, 'worker-a', True, 'done'), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.LEASED)
+        self.assertEqual(job.lease_owner, 'worker-b')
+
+    def test_execute_job_copies_the_file(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+
+        success, result = execute_job(job, 'worker-a')
+
+        self.assertTrue(success, result)
+        self.assertEqual(self.sftp[self.destination.pk].files['/backup/report.csv'], b'a,b\n1,2\n')
+        backup_file.refresh_from_db()
+        self.assertEqual(backup_file.status, TransferStatus.SUCCESS)
+        self.assertIsNone(backup_file.transfer_owner)
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.DONE)
+
+class FileOwnershipTests(QueueTestCase):
+
+    def take_over(self, backup_file, owner='worker-b'):
+        """Acquire a file the way a worker that reclaimed its expired job does"""
+        job = TransferJob(backup_file=backup_file, user=self.user, attempts=2)
+        return acquire_files([job], owner)
+
+    def test_second_owner_cannot_acquire_running_file(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+
+        self.assertEqual(acquire_files([job], 'worker-a'), {backup_file.pk})
+        other = TransferJob(backup_file=backup_file, user=self.user, attempts=1)
+        self.assertEqual(acquire_files([other], 'worker-b'), set())
+
+        backup_file.refresh_from_db()
+        self.assertEqual(backup_file.status, TransferStatus.IN_PROGRESS)
+        self.assertEqual(backup_file.transfer_owner, 'worker-a')
+
+    def test_stale_owner_result_is_dropped(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+        acquire_files([job], 'worker-a')
+
+        self.assertEqual(self.take_over(backup_file), {backup_file.pk})
+        stale = job.backup_file
+        stale.status = TransferStatus.SUCCESS
+        self.assertEqual(store_results([stale], 'worker-a', ['status']), set())
+
+        backup_file.refresh_from_db()
+        self.assertEqual(backup_file.status, TransferStatus.IN_PROGRESS)
+        self.assertEqual(backup_file.transfer_owner, 'worker-b')
+        # The new owner still stores its own result
+        backup_file.status = TransferStatus.SUCCESS
+        self.assertEqual(store_results([backup_file], 'worker-b', ['status']), {backup_file.pk})
+
+    @override_settings(BACKUP_CANCEL_CHECK_SECONDS=0)
+    def test_cancellation_token_aborts_after_takeover(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+        acquire_files([job], 'worker-a')
+
+        with CancellationToken([backup_file.pk], 'worker-a') as token:
+            token.check(backup_file.pk)
+            self.take_over(backup_file)
+            with self.assertRaises(TransferAborted) as raised:
+                token.check(backup_file.pk)
+        # Taken over, not cancelled: the partial file is left to the new owner
+        self.assertNotIsInstance(raised.exception, TransferCancelled)
+
+    def test_cancellation_token_raises_when_cancelled(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+        acquire_files([job], 'worker-a')
+
+        with CancellationToken([backup_file.pk], 'worker-a') as token:
+            self.assertTrue(cancel_file_transfer(backup_file))
+            # Cancelled in this process, so the token hears of it without polling
+            token.request(backup_file.pk)
+            with self.assertRaises(TransferCancelled):
+                token.check(backup_file.pk)
+
+    @override_settings(BACKUP_CANCEL_CHECK_SECONDS=0)
+    def test_execute_job_discards_result_after_takeover(self):
+        backup_file = self.make_file()
+        enqueue_transfer(backup_file)
+        [job] = claim_jobs('worker-a')
+        self.sftp[self.source.pk].on_read = lambda path: self.take_over(backup_file)
+
+        success, result = execute_job(job, 'worker-a')
+
+        self.assertFalse(success)
+        self.assertEqual(result, LEASE_LOST)
+        backup_file.refresh_from_db()
+        self.assertEqual(backup_file.status, TransferStatus.IN_PROGRESS)
+        self.assertEqual(backup_file.transfer_owner, 'worker-b')
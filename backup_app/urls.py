@@ -20,6 +20,7 @@ urlpatterns = [
     path('servers/<int:server_id>/edit/', config_views.edit_server, name='edit_server'),
     path('servers/<int:server_id>/delete/', config_views.delete_server, name='delete_server'),
     path('servers/<int:server_id>/test/', config_views.test_server_connection, name='test_server_connection'),
+    path('servers/<int:server_id>/listing/', config_views.server_listing, name='server_listing'),
     
     # Schedule Configuration URLs
     path('schedules/', config_views.schedule_list, name='schedule_list'),
@@ -27,10 +28,13 @@ urlpatterns = [
     path('schedules/<int:schedule_id>/edit/', config_views.edit_schedule, name='edit_schedule'),
     path('schedules/<int:schedule_id>/delete/', config_views.delete_schedule, name='delete_schedule'),
     path('schedules/<int:schedule_id>/toggle/', config_views.toggle_schedule, name='toggle_schedule'),
+    path('schedules/runs/<int:run_id>/', config_views.schedule_run_status, name='schedule_run_status'),
+    path('schedules/leader/', config_views.scheduler_status, name='scheduler_status'),
     
     # Transfer URLs
     path('scan/', transfer_views.scan_files, name='scan_files'),
     path('transfer/all/', transfer_views.initiate_transfer_all, name='initiate_transfer_all'),
     path('transfer/<int:file_id>/process/', transfer_views.process_transfer, name='process_transfer'),
     path('retry/', transfer_views.retry_failed, name='retry_failed'),
+    path('transfer/batches/<int:batch_id>/', transfer_views.transfer_batch_status, name='transfer_batch_status'),
 ]
\ No newline at end of file
@@ -2,36 +2,27 @@ import logging
 import paramiko
 import io
 import os
+from collections import namedtuple
 from datetime import datetime
 from stat import S_ISREG, S_ISDIR
 from .models import TransferLog
+from .limits import SlotSSHClient, connection_slots
+from .breaker import check_circuit, record_connection_failure, record_connection_success
 
 # Set up logger
 logger = logging.getLogger(__name__)
 
-def calculate_folder_size(sftp, folder_path):
-    """
-    Recursively calculate total size of all files in a folder on remote server
-    
-    Args:
-        sftp: active SFTP client connection
-        folder_path: remote folder path string
-    
-    Returns:
-        int: total size in bytes
-    """
-    total_size = 0
-    try:
-        items = sftp.listdir_attr(folder_path)
-        for item in items:
-            item_path = os.path.join(folder_path, item.filename).replace('\\', '/')
-            if S_ISREG(item.st_mode):
-                total_size += item.st_size
-            elif S_ISDIR(item.st_mode):
-                total_size += calculate_folder_size(sftp, item_path)
-    except Exception as e:
-        logger.error(f"Error calculating folder size for {folder_path}: {str(e)}")
-    return total_size
+# Number of scanned entries handed to consumers at a time
+SCAN_CHUNK_SIZE = 500
+
+# Size of the chunks streamed from source to destination
+COPY_BUFFER_SIZE = 1048576  # 1 MB buffer
+
+class TransferAborted(Exception):
+    """Raised from a progress callback to stop a transfer part-way through"""
+
+class TransferCancelled(TransferAborted):
+    """Raised by a cancellation check when the user cancelled the transfer"""
 
 def sftp_connect(server_config):
     """
@@ -41,11 +32,18 @@ def sftp_connect(server_config):
         server_config: ServerConfig model instance with connection details
         
     Returns:
-        tuple: (ssh_client, sftp_client) - Both open connections to be closed by caller
+        tuple: (ssh_client, sftp_client) - Both open connections to be closed by caller;
+        closing ssh_client frees the server's connection slot
+
+    Raises:
+        CircuitOpen: if the server's circuit breaker is open (see breaker.py)
     """
+    # Fail fast instead of waiting out the connect timeout of a host that is down
+    check_circuit(server_config)
+    
+    # Wait for a free session slot on the server (see ConnectionLimiter)
+    ssh = SlotSSHClient(connection_slots.acquire(server_config))
     try:
-        # Create SSH client
-        ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         
         # Authentication method depends on config
@@ -74,15 +72,117 @@ def sftp_connect(server_config):
         sftp = ssh.open_sftp()
         
         logger.debug(f"Successfully connected to {server_config.host}")
+        record_connection_success(server_config)
         return ssh, sftp
         
     except Exception as e:
+        ssh.close()
+        record_connection_failure(server_config)
         logger.error(f"Failed to connect to {server_config.host}: {str(e)}")
         raise RuntimeError(f"SFTP connection failed: {str(e)}")
 
+class RemoteEntry(namedtuple('RemoteEntry', ['filename', 'size', 'mtime', 'atime', 'mode'])):
+    """
+    Compact description of a single remote directory entry
+
+    Timestamps are kept as raw epoch seconds so that large listings do not
+    allocate a datetime object per entry; convert lazily when needed.
+    """
+    __slots__ = ()
+
+    @property
+    def is_folder(self):
+        return S_ISDIR(self.mode)
+
+    @property
+    def modified_at(self):
+        return datetime.fromtimestamp(self.mtime)
+
+    @property
+    def created_at(self):
+        try:
+            return datetime.fromtimestamp(self.atime)
+        except (TypeError, OSError):
+            return self.modified_at
+
+    def as_dict(self):
+        """Return the entry in the dictionary format used by list_files_on_server"""
+        return {
+            'filename': self.filename,
+            'size': self.size,
+            'modified_at': self.modified_at,
+            'created_at': self.created_at,
+            'is_folder': self.is_folder
+        }
+
+def iter_remote_dir(sftp, path, include_folders=False):
+    """
+    Lazily list a remote directory, yielding RemoteEntry tuples
+
+    Uses listdir_iter so entries are produced as the server returns them
+    instead of after the whole directory has been read.
+
+    Args:
+        sftp: active SFTP client connection
+        path: remote directory path
+        include_folders: If True, also yield sub-directories
+    """
+    for attr in sftp.listdir_iter(path):
+        if attr.st_mode is None:
+            continue
+        if S_ISREG(attr.st_mode):
+            yield RemoteEntry(attr.filename, attr.st_size, attr.st_mtime, attr.st_atime, attr.st_mode)
+        elif include_folders and S_ISDIR(attr.st_mode):
+            logger.debug(f"Found folder: {attr.filename}")
+            yield RemoteEntry(attr.filename, 0, attr.st_mtime, attr.st_atime, attr.st_mode)
+
+def iter_files_on_server(server_config, include_folders=False):
+    """
+    Stream the files (and optionally folders) in the configured remote path
+
+    Args:
+        server_config: ServerConfig model instance
+        include_folders: If True, also include folders in the result
+
+    Yields:
+        RemoteEntry: one entry per file/folder, in server order
+    """
+    ssh, sftp = sftp_connect(server_config)
+    try:
+        yield from iter_remote_dir(sftp, server_config.remote_path, include_folders=include_folders)
+    except Exception as e:
+        logger.error(f"Error listing files on {server_config.host}: {str(e)}")
+        raise RuntimeError(f"Failed to list files: {str(e)}")
+    finally:
+        sftp.close()
+        ssh.close()
+
+def iter_chunks(iterable, size=SCAN_CHUNK_SIZE):
+    """
+    Group an iterable into lists of at most `size` items
+
+    Args:
+        iterable: any iterable, typically a streaming scan
+        size: maximum number of items per chunk
+
+    Yields:
+        list: the next chunk of items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 def list_files_on_server(server_config, include_folders=False):
     """
     List all files and optionally folders in the specified remote path
+
+    Materialises the whole listing; prefer iter_files_on_server for large
+    directories.
     
     Args:
         server_config: ServerConfig model instance
@@ -91,78 +191,120 @@ def list_files_on_server(server_config, include_folders=False):
     Returns:
         list: List of dictionaries with file/folder information
     """
-    ssh = None
-    sftp = None
+    return [entry.as_dict() for entry in iter_files_on_server(server_config, include_folders=include_folders)]
+
+class LineEndingNormalizer:
+    """
+    Streaming CRLF to LF conversion applied to each chunk of a copy
+
+    A CR at the end of a chunk is held back until the next chunk shows whether
+    it starts a CRLF pair, so pairs split across chunk boundaries are still
+    converted. Lone CRs are preserved. Files whose first chunk contains a NUL
+    byte are treated as binary and passed through untouched.
+    """
+
+    def __init__(self):
+        self._pending_cr = False
+        self._binary = None
+
+    def __call__(self, chunk):
+        if self._binary is None:
+            self._binary = b'\x00' in chunk
+        if self._binary:
+            return chunk
+        
+        if self._pending_cr:
+            chunk = b'\r' + chunk
+            self._pending_cr = False
+        if chunk.endswith(b'\r'):
+            chunk = chunk[:-1]
+            self._pending_cr = True
+        return chunk.replace(b'\r\n', b'\n')
+
+    def flush(self):
+        """Return any data still held back once the source is exhausted"""
+        if self._pending_cr:
+            self._pending_cr = False
+            return b'\r'
+        return b''
+
+def get_transfer_transform(backup_file):
+    """Return a fresh streaming transform for a file transfer, or None for a plain copy"""
+    if backup_file.normalize_line_endings:
+        return LineEndingNormalizer()
+    return None
+
+def copy_stream(source_file, dest_file, transform=None, buffer_size=COPY_BUFFER_SIZE, progress=None, cancel=None):
+    """
+    Stream data from an open source file to an open destination file
+    
+    Args:
+        source_file: readable file-like object
+        dest_file: writable file-like object
+        transform: optional callable applied to each chunk, with a flush() method
+            returning any trailing data
+        buffer_size: number of bytes read per chunk
+        progress: optional callable invoked with the number of bytes written after
+            each chunk; it may raise TransferAborted to stop the copy
+        cancel: optional callable invoked after each chunk, before `progress`;
+            it raises TransferCancelled once the transfer was cancelled
+        
+    Returns:
+        int: number of bytes written to the destination
+    """
+    total_transferred = 0
+    buffer = source_file.read(buffer_size)
+    
+    # Stream data directly from source to destination
+    while buffer:
+        if transform:
+            buffer = transform(buffer)
+        dest_file.write(buffer)
+        total_transferred += len(buffer)
+        if cancel:
+            cancel()
+        if progress:
+            progress(len(buffer))
+        buffer = source_file.read(buffer_size)
+    
+    if transform:
+        tail = transform.flush()
+        if tail:
+            dest_file.write(tail)
+            total_transferred += len(tail)
+    
+    return total_transferred
+
+def cancel_check(cancel, backup_file):
+    """Per-chunk cancellation check of one BackupFile for copy_stream, or None without a token"""
+    if cancel is None:
+        return None
+    return lambda: cancel.check(backup_file.pk)
+
+def remove_partial_file(sftp, remote_path):
+    """Delete a destination file left incomplete by a cancelled transfer"""
     try:
-        # Establish SFTP connection
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        if server_config.private_key:
-            private_key = io.StringIO(server_config.private_key)
-            pkey = paramiko.RSAKey.from_private_key(private_key)
-            ssh.connect(
-                hostname=server_config.host,
-                port=server_config.port,
-                username=server_config.username,
-                pkey=pkey,
-                timeout=30
-            )
-        else:
-            ssh.connect(
-                hostname=server_config.host,
-                port=server_config.port,
-                username=server_config.username,
-                password=server_config.password,
-                timeout=30
-            )
-        sftp = ssh.open_sftp()
-        sftp.chdir(server_config.remote_path)
-        file_list = []
-        for entry in sftp.listdir_attr():
-            if S_ISREG(entry.st_mode):
-                file_info = {
-                    'filename': entry.filename,
-                    'size': entry.st_size,
-                    'modified_at': datetime.fromtimestamp(entry.st_mtime),
-                    'is_folder': False
-                }
-                try:
-                    file_info['created_at'] = datetime.fromtimestamp(entry.st_atime)
-                except (AttributeError, OSError):
-                    file_info['created_at'] = file_info['modified_at']
-                file_list.append(file_info)
-            elif include_folders and S_ISDIR(entry.st_mode):
-                folder_info = {
-                    'filename': entry.filename,
-                    'size': 0,
-                    'modified_at': datetime.fromtimestamp(entry.st_mtime),
-                    'is_folder': True
-                }
-                try:
-                    folder_info['created_at'] = datetime.fromtimestamp(entry.st_atime)
-                except (AttributeError, OSError):
-                    folder_info['created_at'] = folder_info['modified_at']
-                file_list.append(folder_info)
-                logger.debug(f"Found folder: {entry.filename}")
-        return file_list
+        sftp.remove(remote_path)
+        logger.info(f"Removed partial file {remote_path}")
     except Exception as e:
-        logger.error(f"Error listing files on {server_config.host}: {str(e)}")
-        raise RuntimeError(f"Failed to list files: {str(e)}")
-    finally:
-        if sftp:
-            sftp.close()
-        if ssh:
-            ssh.close()
+        logger.warning(f"Could not remove partial file {remote_path}: {str(e)}")
 
-def transfer_file(backup_file):
+def transfer_file(backup_file, progress=None, cancel=None):
     """
     Transfer a file or folder from source to destination server
     
     Args:
         backup_file: BackupFile model instance with transfer details
+        progress: optional callable invoked with the number of bytes written after
+            each chunk; raising TransferAborted from it fails the whole transfer
+        cancel: optional CancellationToken checked after each chunk
         
     Returns:
         tuple: (success, message) - Boolean indicating success and a message
+        
+    Raises:
+        TransferCancelled: if the transfer was cancelled; the partial
+            destination file is removed and the sessions are closed
     """
     source_ssh = None
     source_sftp = None
@@ -171,7 +313,7 @@ def transfer_file(backup_file):
     
     # Handle different transfer modes based on whether it's a folder or file
     if backup_file.is_folder:
-        return transfer_folder(backup_file)
+        return transfer_folder(backup_file, progress=progress, cancel=cancel)
     
     # Removed hardcoded path override for Python files to avoid path mismatches
     
@@ -194,23 +336,21 @@ def transfer_file(backup_file):
         with source_sftp.open(backup_file.source_path, 'rb') as source_file:
             # Open destination file for writing
             with dest_sftp.open(backup_file.destination_path, 'wb') as dest_file:
-                # Initialize buffer for streaming data
-                buffer_size = 1048576  # 1 MB buffer
-                buffer = source_file.read(buffer_size)
-                
-                # Track transfer progress
-                total_transferred = 0
-                
-                # Stream data directly from source to destination
-                while buffer:
-                    dest_file.write(buffer)
-                    total_transferred += len(buffer)
-                    buffer = source_file.read(buffer_size)
+                total_transferred = copy_stream(
+                    source_file,
+                    dest_file,
+                    get_transfer_transform(backup_file),
+                    progress=progress,
+                    cancel=cancel_check(cancel, backup_file)
+                )
         
         success_message = f"Successfully transferred file {backup_file.filename} ({total_transferred} bytes)"
         logger.info(success_message)
         return True, success_message
         
+    except TransferCancelled:
+        remove_partial_file(dest_sftp, backup_file.destination_path)
+        raise
     except Exception as e:
         error_message = f"Transfer failed: {str(e)}"
         logger.error(f"Error transferring file {backup_file.filename}: {str(e)}")
@@ -227,15 +367,102 @@ def transfer_file(backup_file):
         if dest_ssh:
             dest_ssh.close()
 
-def transfer_folder(backup_file):
+def transfer_files(backup_files, progress=None, cancel=None):
+    """
+    Transfer several small files between the same two servers over one session
+
+    Opening the SSH sessions dominates the cost of a tiny file, so a batch
+    connects to the source and destination once and copies every file over
+    the same pair of SFTP channels. A failing file does not stop the rest.
+
+    Args:
+        backup_files: BackupFiles (not folders) sharing source and destination servers
+        progress: optional callable invoked with the number of bytes written after
+            each chunk; raising TransferAborted from it stops the whole batch
+        cancel: optional CancellationToken checked after each chunk; a
+            cancelled file is removed from the destination and the rest go on
+
+    Returns:
+        dict: BackupFile id -> (success, message)
+    """
+    source_ssh = None
+    source_sftp = None
+    dest_ssh = None
+    dest_sftp = None
+    results = {}
+
+    try:
+        try:
+            source_ssh, source_sftp = sftp_connect(backup_files[0].source_server)
+            dest_ssh, dest_sftp = sftp_connect(backup_files[0].destination_server)
+        except Exception as e:
+            return {backup_file.pk: (False, f"Transfer failed: {str(e)}") for backup_file in backup_files}
+
+        known_dirs = set()
+        for backup_file in backup_files:
+            try:
+                # Ensure destination directory exists, once per directory
+                dest_dir = os.path.dirname(backup_file.destination_path)
+                if dest_dir not in known_dirs:
+                    try:
+                        dest_sftp.stat(dest_dir)
+                    except FileNotFoundError:
+                        makedirs_remote(dest_sftp, dest_dir)
+                    known_dirs.add(dest_dir)
+
+                with source_sftp.open(backup_file.source_path, 'rb') as source_file:
+                    with dest_sftp.open(backup_file.destination_path, 'wb') as dest_file:
+                        total_transferred = copy_stream(
+                            source_file,
+                            dest_file,
+                            get_transfer_transform(backup_file),
+                            progress=progress,
+                            cancel=cancel_check(cancel, backup_file)
+                        )
+                results[backup_file.pk] = (
+                    True,
+                    f"Successfully transferred file {backup_file.filename} ({total_transferred} bytes)"
+                )
+            except TransferCancelled as e:
+                remove_partial_file(dest_sftp, backup_file.destination_path)
+                results[backup_file.pk] = (False, str(e))
+            except TransferAborted:
+                raise
+            except Exception as e:
+                logger.error(f"Error transferring file {backup_file.filename}: {str(e)}")
+                results[backup_file.pk] = (False, f"Transfer failed: {str(e)}")
+
+        logger.info(f"Transferred {sum(1 for success, _ in results.values() if success)} of "
+                    f"{len(backup_files)} small files in one session")
+        return results
+
+    finally:
+        # Close all connections
+        if source_sftp:
+            source_sftp.close()
+        if source_ssh:
+            source_ssh.close()
+        if dest_sftp:
+            dest_sftp.close()
+        if dest_ssh:
+            dest_ssh.close()
+
+def transfer_folder(backup_file, progress=None, cancel=None):
     """
     Transfer an entire folder from source to destination server
     
     Args:
         backup_file: BackupFile model instance with folder transfer details
+        progress: optional callable invoked with the number of bytes written after
+            each chunk; raising TransferAborted from it fails the whole transfer
+        cancel: optional CancellationToken checked after each chunk
         
     Returns:
         tuple: (success, message) - Boolean indicating success and a message
+        
+    Raises:
+        TransferCancelled: if the transfer was cancelled; the file being
+            copied is removed, files completed before it are kept
     """
     source_ssh = None
     source_sftp = None
@@ -258,73 +485,81 @@ def transfer_folder(backup_file):
             makedirs_remote(dest_sftp, dest_folder_path)
             
         # Get source path to traverse
-        source_folder_path = backup_file.source_path
+        from .snapshots import walk_tree, normalize_remote_path
+        from .filters import ScanFilter
+        source_folder_path = normalize_remote_path(backup_file.source_path)
+        dest_folder_path = normalize_remote_path(dest_folder_path)
         
         # Process files and folders recursively
         transferred_files = 0
-        total_bytes = 0
+        transferred_bytes = 0
         errors = []
         
-        def transfer_recursive(src_path, dest_path):
-            nonlocal transferred_files, total_bytes, errors
+        # A single tree walk drives the copy and computes the folder totals,
+        # re-listing only directories that changed since the last scan
+        tree = walk_tree(
+            source_sftp,
+            backup_file.source_server,
+            source_folder_path,
+            errors=errors,
+            scan_filter=ScanFilter.from_dict(backup_file.scan_filter)
+        )
+        while True:
             try:
-                items = source_sftp.listdir_attr(src_path)
-                logger.debug(f"Listing directory {src_path} with {len(items)} items")
-                for item in items:
-                    src_item_path = os.path.join(src_path, item.filename).replace('\\', '/')
-                    dest_item_path = os.path.join(dest_path, item.filename).replace('\\', '/')
-                    
-                    if not hasattr(item, 'st_mode'):
-                        logger.warning(f"Skipping item {item.filename} - cannot determine type")
-                        continue
-                    
-                    if S_ISREG(item.st_mode):
-                        try:
-                            dest_dir = os.path.dirname(dest_item_path)
-                            try:
-                                dest_sftp.stat(dest_dir)
-                            except FileNotFoundError:
-                                makedirs_remote(dest_sftp, dest_dir)
-                            
-                            with source_sftp.open(src_item_path, 'rb') as src_file:
-                                with dest_sftp.open(dest_item_path, 'wb') as dest_file:
-                                    buffer_size = 1048576  # 1 MB buffer
-                                    buffer = src_file.read(buffer_size)
-                                    file_size = 0
-                                    
-                                    while buffer:
-                                        dest_file.write(buffer)
-                                        file_size += len(buffer)
-                                        buffer = src_file.read(buffer_size)
-                            
-                            transferred_files += 1
-                            total_bytes += file_size
-                            logger.info(f"Transferred file: {src_item_path} -> {dest_item_path} ({file_size} bytes)")
-                        except Exception as e:
-                            error_msg = f"Error transferring file {src_item_path}: {str(e)}"
-                            logger.error(error_msg)
-                            errors.append(error_msg)
-                    elif S_ISDIR(item.st_mode):
-                        try:
-                            dest_sftp.stat(dest_item_path)
-                        except FileNotFoundError:
-                            makedirs_remote(dest_sftp, dest_item_path)
-                        transfer_recursive(src_item_path, dest_item_path)
-                    else:
-                        logger.debug(f"Unknown file type for {src_item_path}, skipping")
+                parent_path, item = next(tree)
+            except StopIteration as stop:
+                total_bytes, total_files = stop.value
+                break
+            
+            relative_dir = parent_path[len(source_folder_path):]
+            src_item_path = f"{parent_path.rstrip('/')}/{item.filename}"
+            dest_item_path = f"{(dest_folder_path + relative_dir).rstrip('/')}/{item.filename}"
+            
+            if item.is_folder:
+                try:
+                    dest_sftp.stat(dest_item_path)
+                except FileNotFoundError:
+                    makedirs_remote(dest_sftp, dest_item_path)
+                continue
+            
+            try:
+                dest_dir = os.path.dirname(dest_item_path)
+                try:
+                    dest_sftp.stat(dest_dir)
+                except FileNotFoundError:
+                    makedirs_remote(dest_sftp, dest_dir)
+                
+                with source_sftp.open(src_item_path, 'rb') as src_file:
+                    with dest_sftp.open(dest_item_path, 'wb') as dest_file:
+                        file_size = copy_stream(
+                            src_file,
+                            dest_file,
+                            get_transfer_transform(backup_file),
+                            progress=progress,
+                            cancel=cancel_check(cancel, backup_file)
+                        )
+                
+                transferred_files += 1
+                transferred_bytes += file_size
+                logger.info(f"Transferred file: {src_item_path} -> {dest_item_path} ({file_size} bytes)")
+            except TransferCancelled:
+                remove_partial_file(dest_sftp, dest_item_path)
+                raise
+            except TransferAborted:
+                raise
             except Exception as e:
-                error_msg = f"Error listing directory {src_path}: {str(e)}"
+                error_msg = f"Error transferring file {src_item_path}: {str(e)}"
                 logger.error(error_msg)
                 errors.append(error_msg)
         
-        transfer_recursive(source_folder_path, dest_folder_path)
-        
-        backup_file.files_count = transferred_files
+        # Folder totals come from the walk itself, so they are also cached for
+        # later scans and size lookups of this tree
+        backup_file.files_count = total_files
         backup_file.file_size = total_bytes
-        backup_file.save()
+        backup_file.save(update_fields=['files_count', 'file_size', 'updated_at'])
         
         if errors:
-            error_summary = f"Transferred {transferred_files} files ({total_bytes} bytes) with {len(errors)} errors"
+            error_summary = f"Transferred {transferred_files} of {total_files} files ({transferred_bytes} of {total_bytes} bytes) with {len(errors)} errors"
             if len(errors) <= 3:
                 error_detail = ". Errors: " + "; ".join(errors)
                 error_summary += error_detail
@@ -336,9 +571,11 @@ def transfer_folder(backup_file):
             else:
                 return False, error_summary
         else:
-            success_message = f"Successfully transferred folder {backup_file.filename} ({transferred_files} files, {total_bytes} bytes)"
+            success_message = f"Successfully transferred folder {backup_file.filename} ({transferred_files} files, {transferred_bytes} bytes)"
             logger.info(success_message)
             return True, success_message
+    except TransferCancelled:
+        raise
     except Exception as e:
         error_message = f"Folder transfer failed: {str(e)}"
         logger.error(f"Error transferring folder {backup_file.filename}: {str(e)}")
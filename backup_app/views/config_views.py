@@ -3,17 +3,25 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.urls import reverse
-from ..models import ServerConfig, ScheduleConfig, BackupFile
+from ..models import ServerConfig, ScheduleConfig, ScheduleRun, BackupFile
 from ..forms import ServerConfigForm, ScheduleConfigForm
-from ..utils import list_files_on_server
+from ..snapshots import ScanInProgress, iter_server_listing, get_cached_listing, normalize_remote_path
+from ..jobs import enqueue_schedule_run
+from ..breaker import get_server_breaker_state
+from ..leader import get_leader
+from ..scheduler import SCHEDULER_ROLE, is_scheduler_leader
 import os
 
 @login_required
 def server_list(request):
     """View all server configurations"""
     # Get all servers for the current user
-    source_servers = ServerConfig.objects.filter(user=request.user, server_type='source')
-    destination_servers = ServerConfig.objects.filter(user=request.user, server_type='destination')
+    source_servers = list(ServerConfig.objects.filter(user=request.user, server_type='source').select_related('state'))
+    destination_servers = list(ServerConfig.objects.filter(user=request.user, server_type='destination').select_related('state'))
+    
+    # Circuit breaker state per server: closed, open or half_open
+    for server in source_servers + destination_servers:
+        server.breaker_state = get_server_breaker_state(server)
     
     context = {
         'title': 'Server Configurations',
@@ -175,19 +183,75 @@ def test_server_connection(request, server_id):
     server = get_object_or_404(ServerConfig, id=server_id, user=request.user)
     
     try:
-        # Try to list files and folders on the server
-        files = list_files_on_server(server, include_folders=True)
+        # Try to list files and folders on the server, counting them as they stream in
+        entries_count = sum(1 for _ in iter_server_listing(server, include_folders=True, share=False))
         
         # Return success message with file and folder count
         return JsonResponse({
             'success': True, 
-            'message': f'Connection successful! Found {len(files)} files and folders in the remote directory.'
+            'message': f'Connection successful! Found {entries_count} files and folders in the remote directory.'
         })
         
     except Exception as e:
         # Return error message
         return JsonResponse({'error': str(e)}, status=400)
 
+@login_required
+def server_listing(request, server_id):
+    """Return the last known listing of a server's remote path, rescanning only when stale"""
+    # Get the server or return 404
+    server = get_object_or_404(ServerConfig, id=server_id, user=request.user)
+    
+    # Serve the snapshot instantly while it is within the TTL, unless a refresh is requested
+    snapshot = None
+    if request.GET.get('refresh') != 'true':
+        snapshot = get_cached_listing(server)
+    cached = snapshot is not None
+    
+    try:
+        if not cached:
+            # Incremental rescan; only re-lists the directory if its mtime changed
+            listing = iter_server_listing(
+                server, include_folders=True, share=request.GET.get('refresh') != 'true', wait=False
+            )
+            for _ in listing:
+                pass
+            snapshot = get_cached_listing(server)
+    except ScanInProgress as e:
+        return JsonResponse({'error': str(e), 'scanning': True}, status=409)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if snapshot is None:
+        return JsonResponse({'error': f'No listing available for {normalize_remote_path(server.remote_path)}'}, status=400)
+    
+    # Page through the entries so huge directories don't produce huge responses
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', 500)), 1), 5000)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset or limit'}, status=400)
+    
+    entries = snapshot.entries.order_by('filename')[offset:offset + limit]
+    
+    return JsonResponse({
+        'success': True,
+        'cached': cached,
+        'path': snapshot.path,
+        'scanned_at': snapshot.scanned_at.isoformat(),
+        'total': snapshot.entries.count(),
+        'offset': offset,
+        'entries': [
+            {
+                'filename': entry.filename,
+                'size': entry.size,
+                'mtime': entry.mtime,
+                'mode': entry.mode,
+            }
+            for entry in entries
+        ],
+    })
+
 @login_required
 def schedule_list(request):
     """View all schedule configurations"""
@@ -214,11 +278,12 @@ def add_schedule(request):
             # Save the schedule to DB
             schedule.save()
             
-            # Trigger initial scan and transfer immediately after adding schedule
-            from backup_app.scheduler import scan_and_transfer_files
-            scan_and_transfer_files(schedule.id)
-            
             messages.success(request, f'Schedule {schedule.name} has been added!')
+            
+            # Queue the initial scan and transfer for a worker instead of running it in the request
+            if schedule.enabled:
+                run = enqueue_schedule_run(schedule, trigger='created')
+                messages.info(request, f'Initial scan queued as run #{run.pk}.')
             return redirect('schedule_list')
     else:
         form = ScheduleConfigForm(user=request.user)
@@ -285,11 +350,49 @@ def toggle_schedule(request, schedule_id):
     schedule.enabled = not schedule.enabled
     schedule.save()
     
-    # Trigger initial scan and transfer immediately after enabling schedule
-    if schedule.enabled:
-        from backup_app.scheduler import scan_and_transfer_files
-        scan_and_transfer_files(schedule.id)
-    
     status = 'enabled' if schedule.enabled else 'disabled'
+    response = {'success': True, 'message': f'Schedule {schedule.name} has been {status}', 'enabled': schedule.enabled}
     
-    return JsonResponse({'success': True, 'message': f'Schedule {schedule.name} has been {status}', 'enabled': schedule.enabled})
+    # Queue an immediate scan and transfer after enabling; the UI polls the run for progress
+    if schedule.enabled:
+        run = enqueue_schedule_run(schedule, trigger='enabled')
+        response['run_id'] = run.pk
+        response['status_url'] = reverse('schedule_run_status', args=[run.pk])
+    
+    return JsonResponse(response)
+
+@login_required
+def schedule_run_status(request, run_id):
+    """Report the progress of a queued or running schedule run"""
+    # Get the run or return 404
+    run = get_object_or_404(ScheduleRun.objects.select_related('schedule'), id=run_id, schedule__user=request.user)
+    
+    return JsonResponse({
+        'id': run.pk,
+        'schedule_id': run.schedule_id,
+        'schedule': run.schedule.name,
+        'trigger': run.trigger,
+        'status': run.status,
+        'status_display': run.get_status_display(),
+        'finished': run.finished_at is not None,
+        'scanned_count': run.scanned_count,
+        'registered_count': run.registered_count,
+        'queued_count': run.queued_count,
+        'result': run.result,
+        'created_at': run.created_at.isoformat(),
+        'started_at': run.started_at.isoformat() if run.started_at else None,
+        'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+    })
+
+@login_required
+def scheduler_status(request):
+    """Report which process currently runs the scheduler"""
+    leader = get_leader(SCHEDULER_ROLE)
+    
+    return JsonResponse({
+        'leader': leader.holder if leader else None,
+        'acquired_at': leader.acquired_at.isoformat() if leader else None,
+        'heartbeat_at': leader.heartbeat_at.isoformat() if leader else None,
+        'expires_at': leader.expires_at.isoformat() if leader else None,
+        'this_process': is_scheduler_leader(),
+    })
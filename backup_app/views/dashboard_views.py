@@ -1,10 +1,12 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.http import JsonResponse
 from django.urls import reverse
 from ..models import ServerConfig, BackupFile, TransferLog, ScheduleConfig, TransferStatus
+from ..jobs import enqueue_transfer
+from ..cancellation import CANCELLABLE, cancel_file_transfer
 
 @login_required
 def dashboard(request):
@@ -16,6 +18,10 @@ def dashboard(request):
     success_count = BackupFile.objects.filter(user=request.user, status=TransferStatus.SUCCESS).count()
     failed_count = BackupFile.objects.filter(user=request.user, status=TransferStatus.FAILED).count()
     retrying_count = BackupFile.objects.filter(user=request.user, status=TransferStatus.RETRYING).count()
+    dead_letter_count = BackupFile.objects.filter(user=request.user, status=TransferStatus.DEAD_LETTER).count()
+    
+    # Total backup size; folder sizes are computed once during the scan/transfer walk
+    total_size = BackupFile.objects.filter(user=request.user).aggregate(total=Sum('file_size'))['total'] or 0
     
     # Get recent transfers (last 5)
     recent_transfers = BackupFile.objects.filter(user=request.user).order_by('-updated_at')[:5]
@@ -34,6 +40,8 @@ def dashboard(request):
         'success_count': success_count,
         'failed_count': failed_count,
         'retrying_count': retrying_count,
+        'dead_letter_count': dead_letter_count,
+        'total_size': total_size,
         'recent_transfers': recent_transfers,
         'servers_count': servers_count,
         'schedules_count': schedules_count,
@@ -115,21 +123,11 @@ def initiate_transfer(request, file_id):
     if backup_file.status in [TransferStatus.IN_PROGRESS, TransferStatus.RETRYING]:
         return JsonResponse({'error': 'Transfer already in progress'}, status=400)
     
-    # Update status to in_progress
-    backup_file.status = TransferStatus.IN_PROGRESS
-    backup_file.save()
-    
-    # Log the manual transfer initiation
-    log = TransferLog(
-        backup_file=backup_file,
-        action='transfer_initiated',
-        message='Manual transfer initiated by user'
-    )
-    log.save()
-    
-    # Queue the transfer (in a real app, this might be a background task)
-    # For now, we'll just redirect and let the view handle the transfer
-    return JsonResponse({'success': True, 'message': 'Transfer initiated', 'redirect': reverse('file_detail', args=[file_id])})
+    # Queue the transfer; a worker moves it to in progress when it starts
+    if enqueue_transfer(backup_file, message='Manual transfer initiated by user') is None:
+        return JsonResponse({'error': 'Transfer already queued'}, status=400)
+    
+    return JsonResponse({'success': True, 'message': 'Transfer queued', 'redirect': reverse('file_detail', args=[file_id])})
 
 @login_required
 def cancel_transfer(request, file_id):
@@ -142,20 +140,11 @@ def cancel_transfer(request, file_id):
     backup_file = get_object_or_404(BackupFile, id=file_id, user=request.user)
     
     # Check if the file is in a state that allows cancellation
-    if backup_file.status not in [TransferStatus.PENDING, TransferStatus.IN_PROGRESS, TransferStatus.RETRYING]:
+    if backup_file.status not in CANCELLABLE:
         return JsonResponse({'error': 'Cannot cancel a completed or failed transfer'}, status=400)
     
-    # Update status to cancelled (using FAILED for now, could add a CANCELLED status)
-    backup_file.status = TransferStatus.FAILED
-    backup_file.error_message = 'Transfer cancelled by user'
-    backup_file.save()
-    
-    # Log the cancellation
-    log = TransferLog(
-        backup_file=backup_file,
-        action='transfer_cancelled',
-        message='Transfer cancelled by user'
-    )
-    log.save()
+    # Cancel queued jobs and signal the worker copying the file, which stops within one chunk
+    if not cancel_file_transfer(backup_file):
+        return JsonResponse({'error': 'Transfer finished before it could be cancelled'}, status=400)
     
     return JsonResponse({'success': True, 'message': 'Transfer cancelled', 'redirect': reverse('file_detail', args=[file_id])})
@@ -3,8 +3,12 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.urls import reverse
-from ..models import ServerConfig, BackupFile, TransferLog, TransferStatus
-from ..utils import list_files_on_server, transfer_file, sftp_connect, calculate_folder_size
+from ..models import ServerConfig, BackupFile, TransferBatch, TransferLog, TransferStatus, JobStatus
+from ..utils import sftp_connect
+from ..jobs import enqueue_transfer, submit_batch, get_batch_progress
+from ..snapshots import ScanInProgress, iter_server_listing
+from ..registration import BulkRegistrar
+from ..filters import ScanFilter
 import os
 import logging
 from datetime import datetime
@@ -30,97 +34,66 @@ def scan_files(request):
     source_server = get_object_or_404(ServerConfig, id=source_server_id, user=request.user, server_type='source')
     destination_server = get_object_or_404(ServerConfig, id=destination_server_id, user=request.user, server_type='destination')
     
+    # Optional include/exclude, size and age rules, applied while walking the source
+    try:
+        scan_filter = ScanFilter.from_data(request.POST)
+    except ValueError as e:
+        messages.error(request, f'Invalid scan filter: {str(e)}')
+        return redirect('dashboard')
+    
     try:
-        # List files on source server including folders
-        files = list_files_on_server(source_server, include_folders=True)
-        
-        # Count new files/folders registered
-        new_files_count = 0
-        
         # Establish SFTP connection to source server for folder size calculation
         ssh, sftp = None, None
         try:
             ssh, sftp = sftp_connect(source_server)
             
-            # Register each file/folder for transfer if not already registered
-            for file_info in files:
-                # Check if file/folder is already registered
-                existing = BackupFile.objects.filter(
-                    filename=file_info['filename'],
-                    source_server=source_server,
-                    destination_server=destination_server,
-                    user=request.user
-                ).first()
-                
-                if not existing:
-                    # Use the configured remote paths for both files and folders
-                    source_path = os.path.join(source_server.remote_path, file_info['filename']).replace('\\', '/')
-                    destination_path = os.path.join(destination_server.remote_path, file_info['filename']).replace('\\', '/')
-                    
-                    # Convert line endings of the source file to Linux format if not a folder
-                    if not file_info.get('is_folder', False):
-                        ssh2, sftp2 = None, None
-                        try:
-                            from ..utils import convert_remote_file_line_endings_to_linux
-                            ssh2, sftp2 = sftp_connect(source_server)
-                            convert_remote_file_line_endings_to_linux(sftp2, source_path)
-                        except Exception as e:
-                            logger.error(f"Failed to convert line endings for {source_path}: {str(e)}")
-                        finally:
-                            if sftp2:
-                                sftp2.close()
-                            if ssh2:
-                                ssh2.close()
-                    
-                    # Calculate folder size if folder
-                    file_size = file_info.get('size', 0)
-                    if file_info.get('is_folder', False):
-                        file_size = calculate_folder_size(sftp, source_path)
-                        logger.info(f"Calculated folder size for {source_path}: {file_size} bytes")
-                    
-                    # Register new file or folder for transfer
-                    new_file = BackupFile(
-                        filename=file_info['filename'],
-                        file_size=file_size,
-                        file_created_at=file_info.get('created_at'),
-                        file_modified_at=file_info.get('modified_at'),
-                        source_path=source_path,
-                        destination_path=destination_path,
-                        status=TransferStatus.PENDING,
-                        source_server=source_server,
-                        destination_server=destination_server,
-                        user=request.user,
-                        is_folder=file_info.get('is_folder', False),
-                        files_count=0
-                    )
-                    
-                    new_file.save()
-                    new_files_count += 1
-                    
-                    # Log the registration
-                    log_entry = TransferLog(
-                        backup_file=new_file,
-                        action='file_registered',
-                        message='File or folder registered for transfer'
-                    )
-                    log_entry.save()
+            # Register new files/folders in bulk batches as the listing streams in;
+            # line endings are optionally normalized later, while transferring
+            registrar = BulkRegistrar(
+                source_server,
+                destination_server,
+                request.user,
+                normalize_line_endings=request.POST.get('normalize_line_endings') in ('on', 'true', '1'),
+                scan_filter=scan_filter,
+                sftp=sftp
+            )
+            # Never block the request on another scan's listing of the same path
+            listing = iter_server_listing(source_server, include_folders=True, scan_filter=scan_filter, wait=False)
+            for _ in registrar.register(listing):
+                pass
         finally:
             if sftp:
                 sftp.close()
             if ssh:
                 ssh.close()
         
-        messages.success(request, f'Scan completed! {new_files_count} new files/folders registered for transfer.')
+        messages.success(
+            request,
+            f'Scan completed! {registrar.scanned_count} files/folders scanned, '
+            f'{registrar.registered_count} new files/folders registered for transfer.'
+        )
         return redirect('file_list')
         
+    except ScanInProgress as e:
+        messages.info(request, str(e))
+        return redirect('dashboard')
     except Exception as e:
         messages.error(request, f'Error scanning source server: {str(e)}')
         return redirect('dashboard')
 
 
+def _batch_submitted(request, batch, description):
+    """Respond to a batch submission: JSON for API clients, a message and redirect for forms"""
+    status_url = reverse('transfer_batch_status', args=[batch.pk])
+    if request.accepts('application/json') and not request.accepts('text/html'):
+        return JsonResponse({'success': True, 'batch_id': batch.pk, 'status_url': status_url}, status=202)
+    
+    messages.success(request, f'{description} submitted as batch #{batch.pk}; workers are queueing the transfers')
+    return redirect('file_list')
+
 @login_required
 def initiate_transfer_all(request):
-    """Initiate and process transfer for all pending files and folders in one operation"""
+    """Submit a batch transfer of all pending files and folders"""
     if request.method != 'POST':
         # Only allow POST requests
         return redirect('file_list')
@@ -131,132 +104,37 @@ def initiate_transfer_all(request):
         status=TransferStatus.PENDING
     )
     
-    count = pending_files.count()
-    
-    if count == 0:
+    if not pending_files.exists():
         messages.info(request, 'No pending files or folders to transfer')
         return redirect('file_list')
     
-    success_count = 0
-    failed_count = 0
-    
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    # A worker selects the files and queues their jobs, so the request returns at once
+    batch = submit_batch(request.user, TransferStatus.PENDING, message='Batch transfer initiated by user')
     
-    def transfer_and_log(file):
-        nonlocal success_count, failed_count
-        try:
-            file.status = TransferStatus.IN_PROGRESS
-            file.save()
-            
-            init_log = TransferLog(
-                backup_file=file,
-                action='transfer_initiated',
-                message='Batch transfer initiated by user'
-            )
-            init_log.save()
-            
-            success, message = transfer_file(file)
-            
-            if success:
-                file.status = TransferStatus.SUCCESS
-                log_action = 'transfer_complete'
-                success_count += 1
-            else:
-                file.status = TransferStatus.FAILED
-                file.error_message = message
-                log_action = 'transfer_failed'
-                failed_count += 1
-            
-            file.save()
-            
-            result_log = TransferLog(
-                backup_file=file,
-                action=log_action,
-                message=message
-            )
-            result_log.save()
-        except Exception as e:
-            failed_count += 1
-            file.status = TransferStatus.FAILED
-            file.error_message = str(e)
-            file.save()
-            log = TransferLog(
-                backup_file=file,
-                action='transfer_failed',
-                message=f'Exception during transfer: {str(e)}'
-            )
-            log.save()
-    
-    # Retry failed transfers up to 2 times in batch to improve success rate
-    max_retries = 2
-    for attempt in range(max_retries + 1):
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = [executor.submit(transfer_and_log, file) for file in pending_files if file.status in [TransferStatus.PENDING, TransferStatus.FAILED]]
-            for future in as_completed(futures):
-                pass
-        
-        # Refresh pending_files queryset for next retry
-        pending_files = BackupFile.objects.filter(
-            user=request.user,
-            status=TransferStatus.PENDING
-        )
-        
-        if pending_files.count() == 0:
-            break
-    
-    # Final counts after retries
-    final_pending = BackupFile.objects.filter(user=request.user, status=TransferStatus.PENDING).count()
-    final_failed = BackupFile.objects.filter(user=request.user, status=TransferStatus.FAILED).count()
-    final_success = BackupFile.objects.filter(user=request.user, status=TransferStatus.SUCCESS).count()
-    total = final_pending + final_failed + final_success
-    
-    if final_failed == 0:
-        messages.success(request, f'Successfully transferred all {total} files and folders after retries')
-    else:
-        messages.warning(request, f'Processed {total} items: {final_success} successful, {final_failed} failed after retries. Check file list for details.')
-    
-    return redirect('file_list')
+    return _batch_submitted(request, batch, 'Transfer of all pending files and folders')
 
 @login_required
 def process_transfer(request, file_id):
-    """Process the actual file or folder transfer (would normally be a background task)"""
+    """Make sure a file or folder is queued for the transfer workers"""
     # Get the file or folder or return 404
     backup_file = get_object_or_404(BackupFile, id=file_id, user=request.user)
     
-    # Only process files/folders that are in_progress or retrying
-    if backup_file.status not in [TransferStatus.IN_PROGRESS, TransferStatus.RETRYING]:
-        messages.error(request, f'Cannot process {backup_file.filename} - not in progress')
+    # Completed files/folders have nothing left to process
+    if backup_file.status == TransferStatus.SUCCESS:
+        messages.error(request, f'Cannot process {backup_file.filename} - already transferred')
         return redirect('file_detail', file_id=file_id)
     
-    # Perform the file or folder transfer
-    success, message = transfer_file(backup_file)
-    
-    if success:
-        backup_file.status = TransferStatus.SUCCESS
-        log_action = 'transfer_complete'
-        messages.success(request, f'{backup_file.filename} transferred successfully')
+    # Queue the transfer unless a worker already has it
+    if enqueue_transfer(backup_file, message='Manual transfer initiated by user'):
+        messages.success(request, f'{backup_file.filename} queued for transfer')
     else:
-        backup_file.status = TransferStatus.FAILED
-        backup_file.error_message = message
-        log_action = 'transfer_failed'
-        messages.error(request, f'Transfer failed: {message}')
-    
-    # Update backup file/folder status
-    backup_file.save()
-    
-    # Log the transfer result
-    log_entry = TransferLog(
-        backup_file=backup_file,
-        action=log_action,
-        message=message
-    )
-    log_entry.save()
+        messages.info(request, f'{backup_file.filename} is already queued for transfer')
     
     return redirect('file_detail', file_id=file_id)
 
 @login_required
 def retry_failed(request):
-    """Retry all failed transfers and process them in one operation"""
+    """Submit a batch retry of all failed transfers"""
     if request.method != 'POST':
         # Only allow POST requests
         return redirect('file_list')
@@ -267,74 +145,64 @@ def retry_failed(request):
         status=TransferStatus.FAILED
     )
     
-    count = failed_files.count()
-    
-    if count == 0:
+    if not failed_files.exists():
         messages.info(request, 'No failed files or folders to retry')
         return redirect('file_list')
     
-    success_count = 0
-    failed_count = 0
-    
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    
-    def retry_and_log(file):
-        nonlocal success_count, failed_count
-        try:
-            file.status = TransferStatus.RETRYING
-            file.retry_count += 1
-            file.save()
-            
-            init_log = TransferLog(
-                backup_file=file,
-                action='transfer_retry',
-                message=f'Manual retry initiated by user (attempt #{file.retry_count})'
-            )
-            init_log.save()
-            
-            success, message = transfer_file(file)
-            
-            if success:
-                file.status = TransferStatus.SUCCESS
-                log_action = 'transfer_complete'
-                success_count += 1
-            else:
-                file.status = TransferStatus.FAILED
-                file.error_message = message
-                log_action = 'transfer_failed'
-                failed_count += 1
-            
-            file.save()
-            
-            result_log = TransferLog(
-                backup_file=file,
-                action=log_action,
-                message=message
-            )
-            result_log.save()
-        except Exception as e:
-            failed_count += 1
-            file.status = TransferStatus.FAILED
-            file.error_message = str(e)
-            file.save()
-            log = TransferLog(
-                backup_file=file,
-                action='transfer_failed',
-                message=f'Exception during retry: {str(e)}'
-            )
-            log.save()
+    batch = submit_batch(
+        request.user,
+        TransferStatus.FAILED,
+        action='transfer_retry',
+        message='Manual retry initiated by user'
+    )
     
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(retry_and_log, file) for file in failed_files]
-        for future in as_completed(futures):
-            pass
+    return _batch_submitted(request, batch, 'Retry of all failed files and folders')
+
+@login_required
+def transfer_batch_status(request, batch_id):
+    """
+    Report the progress of a transfer batch and the results of its finished items
     
-    if failed_count == 0:
-        messages.success(request, f'Successfully retried and transferred all {count} files and folders')
-    else:
-        messages.warning(request, f'Processed {count} retry attempts: {success_count} successful, {failed_count} failed. Check file list for details.')
+    Items are returned in the order they finished; pass the previous response's
+    `next_offset` as `offset` to fetch only results that arrived since.
+    """
+    # Get the batch or return 404
+    batch = get_object_or_404(TransferBatch, id=batch_id, user=request.user)
     
-    return redirect('file_list')
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', 500)), 1), 5000)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset or limit'}, status=400)
+    
+    progress = get_batch_progress(batch)
+    submitted = batch.status == JobStatus.DONE
+    finished_jobs = batch.jobs.filter(finished_at__isnull=False).select_related('backup_file').order_by('finished_at', 'pk')
+    items = list(finished_jobs[offset:offset + limit])
+    
+    return JsonResponse({
+        'id': batch.pk,
+        'source_status': batch.source_status,
+        'status': batch.status,
+        'submitted': submitted,
+        'finished': batch.status == JobStatus.FAILED or (submitted and progress['completed'] == progress['total']),
+        'result': batch.result,
+        'progress': progress,
+        'created_at': batch.created_at.isoformat(),
+        'offset': offset,
+        'next_offset': offset + len(items),
+        'items': [
+            {
+                'job_id': job.pk,
+                'file_id': job.backup_file_id,
+                'filename': job.backup_file.filename,
+                'status': job.status,
+                'result': job.result,
+                'finished_at': job.finished_at.isoformat(),
+            }
+            for job in items
+        ],
+    })
 
 @login_required
 def fix_file_paths(request):
@@ -358,7 +226,7 @@ def fix_file_paths(request):
         file.destination_path = os.path.join(destination_server.remote_path, file.filename).replace('\\', '/')
         
         # Reset status to pending for retransfer if failed
-        if file.status == TransferStatus.FAILED:
+        if file.status in (TransferStatus.FAILED, TransferStatus.DEAD_LETTER):
             file.status = TransferStatus.PENDING
             file.error_message = None
         
@@ -106,3 +106,73 @@ LOGOUT_REDIRECT_URL = 'login'
 # Django APScheduler settings
 APSCHEDULER_DATETIME_FORMAT = "N j, Y, f:s a"
 APSCHEDULER_RUN_NOW_TIMEOUT = 25  # Seconds
+
+# Backup scanning settings
+BACKUP_SNAPSHOT_TTL = 300  # Seconds a cached remote listing is served without rescanning
+BACKUP_FOLDER_SIZE_CACHE_ENTRIES = 10000  # Folder totals memoized per (server, path, directory mtime)
+
+# Transfer queue settings
+BACKUP_WORKER_THREADS = 10  # Transfer worker threads per process
+# Run workers inside the web process alongside the scheduler; disable when using `manage.py run_transfer_workers`
+BACKUP_RUN_INPROCESS_WORKERS = os.environ.get('BACKUP_RUN_INPROCESS_WORKERS', 'true').lower() in ('1', 'true', 'yes')
+BACKUP_JOB_LEASE_SECONDS = 300  # Visibility timeout of a claimed job
+BACKUP_JOB_HEARTBEAT_SECONDS = 30  # Lease renewal interval while a transfer runs
+BACKUP_JOB_POLL_SECONDS = 2  # Idle worker polling interval
+BACKUP_SCHEDULE_MAX_QUEUED = 5000  # A schedule run's scan pauses while this many of its transfers are queued
+BACKUP_SCHEDULE_QUEUE_WAIT_SECONDS = 600  # Longest pause per chunk before the scan queues anyway
+
+# Per-server limits; ServerConfig.max_connections / max_transfers override them
+BACKUP_MAX_CONNECTIONS_PER_SERVER = 12  # SSH sessions per worker process
+BACKUP_MAX_TRANSFERS_PER_SERVER = 10  # Concurrent transfers across all workers
+BACKUP_CONNECTION_WAIT_SECONDS = 300  # How long to wait for a free session slot
+
+# Adaptive (AIMD) concurrency per destination, capped by its transfer limit
+BACKUP_ADAPTIVE_CONCURRENCY = True
+BACKUP_AIMD_INITIAL_CONCURRENCY = 2  # Starting level before throughput is measured
+BACKUP_AIMD_WINDOW_SECONDS = 30  # Throughput measurement window between adjustments
+BACKUP_AIMD_DECREASE_FACTOR = 0.5  # Multiplicative decrease on timeouts/connection errors
+BACKUP_AIMD_GROWTH_THRESHOLD = 0.05  # Relative throughput gain needed to add a transfer
+
+# Size-aware ordering estimates
+BACKUP_DEFAULT_TRANSFER_RATE = 10 * 1024 * 1024  # Bytes/second per transfer before throughput is measured
+BACKUP_TRANSFER_OVERHEAD_SECONDS = 0.5  # Fixed cost added to every transfer estimate
+
+# Small-file batching
+BACKUP_SMALL_FILE_THRESHOLD = 1048576  # Files up to 1 MB share a session with other small files
+BACKUP_SMALL_FILE_BATCH_SIZE = 100  # Maximum files transferred over one session
+
+# Automatic retries of failed transfers
+BACKUP_MAX_RETRIES = 8  # Transient failures retried this often before the file is dead-lettered
+BACKUP_RETRY_BASE_SECONDS = 60  # First retry delay, doubled on every attempt (with jitter)
+BACKUP_RETRY_MAX_DELAY_SECONDS = 6 * 3600  # Cap on the retry delay
+BACKUP_RETRY_CHECK_SECONDS = 60  # How often the scheduler looks for retries that are due
+
+# Per-server circuit breaker
+BACKUP_BREAKER_FAILURE_THRESHOLD = 5  # Consecutive connection failures that open the breaker
+BACKUP_BREAKER_COOLDOWN_SECONDS = 300  # Time an open breaker rejects connections before a probe
+
+# Schedule changes are picked up by the running scheduler within this many seconds
+BACKUP_SCHEDULE_SYNC_SECONDS = 30
+
+# Scheduler leader election: one process per cluster runs the scheduler
+BACKUP_LEADER_LEASE_SECONDS = 30  # A dead leader is replaced after this
+BACKUP_LEADER_HEARTBEAT_SECONDS = 10  # Lease renewal and takeover attempt interval
+
+# Sharding of schedules and transfers across worker nodes (every TransferWorker process is a node)
+BACKUP_SHARDING = True
+BACKUP_NODE_LEASE_SECONDS = 60  # A node without heartbeat leaves the hash ring after this
+BACKUP_NODE_HEARTBEAT_SECONDS = 15  # Heartbeat and ring refresh interval
+BACKUP_SHARD_VIRTUAL_NODES = 128  # Points per node on the hash ring
+BACKUP_SHARD_WORK_STEALING = True  # Idle nodes take transfers from servers owned by other nodes
+
+# Coalescing of scans of the same server and path
+BACKUP_SCAN_SHARE_SECONDS = 60  # A finished listing is reused by scans starting within this window
+BACKUP_SCAN_WAIT_SECONDS = 300  # Longest wait for another scan's in-flight listing; an unrenewed listing claim lapses after this
+
+# Fair sharing of the transfer workers between users (weights are set per user in the admin)
+BACKUP_FAIR_SHARE = True
+BACKUP_DEFAULT_USER_WEIGHT = 1.0  # Weight of users without a FairShare of their own
+BACKUP_USER_MAX_TRANSFERS = None  # Default cap on one user's concurrent transfers, None for no cap
+
+# Cancellation of running transfers
+BACKUP_CANCEL_CHECK_SECONDS = 1  # How often workers in other processes poll for cancelled transfers